@@ -11,11 +11,39 @@ Usage:
     
     app = build_graph()
     result = app.invoke({"user_query": "Find malicious IP 192.168.1.1", "chat_history": [], "retries": 0})
+
+    # Many hunts at once, results streamed back as they finish:
+    from nl2kql_agent import run_batch
+
+    async for item in run_batch(queries, max_concurrency=16):
+        ...
+
+Submodules are imported on first attribute access (PEP 562), so importing the
+package itself loads neither LangGraph nor any LLM provider.
 """
 
+import importlib
+
 __version__ = "1.0.0"
 __author__ = "Your Name"
 
-from .graph import build_graph
+# Public name -> submodule that defines it.
+_LAZY_ATTRIBUTES = {
+    "build_graph": ".graph",
+    "run_batch": ".batch",
+}
+
+__all__ = ["build_graph", "run_batch"]
+
+
+def __getattr__(name: str):
+    module = _LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
 
-__all__ = ["build_graph"]
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
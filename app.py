@@ -1,9 +1,11 @@
 from .graph import build_graph
-from .threat_intel_types import ThreatIntelState
+from .instrumentation import METRICS, configure_logging
+from .threat_intel_types import initial_state
 
 
 def run_demo():
     """Run demonstration scenarios for the threat intelligence system."""
+    configure_logging()
     app = build_graph()
 
     scenarios = [
@@ -17,19 +19,8 @@ def run_demo():
     for i, query in enumerate(scenarios, 1):
         print(f"\n=== Example {i}: {query} ===")
         
-        initial_state: ThreatIntelState = {
-            "user_query": query,
-            "enriched_query": "",
-            "shortlisted_tables": [],
-            "kql_query": "",
-            "validation_status": "",
-            "validation_error": "",
-            "retries": 0,
-            "chat_history": []
-        }
-        
         try:
-            result = app.invoke(initial_state)
+            result = app.invoke(initial_state(query))
             
             print("\n--- Final Results ---")
             print(f"User Query: {result['user_query']}")
@@ -46,6 +37,9 @@ def run_demo():
         
         print("-" * 80)
 
+    print("\n--- Metrics ---")
+    print(METRICS.render_prometheus())
+
 
 if __name__ == "__main__":
     run_demo()
@@ -0,0 +1,314 @@
+"""
+Offline benchmark: runs a corpus of hunts through build_graph() with
+fake_llm.FakeChatModel in place of Gemini and reports latency percentiles,
+per-node time, retries, token counts and throughput per concurrency level.
+With --prefix-cache the fake model emulates provider prompt caching, and the
+report includes the prefix-cache hit rate and cached prompt tokens.
+
+Usage:
+    python -m nl2kql_agent.benchmark --concurrency 1 4 16 --latency 0.2 --invalid-rate 0.3 --output bench.json
+    python -m nl2kql_agent.benchmark --concurrency 4 --repeat 3 --prefix-cache
+
+The JSON report is written to --output (or stdout); a summary table goes to stderr.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import platform
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from . import __version__
+from .fake_llm import FakeChatModel
+from .graph import build_graph
+from .llm import set_llm_factory
+from .threat_intel_types import initial_state
+
+DEFAULT_CORPUS = [
+    "Find activities related to malicious IP address 192.168.1.1",
+    "Investigate phishing email from attacker@evil.com",
+    "Analyze activities related to suspicious file hash d41d8cd98f00b204e9800998ecf8427e",
+    "Which hosts connected to the domain evil-updates.net in the last day?",
+    "Show browsing to http://malicious.example.com/payload.exe",
+    "Find logins from 10.0.0.5 to any account",
+    "Look for processes launched with the SHA256 e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
+    "Emails sent by ceo-office@fake-corp.com with attachments",
+    "DNS lookups resolving to 203.0.113.77",
+    "Were there failed authentication attempts for admin accounts?",
+    "List outbound connections to 2001:db8::1",
+    "Show me anything unusual",
+]
+
+
+class _UsageCollector(BaseCallbackHandler):
+    """Adds up token usage and LLM calls for one query."""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cache_hits = 0
+        self.llm_calls = 0
+        self.llm_errors = 0
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        self.llm_calls += 1
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                self.prompt_tokens += usage.get("input_tokens", 0)
+                self.completion_tokens += usage.get("output_tokens", 0)
+                cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+                self.cached_tokens += cached
+                self.cache_hits += 1 if cached else 0
+
+    def on_llm_error(self, error, **kwargs) -> None:
+        self.llm_calls += 1
+        self.llm_errors += 1
+
+
+@dataclass
+class QueryRun:
+    user_query: str
+    latency: float
+    node_seconds: Dict[str, float] = field(default_factory=dict)
+    retries: int = 0
+    status: str = ""
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cache_hits: int = 0
+    llm_calls: int = 0
+    llm_errors: int = 0
+    error: Optional[str] = None
+
+
+async def _run_query(app, user_query: str, timeout: Optional[float]) -> QueryRun:
+    usage = _UsageCollector()
+    run = QueryRun(user_query=user_query, latency=0.0)
+    start = last = time.perf_counter()
+    final = None
+
+    async def consume():
+        nonlocal last, final
+        async for mode, chunk in app.astream(
+            initial_state(user_query), {"callbacks": [usage]}, stream_mode=["updates", "values"]
+        ):
+            now = time.perf_counter()
+            if mode == "updates":
+                for node, update in chunk.items():
+                    run.node_seconds[node] = run.node_seconds.get(node, 0.0) + (now - last)
+                    # The final state's retries is reset to 0 once a query validates, so count reflections here.
+                    if node == "kql_validator" and (update or {}).get("validation_status") == "retrying":
+                        run.retries += 1
+                last = now
+            else:
+                final = chunk
+
+    try:
+        await asyncio.wait_for(consume(), timeout)
+    except asyncio.TimeoutError:
+        run.error = f"Timed out after {timeout}s"
+    except Exception as e:
+        run.error = f"{type(e).__name__}: {e}"
+    run.latency = time.perf_counter() - start
+    if final is not None:
+        run.status = final.get("validation_status", "")
+    run.prompt_tokens = usage.prompt_tokens
+    run.completion_tokens = usage.completion_tokens
+    run.cached_tokens = usage.cached_tokens
+    run.cache_hits = usage.cache_hits
+    run.llm_calls = usage.llm_calls
+    run.llm_errors = usage.llm_errors
+    return run
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile; 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(runs: List[QueryRun], wall_seconds: float, concurrency: int) -> dict:
+    """Aggregates one concurrency level into the report format."""
+    latencies = [r.latency for r in runs]
+    nodes = sorted({node for r in runs for node in r.node_seconds})
+    node_time = {}
+    for node in nodes:
+        samples = [r.node_seconds[node] for r in runs if node in r.node_seconds]
+        node_time[node] = {
+            "calls": len(samples),
+            "mean": sum(samples) / len(samples),
+            "p95": percentile(samples, 95),
+            "total": sum(samples),
+        }
+    statuses: Dict[str, int] = {}
+    for r in runs:
+        key = r.status or "error"
+        statuses[key] = statuses.get(key, 0) + 1
+    count = len(runs) or 1
+    return {
+        "concurrency": concurrency,
+        "queries": len(runs),
+        "wall_seconds": wall_seconds,
+        "queries_per_second": len(runs) / wall_seconds if wall_seconds > 0 else 0.0,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / count,
+            "max": max(latencies, default=0.0),
+        },
+        "node_seconds": node_time,
+        "retries": {
+            "mean": sum(r.retries for r in runs) / count,
+            "max": max((r.retries for r in runs), default=0),
+            "total": sum(r.retries for r in runs),
+        },
+        "tokens": {
+            "prompt": sum(r.prompt_tokens for r in runs),
+            "completion": sum(r.completion_tokens for r in runs),
+            "prompt_per_query": sum(r.prompt_tokens for r in runs) / count,
+            "completion_per_query": sum(r.completion_tokens for r in runs) / count,
+            "cached": sum(r.cached_tokens for r in runs),
+        },
+        "prompt_cache": {
+            "hits": sum(r.cache_hits for r in runs),
+            "hit_rate": sum(r.cache_hits for r in runs) / max(1, sum(r.llm_calls - r.llm_errors for r in runs)),
+            "cached_token_share": sum(r.cached_tokens for r in runs) / max(1, sum(r.prompt_tokens for r in runs)),
+        },
+        "llm_calls": sum(r.llm_calls for r in runs),
+        "llm_errors": sum(r.llm_errors for r in runs),
+        "status": statuses,
+        "errors": [r.error for r in runs if r.error],
+    }
+
+
+async def _run_level(app, corpus: Sequence[str], concurrency: int, repeat: int, timeout: Optional[float]) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(user_query: str) -> QueryRun:
+        async with semaphore:
+            return await _run_query(app, user_query, timeout)
+
+    queries = [q for _ in range(repeat) for q in corpus]
+    start = time.perf_counter()
+    runs = await asyncio.gather(*(bounded(q) for q in queries))
+    return summarize(list(runs), time.perf_counter() - start, concurrency)
+
+
+def run_benchmark(
+    corpus: Optional[Sequence[str]] = None,
+    concurrency_levels: Sequence[int] = (1, 4, 16),
+    repeat: int = 1,
+    model: Optional[FakeChatModel] = None,
+    timeout: Optional[float] = 60.0,
+    quiet: bool = True,
+    candidates: int = 1,
+) -> dict:
+    """
+    Runs the benchmark and returns the report as a dict.
+
+    model defaults to a FakeChatModel with no latency. Node logging is
+    suppressed unless quiet is False. candidates is passed to build_graph.
+    """
+    corpus = list(corpus or DEFAULT_CORPUS)
+    model = model or FakeChatModel()
+    package_logger = logging.getLogger(__package__)
+    previous_level = package_logger.level
+    if quiet:
+        package_logger.setLevel(logging.ERROR)
+    set_llm_factory(lambda name, temperature: model)
+    try:
+        app = build_graph(candidates=candidates)
+        levels = []
+        for concurrency in concurrency_levels:
+            model.clear_prefix_cache()
+            levels.append(asyncio.run(_run_level(app, corpus, concurrency, repeat, timeout)))
+    finally:
+        set_llm_factory(None)
+        package_logger.setLevel(previous_level)
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "model": {
+            "latency": model.latency,
+            "jitter": model.jitter,
+            "tokens_per_second": model.tokens_per_second,
+            "error_rate": model.error_rate,
+            "invalid_rate": model.invalid_rate,
+            "seed": model.seed,
+            "prefix_cache": model.prefix_cache,
+        },
+        "candidates": candidates,
+        "corpus_size": len(corpus),
+        "repeat": repeat,
+        "levels": levels,
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{'conc':>4} {'n':>5} {'qps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'retries':>7} {'tok/q':>8} {'cached':>6} {'errors':>6}"
+    ]
+    for level in report["levels"]:
+        latency = level["latency"]
+        tokens = level["tokens"]["prompt_per_query"] + level["tokens"]["completion_per_query"]
+        lines.append(
+            f"{level['concurrency']:>4} {level['queries']:>5} {level['queries_per_second']:>8.2f} "
+            f"{latency['p50']:>8.3f} {latency['p95']:>8.3f} {latency['p99']:>8.3f} "
+            f"{level['retries']['mean']:>7.2f} {tokens:>8.0f} {level['prompt_cache']['cached_token_share']:>6.0%} "
+            f"{len(level['errors']):>6}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline NL2KQL graph benchmark with a fake LLM.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=1, help="Times the corpus is run per level.")
+    parser.add_argument("--corpus", help="File with one natural-language query per line.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean fake LLM latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--invalid-rate", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prefix-cache", action="store_true", help="Emulate provider prompt-prefix caching.")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--candidates", type=int, default=1, help="Speculative KQL candidates per generation.")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    corpus = None
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    model = FakeChatModel(
+        latency=args.latency, jitter=args.jitter, tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate, invalid_rate=args.invalid_rate, seed=args.seed, prefix_cache=args.prefix_cache,
+    )
+    report = run_benchmark(corpus, args.concurrency, args.repeat, model, args.timeout, candidates=args.candidates)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print(format_report(report), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
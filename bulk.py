@@ -0,0 +1,494 @@
+"""
+Bulk IoC hunting: turn thousands of indicators from threat-feed files into a
+handful of set-based KQL queries.
+
+Indicators are streamed from CSV, STIX 2.x JSON or plain-text files in chunks,
+refanged, typed with the patterns in iocs.py and deduplicated into an
+IndicatorSet. BulkHunter then makes one LLM call per (indicator type, table)
+to write a query over a placeholder set named `indicators`, and binds that
+set to as many `let indicators = dynamic([...]);` chunks as the query-length
+and value-count limits require. No LLM call is made per indicator.
+
+Usage:
+    python -m nl2kql_agent.bulk feed.csv bundle.json iocs.txt --request "Connections in the last week" --output hunts.kql
+
+    indicators = IndicatorSet()
+    for chunk in read_indicators(["feed.csv", "bundle.json"]):
+        indicators.update(chunk)
+    for query in BulkHunter().queries(indicators, "Connections in the last week"):
+        print(query.kql_query)
+"""
+
+import argparse
+import asyncio
+import csv
+import ipaddress
+import json
+import logging
+import os
+import re
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from .instrumentation import METRICS, configure_logging
+from .iocs import IOC_LABELS, column_index, extract_iocs, ioc_columns
+from .kql_parser import validate_kql
+from .llm import LazyLLM, priority_class
+from .prompts import CachedPrompt
+from .schemas import SchemaRegistry, get_registry
+
+logger = logging.getLogger(__name__)
+
+BULK_INDICATORS = METRICS.counter("nl2kql_bulk_indicators_total", "Indicators read from feeds, by outcome (added, duplicate, skipped).", ["outcome"])
+BULK_TEMPLATES = METRICS.counter("nl2kql_bulk_templates_total", "Per-type, per-table query templates, by source (llm, fallback).", ["source"])
+
+PLACEHOLDER = "indicators"
+DEFAULT_CHUNK_SIZE = 5000
+# Kusto accepts longer queries, but most hunting APIs and portals cap the text well below 100 KB.
+DEFAULT_MAX_QUERY_CHARS = 60_000
+# has_any() takes at most 10,000 values.
+DEFAULT_MAX_VALUES = 10_000
+
+# Only domains appear as whole terms inside other columns (URLs, email addresses).
+_EMBEDDED_TYPES = {"domain"}
+_HASH_TYPES = {"md5", "sha1", "sha256"}
+_REFANG = (
+    (re.compile(r"\[\.\]|\(\.\)|\{\.\}|\[dot\]", re.IGNORECASE), "."),
+    (re.compile(r"\[:\]"), ":"),
+    (re.compile(r"\[@\]|\[at\]", re.IGNORECASE), "@"),
+    (re.compile(r"\bhxxp", re.IGNORECASE), "http"),
+    (re.compile(r"\bfxp", re.IGNORECASE), "ftp"),
+)
+# Quoted comparison values in a STIX pattern, e.g. [ipv4-addr:value = '198.51.100.1'].
+_STIX_VALUE = re.compile(r"[=]\s*'((?:[^'\\]|\\.)*)'")
+_STIX_SCO_TYPES = {"ipv4-addr", "ipv6-addr", "domain-name", "url", "email-addr", "file"}
+_CSV_VALUE_COLUMNS = ("indicator", "ioc", "value", "observable", "indicator_value")
+
+
+def refang(text: str) -> str:
+    """Undoes the usual feed defanging: 1.2.3[.]4, hxxp://, user[@]example.com."""
+    for pattern, replacement in _REFANG:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _from_text(text: str) -> List[Tuple[str, str]]:
+    return [(ioc.type, ioc.value) for ioc in extract_iocs(refang(text))]
+
+
+def _read_text(f) -> Iterator[Tuple[str, str]]:
+    for line in f:
+        if not line.lstrip().startswith("#"):
+            yield from _from_text(line)
+
+
+def _read_csv(f) -> Iterator[Tuple[str, str]]:
+    sample = f.read(4096)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        has_header = csv.Sniffer().has_header(sample)
+    except csv.Error:
+        dialect, has_header = csv.excel, False
+    reader = csv.reader(f, dialect)
+    value_column = None
+    if has_header:
+        header = [name.strip().lower() for name in next(reader, [])]
+        value_column = next((header.index(name) for name in _CSV_VALUE_COLUMNS if name in header), None)
+    for row in reader:
+        if value_column is not None:
+            if value_column < len(row):
+                yield from _from_text(row[value_column])
+        else:
+            for cell in row:
+                yield from _from_text(cell)
+
+
+def _stix_objects(obj) -> Iterator[Tuple[str, str]]:
+    """Indicators in a STIX bundle, a list of STIX objects or a single object."""
+    if isinstance(obj, list):
+        for item in obj:
+            yield from _stix_objects(item)
+        return
+    if not isinstance(obj, dict):
+        return
+    if obj.get("type") == "bundle":
+        yield from _stix_objects(obj.get("objects", []))
+    elif obj.get("type") == "indicator" and obj.get("pattern_type", "stix") == "stix":
+        for value in _STIX_VALUE.findall(obj.get("pattern", "")):
+            yield from _from_text(value.replace("\\'", "'"))
+    elif obj.get("type") in _STIX_SCO_TYPES:
+        values = list(obj.get("hashes", {}).values()) if obj["type"] == "file" else [obj.get("value", "")]
+        for value in values:
+            yield from _from_text(str(value))
+
+
+def _read_stix(f) -> Iterator[Tuple[str, str]]:
+    """A STIX 2.x bundle (or a bare object list), or one STIX object per line."""
+    first = f.read(1)
+    while first and first.isspace():
+        first = f.read(1)
+    f.seek(0)
+    if first == "{" and f.readline().strip().endswith("}"):
+        # JSON lines: one object per line keeps large exports streaming.
+        f.seek(0)
+        for line in f:
+            if line.strip():
+                yield from _stix_objects(json.loads(line))
+        return
+    f.seek(0)
+    yield from _stix_objects(json.load(f))
+
+
+_READERS = {"text": _read_text, "csv": _read_csv, "stix": _read_stix}
+
+
+def _format_of(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".csv", ".tsv"):
+        return "csv"
+    if extension in (".json", ".jsonl", ".stix"):
+        return "stix"
+    return "text"
+
+
+def read_indicators(paths: Sequence[str], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                    fmt: Optional[str] = None) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Streams (type, value) pairs from indicator files in lists of up to
+    chunk_size. The format is taken from the extension (.csv/.tsv, .json/
+    .jsonl/.stix, anything else as text) unless fmt ("csv", "stix", "text")
+    is given. Duplicates are not removed here; see IndicatorSet.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    chunk: List[Tuple[str, str]] = []
+    for path in paths:
+        reader = _READERS[fmt or _format_of(path)]
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            for item in reader(f):
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+class IndicatorSet:
+    """
+    Deduplicated indicators grouped by IoC type.
+
+    Values are kept in their smallest exact form: IPv4 addresses as ints,
+    IPv6 addresses and hashes as bytes, everything else as lower-cased text,
+    so equivalent spellings (upper/lower-case hashes, 2001:DB8::1 and
+    2001:db8:0::1) collapse to one entry.
+
+    Attributes:
+        added (int): Distinct indicators stored.
+        duplicates (int): Indicators dropped as already present.
+        skipped (int): Values that are not a supported IoC type.
+    """
+
+    def __init__(self, items: Iterable[Tuple[str, str]] = ()):
+        self._values: Dict[str, Set[object]] = {}
+        self.added = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.update(items)
+
+    @staticmethod
+    def _encode(ioc_type: str, value: str) -> object:
+        if ioc_type == "ipv4":
+            return int(ipaddress.IPv4Address(value))
+        if ioc_type == "ipv6":
+            return ipaddress.IPv6Address(value).packed
+        if ioc_type in _HASH_TYPES:
+            return bytes.fromhex(value)
+        return value.lower()
+
+    @staticmethod
+    def _decode(ioc_type: str, value: object) -> str:
+        if ioc_type == "ipv4":
+            return str(ipaddress.IPv4Address(value))
+        if ioc_type == "ipv6":
+            return str(ipaddress.IPv6Address(value))
+        if ioc_type in _HASH_TYPES:
+            return value.hex()
+        return value
+
+    def add(self, ioc_type: str, value: str) -> bool:
+        """Stores one indicator; False if it was a duplicate or not a supported type."""
+        try:
+            key = self._encode(ioc_type, value.strip())
+        except ValueError:
+            key = None
+        if key is None or ioc_type not in IOC_LABELS:
+            self.skipped += 1
+            BULK_INDICATORS.inc(outcome="skipped")
+            return False
+        values = self._values.setdefault(ioc_type, set())
+        if key in values:
+            self.duplicates += 1
+            BULK_INDICATORS.inc(outcome="duplicate")
+            return False
+        values.add(key)
+        self.added += 1
+        BULK_INDICATORS.inc(outcome="added")
+        return True
+
+    def update(self, items: Iterable[Tuple[str, str]]) -> None:
+        for ioc_type, value in items:
+            self.add(ioc_type, value)
+
+    def types(self) -> List[str]:
+        """IoC types present, in IOC_LABELS order."""
+        return [ioc_type for ioc_type in IOC_LABELS if self._values.get(ioc_type)]
+
+    def values(self, ioc_type: str) -> List[str]:
+        """The indicators of one type as text, sorted."""
+        return sorted(self._decode(ioc_type, value) for value in self._values.get(ioc_type, ()))
+
+    def __len__(self) -> int:
+        return self.added
+
+    def counts(self) -> Dict[str, int]:
+        return {ioc_type: len(self._values[ioc_type]) for ioc_type in self.types()}
+
+
+@dataclass
+class BulkQuery:
+    """
+    One generated query over a chunk of indicators.
+
+    Attributes:
+        ioc_type (str): IoC type of the indicators in the chunk.
+        table (str): Table the query hunts in.
+        chunk (int): 1-based chunk number; total is the number of chunks for this type and table.
+        total (int): Chunks for this type and table.
+        indicators (int): Indicators bound in this query.
+        kql_query (str): The query, starting with the `let indicators = dynamic([...]);` binding.
+    """
+    ioc_type: str
+    table: str
+    chunk: int
+    total: int
+    indicators: int
+    kql_query: str
+
+
+class BulkHunter:
+    """
+    Writes set-based hunting queries for an IndicatorSet, with one LLM call
+    per (IoC type, table) pair.
+
+    Attributes:
+        lookback (str): Time window for the fallback template and the prompt, e.g. "30d".
+        max_query_chars (int): Upper bound on the length of each emitted query.
+        max_values (int): Upper bound on the indicators bound in each query.
+        use_llm (bool): False skips the LLM and uses the deterministic template for every pair.
+        registry (SchemaRegistry): Schemas and column index; the process-wide registry by default.
+    """
+
+    llm = LazyLLM(temperature=0.0)
+
+    PROMPT = CachedPrompt("bulk", f"""
+You are an expert in Kusto Query Language (KQL) and a security analyst.
+Write one KQL query over the table below that hunts for any of a set of indicators of compromise.
+The set is already bound as a dynamic array named `{PLACEHOLDER}`; do not define it and do not list any values.
+Use `in~ ({PLACEHOLDER})` for columns that hold the indicator itself and `has_any ({PLACEHOLDER})` for columns that merely contain it.
+Use the exact table and field names from the schema.
+Your output MUST be ONLY the KQL query string, without any additional text, explanations, or markdown formatting (e.g., no ```kql).
+        """, suffix="""
+Indicator type: {ioc_label}
+Match against these columns: {columns}
+Restrict the time range to the last {lookback} unless the request says otherwise.
+
+Hunting Request:
+{request}
+        """, schema_heading="Table and Schema:")
+
+    def __init__(self, lookback: str = "30d", max_query_chars: int = DEFAULT_MAX_QUERY_CHARS,
+                 max_values: int = DEFAULT_MAX_VALUES, use_llm: bool = True,
+                 registry: Optional[SchemaRegistry] = None):
+        if max_values < 1:
+            raise ValueError("max_values must be at least 1.")
+        self.lookback = lookback
+        self.max_query_chars = max_query_chars
+        self.max_values = max_values
+        self.use_llm = use_llm
+        self.registry = registry or get_registry()
+
+    # -- planning ----------------------------------------------------------- #
+
+    def targets(self, ioc_type: str, tables: Optional[Sequence[str]] = None) -> Dict[str, List[Tuple[str, bool]]]:
+        """Table -> [(column, native)] for one IoC type; native columns hold the indicator itself."""
+        targets: Dict[str, List[Tuple[str, bool]]] = {}
+        native_weight = max((weight for _, _, weight in ioc_columns(ioc_type, column_index(self.registry))), default=0)
+        for table, column, weight in ioc_columns(ioc_type, column_index(self.registry)):
+            native = weight >= native_weight
+            if tables is not None and table not in tables or not native and ioc_type not in _EMBEDDED_TYPES:
+                continue
+            targets.setdefault(table, []).append((column, native))
+        return targets
+
+    def fallback_template(self, ioc_type: str, table: str, columns: List[Tuple[str, bool]]) -> str:
+        """A set-membership query written without the LLM."""
+        operator = "in" if ioc_type in ("ipv4", "ipv6") else "in~"
+        terms = [f"{column} {operator} ({PLACEHOLDER})" if native else f"{column} has_any ({PLACEHOLDER})"
+                 for column, native in columns]
+        lines = [table]
+        time_column = next((column for column, col_type in self.registry[table] if col_type == "datetime"), None)
+        if time_column is not None:
+            lines.append(f"| where {time_column} > ago({self.lookback})")
+        lines.append(f"| where {' or '.join(terms)}")
+        return "\n".join(lines)
+
+    def _messages(self, request: str, ioc_type: str, table: str, columns: List[Tuple[str, bool]]) -> List:
+        return self.PROMPT.format_messages(
+            [table], ioc_label=IOC_LABELS[ioc_type], lookback=self.lookback,
+            columns=", ".join(f"{column} ({'holds' if native else 'contains'} it)" for column, native in columns),
+            request=request.strip() or "Find any activity involving these indicators.",
+        )
+
+    def _on_template(self, ioc_type: str, table: str, columns: List[Tuple[str, bool]], llm_response) -> str:
+        """The LLM's template if it validates and uses the placeholder, otherwise the fallback."""
+        content = llm_response.content
+        template = (content if isinstance(content, str) else "".join(p for p in content if isinstance(p, str))).strip()
+        # A model that binds the set itself anyway: drop its let statement.
+        template = re.sub(rf"^\s*let\s+{PLACEHOLDER}\s*=[^;]*;\s*", "", template)
+        probe = f'let {PLACEHOLDER} = dynamic(["x"]);\n{template}'
+        if re.search(rf"\b{PLACEHOLDER}\b", template) and validate_kql(probe, [table])["is_valid"]:
+            BULK_TEMPLATES.inc(source="llm")
+            return template
+        logger.info("Template for %s in %s does not use the indicator set or is invalid; using the fallback.",
+                    ioc_type, table)
+        return self._fallback(ioc_type, table, columns)
+
+    def _fallback(self, ioc_type: str, table: str, columns: List[Tuple[str, bool]]) -> str:
+        BULK_TEMPLATES.inc(source="fallback")
+        return self.fallback_template(ioc_type, table, columns)
+
+    def _plan(self, indicators: IndicatorSet, tables: Optional[Sequence[str]]) -> List[Tuple[str, str, List[Tuple[str, bool]]]]:
+        return [
+            (ioc_type, table, columns)
+            for ioc_type in indicators.types()
+            for table, columns in self.targets(ioc_type, tables).items()
+        ]
+
+    def templates(self, indicators: IndicatorSet, request: str = "",
+                  tables: Optional[Sequence[str]] = None) -> Dict[Tuple[str, str], str]:
+        """(IoC type, table) -> query template over `indicators`, one LLM call each."""
+        templates = {}
+        with priority_class("batch"):
+            for ioc_type, table, columns in self._plan(indicators, tables):
+                if not self.use_llm:
+                    templates[ioc_type, table] = self._fallback(ioc_type, table, columns)
+                    continue
+                try:
+                    response = self.llm.invoke(self._messages(request, ioc_type, table, columns))
+                    templates[ioc_type, table] = self._on_template(ioc_type, table, columns, response)
+                except Exception as e:
+                    logger.warning("Template generation for %s in %s failed: %s", ioc_type, table, e)
+                    templates[ioc_type, table] = self._fallback(ioc_type, table, columns)
+        return templates
+
+    async def atemplates(self, indicators: IndicatorSet, request: str = "",
+                         tables: Optional[Sequence[str]] = None) -> Dict[Tuple[str, str], str]:
+        """Async variant of templates(); the LLM calls run concurrently."""
+        async def one(ioc_type: str, table: str, columns: List[Tuple[str, bool]]) -> str:
+            if not self.use_llm:
+                return self._fallback(ioc_type, table, columns)
+            try:
+                response = await self.llm.ainvoke(self._messages(request, ioc_type, table, columns))
+                return self._on_template(ioc_type, table, columns, response)
+            except Exception as e:
+                logger.warning("Template generation for %s in %s failed: %s", ioc_type, table, e)
+                return self._fallback(ioc_type, table, columns)
+
+        plan = self._plan(indicators, tables)
+        with priority_class("batch"):
+            results = await asyncio.gather(*(one(*item) for item in plan))
+        return {(ioc_type, table): template for (ioc_type, table, _), template in zip(plan, results)}
+
+    # -- chunking ----------------------------------------------------------- #
+
+    @staticmethod
+    def render(template: str, values: Sequence[str]) -> str:
+        """The template preceded by `let indicators = dynamic([...]);` binding values."""
+        return f"let {PLACEHOLDER} = dynamic([{', '.join(json.dumps(value) for value in values)}]);\n{template}"
+
+    def chunks(self, template: str, values: Sequence[str]) -> List[List[str]]:
+        """values split into as few chunks as max_query_chars and max_values allow for the template."""
+        budget = self.max_query_chars - len(self.render(template, []))
+        chunks, chunk, size = [], [], 0
+        for value in values:
+            cost = len(json.dumps(value)) + (2 if chunk else 0)
+            if chunk and (size + cost > budget or len(chunk) >= self.max_values):
+                chunks.append(chunk)
+                chunk, size, cost = [], 0, cost - 2
+            if cost > budget:
+                raise ValueError(f"max_query_chars={self.max_query_chars} leaves no room for the indicator {value!r}.")
+            chunk.append(value)
+            size += cost
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _queries(self, indicators: IndicatorSet, templates: Dict[Tuple[str, str], str]) -> List[BulkQuery]:
+        queries = []
+        for (ioc_type, table), template in templates.items():
+            chunks = self.chunks(template, indicators.values(ioc_type))
+            for number, chunk in enumerate(chunks, 1):
+                queries.append(BulkQuery(ioc_type, table, number, len(chunks), len(chunk), self.render(template, chunk)))
+        return queries
+
+    def queries(self, indicators: IndicatorSet, request: str = "",
+                tables: Optional[Sequence[str]] = None) -> List[BulkQuery]:
+        """Every query needed to hunt all indicators, grouped by type and table."""
+        return self._queries(indicators, self.templates(indicators, request, tables))
+
+    async def aqueries(self, indicators: IndicatorSet, request: str = "",
+                       tables: Optional[Sequence[str]] = None) -> List[BulkQuery]:
+        """Async variant of queries()."""
+        return self._queries(indicators, await self.atemplates(indicators, request, tables))
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Write set-based KQL hunts for indicator feeds.")
+    parser.add_argument("paths", nargs="+", help="CSV, STIX JSON or text files of indicators.")
+    parser.add_argument("--request", default="", help="What to look for, in natural language.")
+    parser.add_argument("--format", choices=sorted(_READERS), help="Input format (default: from the extension).")
+    parser.add_argument("--tables", nargs="+", help="Only hunt in these tables.")
+    parser.add_argument("--lookback", default="30d")
+    parser.add_argument("--max-query-chars", type=int, default=DEFAULT_MAX_QUERY_CHARS)
+    parser.add_argument("--max-values", type=int, default=DEFAULT_MAX_VALUES)
+    parser.add_argument("--no-llm", action="store_true", help="Use the deterministic template for every table.")
+    parser.add_argument("--output", help="Write the queries here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    indicators = IndicatorSet()
+    for chunk in read_indicators(args.paths, fmt=args.format):
+        indicators.update(chunk)
+    logger.info("Read %d distinct indicators (%d duplicates, %d skipped): %s", indicators.added,
+                indicators.duplicates, indicators.skipped, indicators.counts())
+    hunter = BulkHunter(lookback=args.lookback, max_query_chars=args.max_query_chars,
+                        max_values=args.max_values, use_llm=not args.no_llm)
+    queries = hunter.queries(indicators, args.request, args.tables)
+    text = "\n\n".join(
+        f"// {q.indicators} {IOC_LABELS[q.ioc_type]} indicators in {q.table}, part {q.chunk}/{q.total}\n{q.kql_query}"
+        for q in queries
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    print(f"{len(queries)} queries for {indicators.added} indicators.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
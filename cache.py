@@ -0,0 +1,251 @@
+"""
+IoC-templated cache of validated NL -> KQL results.
+
+Queries that differ only in their indicators ("find activity for IP X") share
+one cache entry: IoCs are replaced by typed placeholders to build the key, the
+validated KQL is stored with the same placeholders, and a hit substitutes the
+new indicators back in without calling the graph (and therefore any LLM).
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .instrumentation import CACHE_LOOKUPS
+from .iocs import IoC, extract_iocs
+from .schemas import get_registry
+from .threat_intel_types import ThreatIntelState
+
+logger = logging.getLogger(__name__)
+
+_PLACEHOLDER = "{{{{IOC:{type}:{index}}}}}"
+_PLACEHOLDER_RE = re.compile(r"\{\{IOC:(\w+):(\d+)\}\}")
+
+
+def template_query(user_query: str) -> Tuple[str, List[IoC]]:
+    """
+    Replaces every IoC in user_query by a typed placeholder and normalizes
+    case and whitespace. Returns the template and the IoCs in slot order.
+    """
+    iocs = extract_iocs(user_query)
+    counters: Dict[str, int] = {}
+    slots: List[IoC] = []
+    parts: List[str] = []
+    last = 0
+    for ioc in sorted(iocs, key=lambda i: i.start):
+        index = counters.get(ioc.type, 0)
+        counters[ioc.type] = index + 1
+        slots.append(ioc)
+        parts.append(user_query[last:ioc.start].lower())
+        parts.append(_PLACEHOLDER.format(type=ioc.type, index=index))
+        last = ioc.end
+    parts.append(user_query[last:].lower())
+    template = " ".join("".join(parts).split())
+    return template, slots
+
+
+def _slot_names(slots: List[IoC]) -> List[str]:
+    counters: Dict[str, int] = {}
+    names = []
+    for ioc in slots:
+        index = counters.get(ioc.type, 0)
+        counters[ioc.type] = index + 1
+        names.append(_PLACEHOLDER.format(type=ioc.type, index=index))
+    return names
+
+
+def _to_template(text: str, slots: List[IoC]) -> str:
+    # Longest values first so an IoC that contains another is replaced whole.
+    for ioc, name in sorted(zip(slots, _slot_names(slots)), key=lambda pair: -len(pair[0].value)):
+        text = re.sub(re.escape(ioc.value), name, text, flags=re.IGNORECASE)
+    return text
+
+
+def _from_template(text: str, slots: List[IoC]) -> str:
+    values = dict(zip(_slot_names(slots), (ioc.value for ioc in slots)))
+    return _PLACEHOLDER_RE.sub(lambda m: values.get(m.group(0), m.group(0)), text)
+
+
+class QueryCache:
+    """
+    Bounded LRU cache with a TTL and an optional SQLite file behind it.
+
+    Only results with validation_status == "valid" whose KQL contains every
+    IoC of the user query are stored, so substituting new indicators always
+    yields a query that targets them.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 24 * 3600, path: Optional[str] = None,
+                 schema_version: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.schema_version = schema_version or get_registry().version
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS kql_cache (key TEXT PRIMARY KEY, created REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self._db.commit()
+
+    def _key(self, template: str) -> str:
+        return f"{self.schema_version}\x1f{template}"
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created > self.ttl_seconds
+
+    def _load(self, key: str) -> Optional[Tuple[float, dict]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT created, value FROM kql_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        entry = (row[0], json.loads(row[1]))
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key: str, entry: Tuple[float, dict]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM kql_cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def get(self, user_query: str) -> Optional[dict]:
+        """Returns the cached result fields for user_query with its own IoCs filled in, or None."""
+        template, slots = template_query(user_query)
+        key = self._key(template)
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None and self._expired(entry[0]):
+                self._forget(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        value = entry[1]
+        return {
+            "enriched_query": _from_template(value["enriched_query"], slots),
+            "shortlisted_tables": list(value["shortlisted_tables"]),
+            "iocs": [{"type": ioc.type, "value": ioc.value} for ioc in slots],
+            "kql_query": _from_template(value["kql_query"], slots),
+        }
+
+    def put(self, user_query: str, result: ThreatIntelState) -> bool:
+        """Stores a validated result. Returns False when it is not cacheable."""
+        kql_query = result.get("kql_query", "")
+        if result.get("validation_status") != "valid" or not kql_query:
+            return False
+        template, slots = template_query(user_query)
+        if any(ioc.value.lower() not in kql_query.lower() for ioc in slots):
+            return False
+        value = {
+            "enriched_query": _to_template(result.get("enriched_query", ""), slots),
+            "shortlisted_tables": list(result.get("shortlisted_tables", [])),
+            "kql_query": _to_template(kql_query, slots),
+        }
+        key = self._key(template)
+        entry = (time.time(), value)
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO kql_cache (key, created, value) VALUES (?, ?, ?)",
+                    (key, entry[0], json.dumps(value)),
+                )
+                self._db.commit()
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM kql_cache")
+                self._db.commit()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CachedGraph:
+    """
+    Wraps a compiled graph so cache hits return without running any node.
+
+    Only fresh, stateless hunts use the cache. Follow-up turns (marked by
+    follow_up_state()) depend on the previous turn's tables and IoCs, which
+    the key does not capture, and a
+    hit on a checkpointed graph would never reach the thread's checkpoint,
+    so runs with a thread_id or on a graph with a checkpointer bypass it.
+    """
+
+    def __init__(self, app, cache: QueryCache):
+        self.app = app
+        self.cache = cache
+
+    def _cacheable(self, state: Optional[ThreatIntelState], config) -> bool:
+        if state is None:
+            # Resuming a checkpointed thread; there is no new query to look up.
+            return False
+        if getattr(self.app, "checkpointer", None) is not None:
+            return False
+        if ((config or {}).get("configurable") or {}).get("thread_id") is not None:
+            return False
+        # A state carrying an earlier turn's enrichment is a follow-up even without the flag.
+        return not state.get("follow_up") and not state.get("enriched_query")
+
+    def _cached_result(self, state: ThreatIntelState) -> Optional[ThreatIntelState]:
+        cached = self.cache.get(state.get("user_query", ""))
+        CACHE_LOOKUPS.inc(result="miss" if cached is None else "hit")
+        if cached is None:
+            return None
+        logger.info("[Cache Hit] %s", cached["kql_query"])
+        result = dict(state)
+        result.update(cached)
+        result.update(validation_status="valid", validation_error="", retries=0, cache_hit=True)
+        return result
+
+    def invoke(self, state: Optional[ThreatIntelState], config=None, **kwargs) -> ThreatIntelState:
+        if not self._cacheable(state, config):
+            return self.app.invoke(state, config, **kwargs)
+        result = self._cached_result(state)
+        if result is not None:
+            return result
+        result = self.app.invoke(state, config, **kwargs)
+        self.cache.put(result.get("user_query", ""), result)
+        result["cache_hit"] = False
+        return result
+
+    async def ainvoke(self, state: Optional[ThreatIntelState], config=None, **kwargs) -> ThreatIntelState:
+        if not self._cacheable(state, config):
+            return await self.app.ainvoke(state, config, **kwargs)
+        result = self._cached_result(state)
+        if result is not None:
+            return result
+        result = await self.app.ainvoke(state, config, **kwargs)
+        self.cache.put(result.get("user_query", ""), result)
+        result["cache_hit"] = False
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
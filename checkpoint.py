@@ -0,0 +1,392 @@
+"""
+Durable, compact LangGraph checkpoints in a local SQLite file.
+
+build_graph(checkpointer=SQLiteCheckpointer("hunts.db")) saves the state
+after every node, keyed by thread id. A hunt that crashed or timed out is
+resumed from its last completed node by invoking the graph again with None
+as input and the same thread, so a failed reflection call restarts at
+kql_validator instead of re-running the enricher and generator:
+
+    app = build_graph(checkpointer=SQLiteCheckpointer("hunts.db"))
+    config = thread_config("analyst-42")
+    app.invoke(initial_state("Find activity for IP 203.0.113.7"), config)
+    app.invoke(follow_up_state("Only failed logins from it"), config)   # reuses the enrichment
+    app.invoke(None, config)                                             # resumes an interrupted run
+
+Checkpoints are stored incrementally, as LangGraph's in-memory saver does:
+each step writes only the channels it changed. Values are packed with
+MessagePack, chat messages as (type, content, id) without their provider
+metadata, and blobs above COMPRESS_MIN_BYTES are compressed with zstandard
+(pinned in requirements.txt), or with the standard library's zlib where
+zstandard is not installed; either kind is read back. Only the
+newest max_checkpoints per thread are kept. Write time and bytes per step
+are recorded in instrumentation.METRICS and returned by stats().
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import ormsgpack
+
+try:
+    import zstandard
+except ImportError:  # optional: fall back to zlib
+    zstandard = None
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    SerializerProtocol,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+from .instrumentation import METRICS
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_WRITE_SECONDS = METRICS.histogram(
+    "nl2kql_checkpoint_write_seconds", "Time to persist one checkpoint or one node's writes.", ["kind"]
+)
+CHECKPOINT_BYTES = METRICS.counter("nl2kql_checkpoint_bytes_total", "Serialized bytes written to the checkpoint store.", ["kind"])
+
+# Blobs at least this large are compressed.
+COMPRESS_MIN_BYTES = 512
+
+_EXT_MESSAGE = 64
+_EXT_FALLBACK = 65
+_MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, checkpoint_id TEXT NOT NULL,
+    parent_id TEXT, type TEXT NOT NULL, checkpoint BLOB NOT NULL, metadata_type TEXT NOT NULL,
+    metadata BLOB NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, channel TEXT NOT NULL, version TEXT NOT NULL,
+    type TEXT NOT NULL, blob BLOB NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL, checkpoint_ns TEXT NOT NULL, checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL, idx INTEGER NOT NULL, channel TEXT NOT NULL, type TEXT NOT NULL,
+    blob BLOB NOT NULL, task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+"""
+
+
+def thread_config(thread_id: str, checkpoint_ns: str = "") -> RunnableConfig:
+    """The invoke() config that selects a checkpointed thread."""
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}}
+
+
+class CompactSerializer(SerializerProtocol):
+    """
+    MessagePack serializer that stores chat messages as (type, content, id)
+    and compresses large values. Anything plain MessagePack cannot hold, and
+    messages with tool calls or extra fields, goes through LangGraph's
+    JsonPlusSerializer unchanged.
+    """
+
+    def __init__(self, compress_min_bytes: int = COMPRESS_MIN_BYTES):
+        self.compress_min_bytes = compress_min_bytes
+        self._fallback = JsonPlusSerializer()
+        self._zstd_local = threading.local()  # zstandard (de)compressors are not thread-safe
+
+    def _zstd(self) -> Tuple[Any, Any]:
+        if zstandard is None:
+            raise ImportError("Reading zstd-compressed checkpoints needs zstandard (pip install zstandard).")
+        codecs = getattr(self._zstd_local, "codecs", None)
+        if codecs is None:
+            codecs = self._zstd_local.codecs = (zstandard.ZstdCompressor(level=1), zstandard.ZstdDecompressor())
+        return codecs
+
+    def _default(self, obj: Any) -> ormsgpack.Ext:
+        if (isinstance(obj, BaseMessage) and obj.type in _MESSAGE_TYPES and not obj.additional_kwargs
+                and not getattr(obj, "tool_calls", None) and not obj.name):
+            return ormsgpack.Ext(_EXT_MESSAGE, ormsgpack.packb([obj.type, obj.content, obj.id]))
+        type_, data = self._fallback.dumps_typed(obj)
+        if type_ != "msgpack":
+            raise TypeError(f"Cannot serialize {type(obj).__name__} compactly.")
+        return ormsgpack.Ext(_EXT_FALLBACK, data)
+
+    def _ext_hook(self, code: int, data: bytes) -> Any:
+        if code == _EXT_MESSAGE:
+            type_, content, id_ = ormsgpack.unpackb(data)
+            return _MESSAGE_TYPES[type_](content=content, id=id_)
+        if code == _EXT_FALLBACK:
+            return self._fallback.loads_typed(("msgpack", data))
+        raise ValueError(f"Unknown extension type {code} in checkpoint.")
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        if obj is None or isinstance(obj, (bytes, bytearray)):
+            return self._fallback.dumps_typed(obj)
+        try:
+            data = ormsgpack.packb(obj, default=self._default, option=ormsgpack.OPT_NON_STR_KEYS
+                                   | ormsgpack.OPT_PASSTHROUGH_DATACLASS | ormsgpack.OPT_PASSTHROUGH_DATETIME
+                                   | ormsgpack.OPT_PASSTHROUGH_ENUM | ormsgpack.OPT_PASSTHROUGH_UUID)
+        except (TypeError, ormsgpack.MsgpackEncodeError):
+            return self._fallback.dumps_typed(obj)
+        if len(data) >= self.compress_min_bytes:
+            if zstandard is not None:
+                return "cmsgpack+zstd", self._zstd()[0].compress(data)
+            return "cmsgpack+zlib", zlib.compress(data, 1)
+        return "cmsgpack", data
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_ == "cmsgpack+zstd":
+            payload, type_ = self._zstd()[1].decompress(payload), "cmsgpack"
+        elif type_ == "cmsgpack+zlib":
+            payload, type_ = zlib.decompress(payload), "cmsgpack"
+        if type_ == "cmsgpack":
+            return ormsgpack.unpackb(payload, ext_hook=self._ext_hook, option=ormsgpack.OPT_NON_STR_KEYS)
+        return self._fallback.loads_typed(data)
+
+
+class SQLiteCheckpointer(BaseCheckpointSaver[int]):
+    """
+    LangGraph checkpoint saver backed by one SQLite file.
+
+    Attributes:
+        path (str): Database file; ":memory:" keeps checkpoints for the life of the process.
+        max_checkpoints (Optional[int]): Checkpoints kept per thread and namespace; None keeps all.
+    """
+
+    def __init__(self, path: str = ":memory:", max_checkpoints: Optional[int] = 20,
+                 serde: Optional[SerializerProtocol] = None):
+        super().__init__(serde=serde or CompactSerializer())
+        self.path = path
+        self.max_checkpoints = max_checkpoints
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # WAL with synchronous=NORMAL: one fsync per checkpoint instead of one per statement.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._stats = {"checkpoints": 0, "writes": 0, "bytes": 0, "seconds": 0.0}
+
+    # -- reading ------------------------------------------------------------ #
+
+    def _tuple(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str, parent_id: Optional[str],
+               type_: str, checkpoint_blob: bytes, metadata: CheckpointMetadata) -> CheckpointTuple:
+        checkpoint = self.serde.loads_typed((type_, checkpoint_blob))
+        values = {}
+        for channel, version in checkpoint["channel_versions"].items():
+            row = self._db.execute(
+                "SELECT type, blob FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, str(version)),
+            ).fetchone()
+            if row is not None and row[0] != "empty":
+                values[channel] = self.serde.loads_typed((row[0], row[1]))
+        writes = self._db.execute(
+            "SELECT task_id, channel, type, blob FROM writes WHERE thread_id = ? AND checkpoint_ns = ? "
+            "AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint={**checkpoint, "channel_values": values},
+            metadata=metadata,
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, blob))) for task_id, channel, t, blob in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+        query = ("SELECT checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                 "WHERE thread_id = ? AND checkpoint_ns = ?")
+        params: Tuple = (thread_id, checkpoint_ns)
+        if checkpoint_id:
+            query += " AND checkpoint_id = ?"
+            params += (checkpoint_id,)
+        else:
+            query += " ORDER BY checkpoint_id DESC LIMIT 1"
+        with self._lock:
+            row = self._db.execute(query, params).fetchone()
+            if row is None:
+                return None
+            metadata = self.serde.loads_typed((row[4], row[5]))
+            return self._tuple(thread_id, checkpoint_ns, *row[:4], metadata)
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = ("SELECT thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata "
+                 "FROM checkpoints")
+        clauses: List[str] = []
+        params: List[Any] = []
+        if config:
+            clauses.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if config["configurable"].get("checkpoint_ns") is not None:
+                clauses.append("checkpoint_ns = ?")
+                params.append(config["configurable"]["checkpoint_ns"])
+            if get_checkpoint_id(config):
+                clauses.append("checkpoint_id = ?")
+                params.append(get_checkpoint_id(config))
+        if before and get_checkpoint_id(before):
+            clauses.append("checkpoint_id < ?")
+            params.append(get_checkpoint_id(before))
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY checkpoint_id DESC"
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        for thread_id, checkpoint_ns, checkpoint_id, parent_id, type_, checkpoint, metadata_type, metadata_blob in rows:
+            if limit is not None and limit <= 0:
+                break
+            metadata = self.serde.loads_typed((metadata_type, metadata_blob))
+            if filter and not all(metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            with self._lock:
+                item = self._tuple(thread_id, checkpoint_ns, checkpoint_id, parent_id, type_, checkpoint, metadata)
+            yield item
+
+    # -- writing ------------------------------------------------------------ #
+
+    def _record(self, kind: str, start: float, size: int) -> None:
+        """Called with the lock held."""
+        elapsed = time.perf_counter() - start
+        CHECKPOINT_WRITE_SECONDS.observe(elapsed, kind=kind)
+        CHECKPOINT_BYTES.inc(size, kind=kind)
+        self._stats["checkpoints" if kind == "checkpoint" else "writes"] += 1
+        self._stats["bytes"] += size
+        self._stats["seconds"] += elapsed
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        start = time.perf_counter()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        stored = checkpoint.copy()
+        values = stored.pop("channel_values")
+        blobs = [
+            (thread_id, checkpoint_ns, channel, str(version),
+             *(self.serde.dumps_typed(values[channel]) if channel in values else ("empty", b"")))
+            for channel, version in new_versions.items()
+        ]
+        type_, checkpoint_blob = self.serde.dumps_typed(stored)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)", blobs)
+            self._db.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                 type_, checkpoint_blob, metadata_type, metadata_blob),
+            )
+            if self.max_checkpoints is not None:
+                self._prune(thread_id, checkpoint_ns)
+            self._db.commit()
+            self._record("checkpoint", start, len(checkpoint_blob) + len(metadata_blob) + sum(len(b[5]) for b in blobs))
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def _prune(self, thread_id: str, checkpoint_ns: str) -> None:
+        """Drops checkpoints beyond max_checkpoints, then blobs no kept checkpoint refers to."""
+        key = (thread_id, checkpoint_ns)
+        count = self._db.execute(
+            "SELECT COUNT(*) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?", key
+        ).fetchone()[0]
+        # Prune in batches so the blob scan below runs once per max_checkpoints // 2 steps.
+        if count <= self.max_checkpoints + max(self.max_checkpoints // 2, 1):
+            return
+        kept = self._db.execute(
+            "SELECT checkpoint_id, type, checkpoint FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT ?", key + (self.max_checkpoints,),
+        ).fetchall()
+        oldest = kept[-1][0]
+        self._db.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", key + (oldest,))
+        self._db.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", key + (oldest,))
+        referenced = set()
+        for _, type_, blob in kept:
+            referenced.update((channel, str(version)) for channel, version
+                              in self.serde.loads_typed((type_, blob))["channel_versions"].items())
+        stale = [
+            key + row for row in self._db.execute(
+                "SELECT channel, version FROM blobs WHERE thread_id = ? AND checkpoint_ns = ?", key
+            ).fetchall() if row not in referenced
+        ]
+        self._db.executemany(
+            "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?", stale
+        )
+        logger.debug("Pruned thread %s to %d checkpoints, dropping %d blobs.", thread_id, len(kept), len(stale))
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        start = time.perf_counter()
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, blob = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx),
+                         channel, type_, blob, task_path))
+        # Special channels (errors, interrupts) are overwritten; regular writes are kept from the first attempt.
+        verb = "INSERT OR REPLACE" if all(channel in WRITES_IDX_MAP for channel, _ in writes) else "INSERT OR IGNORE"
+        with self._lock:
+            self._db.executemany(f"{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+            self._record("writes", start, sum(len(row[7]) for row in rows))
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            for table in ("checkpoints", "blobs", "writes"):
+                self._db.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+            self._db.commit()
+
+    # -- async -------------------------------------------------------------- #
+    # SQLite calls take well under a millisecond here, so the async variants run inline.
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.get_tuple(config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.delete_thread(thread_id)
+
+    # -- bookkeeping -------------------------------------------------------- #
+
+    def stats(self) -> Dict[str, float]:
+        """Writes so far: checkpoints, node write batches, bytes, seconds and mean cost per write."""
+        stats = dict(self._stats)
+        count = stats["checkpoints"] + stats["writes"]
+        stats["mean_bytes"] = stats["bytes"] / count if count else 0.0
+        stats["mean_ms"] = 1000 * stats["seconds"] / count if count else 0.0
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -1,8 +1,31 @@
 import os
-from dotenv import load_dotenv
+from functools import lru_cache
+from typing import Optional
 
-load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    raise RuntimeError("Environment variable GOOGLE_API_KEY is missing.")
+@lru_cache(maxsize=None)
+def _load_dotenv() -> None:
+    # Deferred so importing the package neither imports dotenv nor reads .env.
+    from dotenv import load_dotenv
+    load_dotenv()
+
+
+def get_setting(name: str, default: Optional[str] = None) -> Optional[str]:
+    """An environment setting; .env is loaded on the first call."""
+    _load_dotenv()
+    return os.getenv(name, default)
+
+
+def require_google_api_key() -> str:
+    """The Gemini API key; raises only when a real client is actually built."""
+    key = get_setting("GOOGLE_API_KEY")
+    if not key:
+        raise RuntimeError("Environment variable GOOGLE_API_KEY is missing.")
+    return key
+
+
+def __getattr__(name: str):
+    # Backwards compatibility for `from .config import GOOGLE_API_KEY`.
+    if name == "GOOGLE_API_KEY":
+        return get_setting("GOOGLE_API_KEY")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
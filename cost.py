@@ -0,0 +1,479 @@
+"""
+Static cost estimates for KQL queries, from table statistics.
+
+CostModel walks the parsed query with the row counts, ingestion rates and
+column cardinalities of SchemaRegistry.stats() (NL2KQL_STATS_PATH) and
+estimates the bytes each table scan reads and the rows each join produces.
+QueryValidator uses it to send queries over a CostBudget back to reflection
+and to reject them once retries run out:
+
+    model = CostModel(CostBudget(max_scan_bytes=20e9, max_join_rows=5e7))
+    estimate, problem = model.check("ProcessEvents | join FileCreationEvents on hostname")
+
+The model is deliberately coarse (textbook selectivities, independent
+predicates, uniform key distributions). It is meant to tell a filtered,
+time-bounded lookup from an unbounded scan or cross-product, not to predict
+cluster time.
+"""
+
+import fnmatch
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from .instrumentation import METRICS
+from .kql_parser import (
+    Binary, Call, Count, Distinct, Expr, Extend, Index, Join, ListExpr, Literal, Member, Name, Pipeline, Project,
+    ProjectRename, Sort, SubQuery, Summarize, TableSource, Take, Unary, UnionOperator, UnionSource,
+    Where, parse_kql,
+)
+from .schemas import SchemaRegistry, get_registry
+
+logger = logging.getLogger(__name__)
+
+COST_CHECKS = METRICS.counter("nl2kql_cost_checks_total", "Cost estimates by verdict (within, over).", ["verdict"])
+
+# Fraction of a column read when it is only filtered with an operator Kusto answers from its term index.
+INDEX_SCAN_FACTOR = 0.1
+# Selectivity of predicates the model cannot size (substring and range filters, unknown functions).
+DEFAULT_SELECTIVITY = 0.1
+RANGE_SELECTIVITY = 1 / 3
+
+_INDEXED_OPERATORS = {"==", "=~", "has", "has_cs", "hasprefix", "hasprefix_cs", "in", "in~", "has_any", "has_all"}
+_EQUALITY_OPERATORS = {"==", "=~", "has", "has_cs"}
+_SET_OPERATORS = {"in", "in~", "has_any"}
+_TIMESPAN_UNITS_DAYS = {
+    "d": 1.0, "day": 1.0, "days": 1.0,
+    "h": 1 / 24, "hr": 1 / 24, "hrs": 1 / 24, "hour": 1 / 24, "hours": 1 / 24,
+    "m": 1 / 1440, "min": 1 / 1440, "minute": 1 / 1440, "minutes": 1 / 1440,
+    "s": 1 / 86400, "sec": 1 / 86400, "second": 1 / 86400, "seconds": 1 / 86400,
+    "ms": 1 / 86_400_000, "millisecond": 1 / 86_400_000, "milliseconds": 1 / 86_400_000,
+}
+_TIMESPAN = re.compile(r"^(\d+(?:\.\d+)?)([a-z]+)$")
+_SHAPING = (Project, Summarize, Count)
+
+
+def _timespan_days(expr: Expr) -> Optional[float]:
+    """Days in a timespan literal such as 7d or 36h; None for anything else."""
+    if not isinstance(expr, Literal) or expr.kind != "timespan":
+        return None
+    match = _TIMESPAN.match(expr.value.strip().lower())
+    if match is None or match.group(2) not in _TIMESPAN_UNITS_DAYS:
+        return None
+    return float(match.group(1)) * _TIMESPAN_UNITS_DAYS[match.group(2)]
+
+
+def _ago_days(expr: Expr) -> Optional[float]:
+    if isinstance(expr, Call) and expr.func == "ago" and len(expr.args) == 1:
+        return _timespan_days(expr.args[0])
+    return None
+
+
+def _names(expr: Any) -> Set[str]:
+    """Every bare name inside an expression (columns, and lets, which are ignored later)."""
+    if isinstance(expr, Name):
+        return {expr.name}
+    if isinstance(expr, Binary):
+        return _names(expr.left) | _names(expr.right)
+    if isinstance(expr, Unary):
+        return _names(expr.operand)
+    if isinstance(expr, Member):
+        return _names(expr.obj)
+    if isinstance(expr, Index):
+        return _names(expr.obj) | _names(expr.index)
+    children = expr.args if isinstance(expr, Call) else expr.items if isinstance(expr, ListExpr) else []
+    return set().union(*(_names(child) for child in children))
+
+
+def _conjuncts(expr: Expr) -> List[Expr]:
+    if isinstance(expr, Binary) and expr.op == "and":
+        return _conjuncts(expr.left) + _conjuncts(expr.right)
+    return [expr]
+
+
+def _format_bytes(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1000 or unit == "TB":
+            return f"{size:,.0f} {unit}" if unit == "B" else f"{size:,.1f} {unit}"
+        size /= 1000
+    return f"{size:,.1f} TB"
+
+
+@dataclass
+class CostBudget:
+    """
+    Limits a query must stay within.
+
+    Attributes:
+        max_scan_bytes (float): Bytes read from all table scans together.
+        max_join_rows (float): Rows produced by any single join.
+    """
+    max_scan_bytes: float = 50e9
+    max_join_rows: float = 1e8
+
+
+@dataclass
+class CostEstimate:
+    """
+    Estimated cost of one query.
+
+    Attributes:
+        scan_bytes (float): Bytes read by all table scans.
+        rows_scanned (float): Rows in the scanned time windows.
+        rows (float): Rows the query returns.
+        max_join_rows (float): Rows produced by the largest join.
+        tables (List[str]): Tables scanned, in order.
+        notes (List[str]): One line per scan and join, for logs and the reflection prompt.
+    """
+    scan_bytes: float = 0.0
+    rows_scanned: float = 0.0
+    rows: float = 0.0
+    max_join_rows: float = 0.0
+    tables: List[str] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "scan_bytes": self.scan_bytes, "rows_scanned": self.rows_scanned, "rows": self.rows,
+            "max_join_rows": self.max_join_rows, "tables": list(self.tables), "notes": list(self.notes),
+        }
+
+
+class _Relation:
+    """Estimated size of an intermediate result: rows, distinct values per column, and the tables it came from."""
+
+    __slots__ = ("rows", "distinct", "tables")
+
+    def __init__(self, rows: float, distinct: Dict[str, float], tables: List[str]):
+        self.rows = rows
+        self.distinct = distinct
+        self.tables = tables
+
+    def ndv(self, column: str) -> float:
+        return max(1.0, min(self.distinct.get(column, self.rows), self.rows))
+
+    def scaled(self, rows: float) -> "_Relation":
+        return _Relation(rows, {c: min(d, max(rows, 1.0)) for c, d in self.distinct.items()}, self.tables)
+
+
+class _Estimator:
+    def __init__(self, registry: SchemaRegistry, estimate: CostEstimate):
+        self.registry = registry
+        self.estimate = estimate
+        self.lets: Dict[str, Pipeline] = {}
+
+    def pipeline(self, pipeline: Pipeline) -> _Relation:
+        relation, time_filtered = self.source(pipeline)
+        for op in pipeline.operators:
+            relation = self.operator(op, relation, time_filtered)
+        return relation
+
+    # -- scans -------------------------------------------------------------- #
+
+    def source(self, pipeline: Pipeline) -> Tuple[_Relation, Set[str]]:
+        """The relation a pipeline starts from, and the columns whose time filters were applied to its scan."""
+        source = pipeline.source
+        if isinstance(source, UnionSource):
+            # Filters after a union are pushed into each leg's scan.
+            legs, time_filtered = [], set()
+            for leg in source.legs:
+                relation, columns = self.source(Pipeline(leg.source, leg.operators + pipeline.operators))
+                for op in leg.operators:
+                    relation = self.operator(op, relation, columns)
+                legs.append(relation)
+                time_filtered |= columns
+            return self.union(legs), time_filtered
+        if not isinstance(source, TableSource):
+            return _Relation(1.0, {}, []), set()
+        if source.name in self.lets:
+            return self.pipeline(self.lets[source.name]), set()
+        if "*" in source.name:
+            scans = [self.scan(t, pipeline) for t in self.registry if fnmatch.fnmatchcase(t, source.name)]
+            return self.union([relation for relation, _ in scans]), set().union(*(cols for _, cols in scans))
+        return self.scan(source.name, pipeline)
+
+    def scan(self, table: str, pipeline: Pipeline) -> Tuple[_Relation, Set[str]]:
+        """
+        Rows and bytes read from one table, given the filters and columns the
+        pipeline uses. Filters before the first join or aggregation prune the
+        scan: time filters to the ingestion window, term-index filters to the
+        matching rows, whose output columns are all that is decoded.
+        """
+        stats = self.registry.stats(table)
+        schema = dict(self.registry[table]) if table in self.registry else {}
+        datetime_columns = {c for c, t in schema.items() if t == "datetime"}
+        base = _Relation(float(stats.rows), {c: float(stats.distinct(c)) for c in schema}, [table])
+
+        days, time_columns, indexed, filtered = None, set(), set(), set()
+        index_selectivity = 1.0
+        for op in pipeline.operators:
+            if isinstance(op, (Join, Summarize, UnionOperator)):
+                break
+            if not isinstance(op, Where):
+                continue
+            for term in _conjuncts(op.predicate):
+                window = self._time_window(term, datetime_columns)
+                if window is not None:
+                    days = window[1] if days is None else min(days, window[1])
+                    time_columns.add(window[0])
+                elif self._indexed(term):
+                    indexed.add(term.left.name)
+                    index_selectivity *= self.selectivity(term, base)
+                else:
+                    filtered |= _names(term)
+        rows = base.rows if days is None else min(base.rows, stats.rows_per_day * days)
+
+        shaped = any(isinstance(op, _SHAPING) for op in pipeline.operators)
+        output = (self._referenced(pipeline) if shaped else set(schema)) - filtered
+        scan_bytes = 0.0
+        for column in (filtered | indexed | time_columns | output) & set(schema):
+            if column in filtered:
+                share = 1.0
+            elif column in indexed or column in time_columns:
+                share = max(INDEX_SCAN_FACTOR, index_selectivity if column in output else 0.0)
+            else:
+                share = index_selectivity
+            scan_bytes += rows * stats.column_bytes(column) * share
+
+        self.estimate.scan_bytes += scan_bytes
+        self.estimate.rows_scanned += rows
+        self.estimate.tables.append(table)
+        window = ("no time filter" if days is None else f"last {days:g}d" if days >= 1 else f"last {days * 24:.3g}h")
+        self.estimate.notes.append(f"scan {table}: ~{rows:,.0f} rows ({window}), ~{_format_bytes(scan_bytes)}")
+        return base.scaled(rows), time_columns
+
+    @staticmethod
+    def _time_window(term: Expr, datetime_columns: Set[str]) -> Optional[Tuple[str, float]]:
+        """(column, days) for `col > ago(Nd)`, `col >= ago(Nd)` and `col between (ago(Nd) .. ...)`."""
+        if not isinstance(term, Binary) or not isinstance(term.left, Name) or term.left.name not in datetime_columns:
+            return None
+        if term.op in (">", ">="):
+            days = _ago_days(term.right)
+        elif term.op == "between" and isinstance(term.right, ListExpr) and term.right.items:
+            days = _ago_days(term.right.items[0])
+        else:
+            days = None
+        return (term.left.name, days) if days is not None else None
+
+    def _indexed(self, term: Expr) -> bool:
+        """True for `column <op> constants` filters Kusto answers from its term index."""
+        return (isinstance(term, Binary) and term.op in _INDEXED_OPERATORS and isinstance(term.left, Name)
+                and not _names(term.right) - set(self.lets))
+
+    @staticmethod
+    def _referenced(pipeline: Pipeline) -> Set[str]:
+        """Columns the pipeline's operators read, other than in where filters."""
+        columns: Set[str] = set()
+        for op in pipeline.operators:
+            if isinstance(op, (Project, Extend)):
+                for item in op.items:
+                    columns |= _names(item.expr)
+            elif isinstance(op, Summarize):
+                for item in op.aggregates + op.by:
+                    columns |= _names(item.expr)
+            elif isinstance(op, Sort):
+                for key in op.by:
+                    columns |= _names(key)
+            elif isinstance(op, Distinct):
+                for column in op.columns:
+                    columns |= _names(column)
+            elif isinstance(op, ProjectRename):
+                columns |= {old.name for _, old in op.items}
+            elif isinstance(op, Join):
+                columns |= {key.left.name for key in op.on}
+        return columns
+
+    # -- operators ---------------------------------------------------------- #
+
+    def operator(self, op, relation: _Relation, time_filtered: Set[str]) -> _Relation:
+        if isinstance(op, Where):
+            selectivity = 1.0
+            for term in _conjuncts(op.predicate):
+                if isinstance(term, Binary) and isinstance(term.left, Name) and term.left.name in time_filtered:
+                    continue  # already applied to the scan
+                selectivity *= self.selectivity(term, relation)
+            return relation.scaled(relation.rows * selectivity)
+        if isinstance(op, (Project, Extend)):
+            distinct = {} if isinstance(op, Project) else dict(relation.distinct)
+            for item in op.items:
+                if item.alias and "," in item.alias:
+                    continue
+                name = item.alias or (item.expr.name if isinstance(item.expr, Name) else None)
+                if name:
+                    source = item.expr.name if isinstance(item.expr, Name) else None
+                    distinct[name] = relation.ndv(source) if source else relation.rows
+            return _Relation(relation.rows, distinct, relation.tables)
+        if isinstance(op, Summarize):
+            groups, distinct = 1.0, {}
+            for item in op.by:
+                expr = item.expr
+                if isinstance(expr, Call) and expr.func in ("bin", "floor") and len(expr.args) == 2:
+                    column = expr.args[0].name if isinstance(expr.args[0], Name) else None
+                    span = _timespan_days(expr.args[1])
+                    ndv = relation.rows if span is None else min(relation.rows, 30.0 / max(span, 1e-9))
+                else:
+                    column = expr.name if isinstance(expr, Name) else None
+                    ndv = relation.ndv(column) if column else relation.rows
+                groups *= ndv
+                distinct[item.alias or column or f"Column{len(distinct) + 1}"] = ndv
+            rows = min(relation.rows, groups) if op.by else 1.0
+            return _Relation(rows, distinct, relation.tables)
+        if isinstance(op, Join):
+            return self.join(op, relation)
+        if isinstance(op, UnionOperator):
+            return self.union([relation] + [self.pipeline(leg) for leg in op.legs])
+        if isinstance(op, (Take, Sort)):
+            count = op.count
+            if isinstance(count, Literal) and count.kind == "number":
+                return relation.scaled(min(relation.rows, float(count.value)))
+            return relation
+        if isinstance(op, Distinct):
+            columns = [c.name for c in op.columns if isinstance(c, Name)] or list(relation.distinct)
+            groups = 1.0
+            for column in columns:
+                groups *= relation.ndv(column)
+            return relation.scaled(min(relation.rows, groups))
+        if isinstance(op, Count):
+            return _Relation(1.0, {"Count": 1.0}, relation.tables)
+        if isinstance(op, ProjectRename):
+            distinct = dict(relation.distinct)
+            for new, old in op.items:
+                distinct[new.name] = distinct.pop(old.name, relation.rows)
+            return _Relation(relation.rows, distinct, relation.tables)
+        # project-away/keep, mv-expand and anything else: row count unchanged.
+        return relation
+
+    def selectivity(self, term: Expr, relation: _Relation) -> float:
+        if isinstance(term, Binary) and term.op == "and":
+            return self.selectivity(term.left, relation) * self.selectivity(term.right, relation)
+        if isinstance(term, Binary) and term.op == "or":
+            a, b = self.selectivity(term.left, relation), self.selectivity(term.right, relation)
+            return min(1.0, a + b - a * b)
+        if isinstance(term, Unary) and term.op == "!" or isinstance(term, Call) and term.func == "not" and term.args:
+            inner = term.operand if isinstance(term, Unary) else term.args[0]
+            return 1.0 - self.selectivity(inner, relation)
+        if isinstance(term, Call):
+            return {"isempty": 0.1, "isnull": 0.1, "isnotempty": 0.9, "isnotnull": 0.9}.get(term.func, DEFAULT_SELECTIVITY)
+        if not isinstance(term, Binary):
+            return DEFAULT_SELECTIVITY
+        op = term.op
+        negated = op.startswith("!") and op not in ("!=",)
+        if op in ("!=", "<>", "!~"):
+            negated, op = True, "=="
+        base = op.lstrip("!")
+        column = term.left.name if isinstance(term.left, Name) else None
+        if base in _EQUALITY_OPERATORS and column:
+            selectivity = 1.0 / relation.ndv(column)
+        elif base in _SET_OPERATORS and column:
+            selectivity = min(1.0, self.set_size(term.right) / relation.ndv(column))
+        elif base in ("<", ">", "<=", ">=", "between"):
+            selectivity = RANGE_SELECTIVITY
+        else:
+            selectivity = DEFAULT_SELECTIVITY
+        return 1.0 - selectivity if negated else selectivity
+
+    def set_size(self, expr: Expr) -> float:
+        """Values in an in()/has_any() list; a subquery or tabular let counts its estimated rows."""
+        items = expr.items if isinstance(expr, ListExpr) else [expr]
+        size = 0.0
+        for item in items:
+            if isinstance(item, SubQuery):
+                size += self.pipeline(item.pipeline).rows
+            elif isinstance(item, Name) and item.name in self.lets:
+                size += self.pipeline(self.lets[item.name]).rows
+            elif isinstance(item, Call) and item.func == "dynamic":
+                size += sum(len(arg.items) if isinstance(arg, ListExpr) else 1 for arg in item.args)
+            else:
+                size += 1.0
+        return size
+
+    def join(self, op: Join, left: _Relation) -> _Relation:
+        right = self.pipeline(op.right)
+        left_ndv = right_ndv = 1.0
+        for key in op.on:
+            left_ndv *= left.ndv(key.left.name)
+            right_ndv *= right.ndv(key.right.name)
+        left_ndv, right_ndv = min(left_ndv, left.rows), min(right_ndv, right.rows)
+        kind = op.kind
+        if not op.on:
+            rows = left.rows * right.rows
+        elif kind in ("leftsemi",):
+            rows = left.rows * min(1.0, right_ndv / max(left_ndv, 1.0))
+        elif kind in ("leftanti", "leftantisemi"):
+            rows = left.rows * max(0.0, 1.0 - min(1.0, right_ndv / max(left_ndv, 1.0)))
+        elif kind in ("rightsemi",):
+            rows = right.rows * min(1.0, left_ndv / max(right_ndv, 1.0))
+        elif kind in ("rightanti", "rightantisemi"):
+            rows = right.rows * max(0.0, 1.0 - min(1.0, left_ndv / max(right_ndv, 1.0)))
+        elif kind == "innerunique":
+            # The left side is deduplicated on the key first.
+            rows = right.rows * min(1.0, left_ndv / max(right_ndv, 1.0))
+        else:
+            rows = left.rows * right.rows / max(left_ndv, right_ndv, 1.0)
+            if kind in ("leftouter", "fullouter"):
+                rows = max(rows, left.rows)
+            if kind in ("rightouter", "fullouter"):
+                rows = max(rows, right.rows)
+        if op.token.value == "lookup":
+            rows = left.rows
+        keys = ", ".join(key.left.name if key.left.name == key.right.name else f"{key.left.name}={key.right.name}"
+                         for key in op.on) or "nothing"
+        self.estimate.notes.append(
+            f"join kind={kind} {'+'.join(left.tables) or '?'} x {'+'.join(right.tables) or '?'} on {keys}: ~{rows:,.0f} rows"
+        )
+        self.estimate.max_join_rows = max(self.estimate.max_join_rows, rows)
+        distinct = dict(right.distinct)
+        distinct.update(left.distinct)
+        return _Relation(rows, distinct, left.tables + right.tables).scaled(rows)
+
+    def union(self, relations: List[_Relation]) -> _Relation:
+        rows = sum(r.rows for r in relations)
+        distinct: Dict[str, float] = {}
+        for relation in relations:
+            for column, ndv in relation.distinct.items():
+                distinct[column] = distinct.get(column, 0.0) + ndv
+        return _Relation(rows, distinct, [t for r in relations for t in r.tables])
+
+
+class CostModel:
+    """
+    Estimates query cost from table statistics and checks it against a budget.
+
+    Attributes:
+        budget (CostBudget): Limits for check().
+        registry (SchemaRegistry): Source of schemas and statistics; the process-wide registry by default.
+    """
+
+    def __init__(self, budget: Optional[CostBudget] = None, registry: Optional[SchemaRegistry] = None):
+        self.budget = budget or CostBudget()
+        self.registry = registry or get_registry()
+
+    def estimate(self, kql_query: str) -> CostEstimate:
+        """Estimated scan bytes, rows and join sizes of a query; raises KQLError if it does not parse."""
+        ast = parse_kql(kql_query)
+        estimate = CostEstimate()
+        estimator = _Estimator(self.registry, estimate)
+        for let in ast.lets:
+            if isinstance(let.value, Pipeline):
+                estimator.lets[let.name] = let.value
+        if ast.body is not None:
+            estimate.rows = estimator.pipeline(ast.body).rows
+        return estimate
+
+    def check(self, kql_query: str) -> Tuple[CostEstimate, Optional[str]]:
+        """The estimate and, when it is over budget, the reason for the reflection prompt."""
+        estimate = self.estimate(kql_query)
+        problems = []
+        if estimate.scan_bytes > self.budget.max_scan_bytes:
+            problems.append(f"scans ~{_format_bytes(estimate.scan_bytes)} (budget {_format_bytes(self.budget.max_scan_bytes)})")
+        if estimate.max_join_rows > self.budget.max_join_rows:
+            problems.append(f"a join produces ~{estimate.max_join_rows:,.0f} rows (budget {self.budget.max_join_rows:,.0f})")
+        COST_CHECKS.inc(verdict="over" if problems else "within")
+        if not problems:
+            return estimate, None
+        return estimate, (
+            f"The query is too expensive to run: it {' and '.join(problems)}. Estimate: {'; '.join(estimate.notes)}. "
+            "Add a time filter such as `where <datetime column> > ago(1d)` on every table, filter before joining, "
+            "join on selective keys, and project only the columns you need."
+        )
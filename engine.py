@@ -0,0 +1,974 @@
+"""
+In-memory execution of a KQL subset over columnar sample data.
+
+A query that validates can still return nothing, or blow up in a join, and
+today we only learn that from the production cluster. ExecutionEngine runs
+the parsed query (where, project, extend, summarize, join, union, take, top,
+distinct, count, in/has/contains and friends) over small per-table samples
+held as NumPy arrays, so QueryValidator can dry-run a candidate in a few
+milliseconds and send empty or exploding results to reflection.
+
+Sample data comes from one file per table, <Table>.csv or <Table>.parquet
+(Parquet needs pyarrow), typed by the schema registry:
+
+    data = SampleData.from_directory("samples/")
+    engine = ExecutionEngine(data)
+    engine.dry_run('AuthenticationEvents | where result == "Failed" | count')
+
+SampleData.synthetic() builds seeded data from the schemas alone, for tests
+and for trying the engine without exported samples. ago() and now() are
+anchored at the newest timestamp in the sample, so time windows keep
+matching a sample exported last month. sort and top order rows by their
+keys, direction and null placement; other operators keep their input order.
+"""
+
+import csv
+import fnmatch
+import os
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from .instrumentation import METRICS
+from .iocs import COLUMN_KIND_PATTERNS
+from .kql_parser import (
+    Binary, Call, Count, DatatableSource, Distinct, Expr, Extend, Join, KQLError, ListExpr, Literal, Name,
+    Pipeline, Project, ProjectNames, ProjectRename, Sort, Star, SubQuery, Summarize, TableSource, Take,
+    UnionOperator, UnionSource, Unary, Where, parse_kql,
+)
+from .schemas import get_registry
+
+DRY_RUNS = METRICS.counter("nl2kql_dry_runs_total", "Dry runs on sample data by verdict.", ["verdict"])
+DRY_RUN_SECONDS = METRICS.histogram("nl2kql_dry_run_seconds", "Time to execute a query on sample data.")
+
+# Joins larger than this are not materialized; the dry run reports the row count.
+MAX_MATERIALIZED_ROWS = 2_000_000
+
+_NUMERIC_TYPES = {"int", "long", "real", "double", "decimal"}
+_TIMESPAN_UNITS_US = {
+    "d": 86_400e6, "day": 86_400e6, "days": 86_400e6,
+    "h": 3_600e6, "hr": 3_600e6, "hrs": 3_600e6, "hour": 3_600e6, "hours": 3_600e6,
+    "m": 60e6, "min": 60e6, "minute": 60e6, "minutes": 60e6,
+    "s": 1e6, "sec": 1e6, "second": 1e6, "seconds": 1e6,
+    "ms": 1e3, "milli": 1e3, "millis": 1e3, "millisecond": 1e3, "milliseconds": 1e3,
+    "microsecond": 1.0, "microseconds": 1.0, "tick": 0.1, "ticks": 0.1,
+}
+_TIMESPAN = re.compile(r"^(\d+(?:\.\d+)?)([a-z]+)$")
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "\\": "\\", '"': '"', "'": "'"}
+
+
+class EngineError(Exception):
+    """A query cannot be executed on the sample data."""
+
+
+class UnsupportedQuery(EngineError):
+    """The query uses KQL outside the subset the engine executes."""
+
+
+class CardinalityExceeded(EngineError):
+    """An intermediate result would be larger than MAX_MATERIALIZED_ROWS."""
+
+    def __init__(self, rows: int):
+        super().__init__(f"An intermediate result would have {rows} rows.")
+        self.rows = rows
+
+
+# --------------------------------------------------------------------------- #
+# Sample data
+# --------------------------------------------------------------------------- #
+
+def _null_like(values: np.ndarray, n: int) -> np.ndarray:
+    """n nulls of the same kind as values ("" for strings)."""
+    kind = values.dtype.kind
+    if kind == "U":
+        return np.full(n, "", dtype=values.dtype)
+    if kind in "Mm":
+        return np.full(n, np.datetime64("NaT") if kind == "M" else np.timedelta64("NaT"), dtype=values.dtype)
+    if kind == "b":
+        return np.zeros(n, dtype=bool)
+    if kind == "f":
+        return np.full(n, np.nan)
+    return np.full(n, None, dtype=object)
+
+
+def _parse_datetime(text: str) -> np.datetime64:
+    text = text.strip().strip("'\"").replace(" ", "T").rstrip("Z")
+    if not text:
+        return np.datetime64("NaT", "us")
+    try:
+        return np.datetime64(text, "us")
+    except ValueError:
+        return np.datetime64("NaT", "us")
+
+
+def _parse_timespan(text: str) -> np.timedelta64:
+    match = _TIMESPAN.match(text.strip().lower())
+    if match is None or match.group(2) not in _TIMESPAN_UNITS_US:
+        raise UnsupportedQuery(f"Cannot read the timespan '{text}'.")
+    return np.timedelta64(int(float(match.group(1)) * _TIMESPAN_UNITS_US[match.group(2)]), "us")
+
+
+def _column_array(values: Sequence[Any], col_type: str) -> np.ndarray:
+    """Converts raw values (CSV text or Parquet values) to the array type used for a KQL column type."""
+    if col_type == "datetime":
+        return np.array([v if isinstance(v, np.datetime64) else _parse_datetime(str(v or "")) for v in values],
+                        dtype="datetime64[us]")
+    if col_type in _NUMERIC_TYPES:
+        out = np.full(len(values), np.nan)
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except (TypeError, ValueError):
+                pass
+        return out
+    if col_type == "bool":
+        return np.array([str(v).strip().lower() in ("true", "1") for v in values], dtype=bool)
+    if col_type == "timespan":
+        return np.array([_parse_timespan(str(v)) if v else np.timedelta64("NaT") for v in values],
+                        dtype="timedelta64[us]")
+    return np.array(["" if v is None else str(v) for v in values], dtype=str)
+
+
+def _column_bytes(values: np.ndarray) -> int:
+    """Approximate stored size: UTF-8 length for strings, the item size otherwise."""
+    if values.dtype.kind == "U":
+        return int(np.strings.str_len(values).sum())
+    return int(values.size * values.dtype.itemsize)
+
+
+class SampleTable:
+    """One table's sample as column name -> array, all of the same length."""
+
+    def __init__(self, name: str, columns: Dict[str, np.ndarray]):
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns of {name} have different lengths: {sorted(lengths)}.")
+        self.name = name
+        self.columns = columns
+        self.rows = lengths.pop() if lengths else 0
+        self.column_bytes = {column: _column_bytes(values) for column, values in columns.items()}
+
+    @classmethod
+    def from_records(cls, name: str, records: Iterable[Mapping[str, Any]],
+                     schema: Sequence[Tuple[str, str]]) -> "SampleTable":
+        rows = list(records)
+        columns = {}
+        for column, col_type in _unique_schema(schema):
+            columns[column] = _column_array([row.get(column) for row in rows], col_type)
+        return cls(name, columns)
+
+
+def _unique_schema(schema: Sequence[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    seen: Dict[str, str] = {}
+    for column, col_type in schema:
+        seen.setdefault(column, col_type)
+    return list(seen.items())
+
+
+class SampleData(Mapping):
+    """Read-only mapping of table name -> SampleTable."""
+
+    def __init__(self, tables: Mapping[str, SampleTable]):
+        self._tables = dict(tables)
+
+    def __getitem__(self, table: str) -> SampleTable:
+        return self._tables[table]
+
+    def __iter__(self):
+        return iter(self._tables)
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    @classmethod
+    def from_directory(cls, path: str, schemas: Optional[Mapping[str, Sequence[Tuple[str, str]]]] = None) -> "SampleData":
+        """Loads <Table>.parquet or <Table>.csv for each table in the schemas; tables without a file are skipped."""
+        schemas = get_registry() if schemas is None else schemas
+        tables = {}
+        for table, schema in schemas.items():
+            parquet = os.path.join(path, f"{table}.parquet")
+            csv_path = os.path.join(path, f"{table}.csv")
+            if os.path.exists(parquet):
+                tables[table] = _read_parquet(table, parquet, schema)
+            elif os.path.exists(csv_path):
+                with open(csv_path, newline="", encoding="utf-8") as f:
+                    tables[table] = SampleTable.from_records(table, csv.DictReader(f), schema)
+        if not tables:
+            raise FileNotFoundError(f"No <Table>.csv or <Table>.parquet sample files found in {path}.")
+        return cls(tables)
+
+    @classmethod
+    def synthetic(cls, schemas: Optional[Mapping[str, Sequence[Tuple[str, str]]]] = None, rows: int = 1000,
+                  seed: int = 0, end: str = "2024-06-01T00:00:00", days: int = 30) -> "SampleData":
+        """
+        Seeded stand-in data: skewed draws from small per-column value pools
+        (shared by same-named columns, so joins match) and timestamps spread
+        over the `days` before `end`.
+        """
+        schemas = get_registry() if schemas is None else schemas
+        end_us = np.datetime64(end, "us")
+        tables = {}
+        for table, schema in schemas.items():
+            rng = np.random.default_rng([seed, sum(map(ord, table))])
+            columns = {}
+            for column, col_type in _unique_schema(schema):
+                columns[column] = _synthetic_column(column, col_type, rows, rng, seed, end_us, days)
+            tables[table] = SampleTable(table, columns)
+        return cls(tables)
+
+
+def _read_parquet(table: str, path: str, schema: Sequence[Tuple[str, str]]) -> SampleTable:
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(f"Reading {path} needs pyarrow (pip install pyarrow).") from e
+    data = pq.read_table(path)
+    columns = {}
+    for column, col_type in _unique_schema(schema):
+        if column in data.column_names:
+            values = data.column(column).to_numpy(zero_copy_only=False)
+            if col_type == "datetime" and values.dtype.kind == "M":
+                columns[column] = values.astype("datetime64[us]")
+                continue
+            values = values.tolist()
+        else:
+            values = [None] * data.num_rows
+        columns[column] = _column_array(values, col_type)
+    return SampleTable(table, columns)
+
+
+def _value_pool(column: str, kind: Optional[str], seed: int) -> List[str]:
+    rng = random.Random(f"{seed}:{kind or column}")
+    words = ["alpha", "bravo", "delta", "echo", "kilo", "lima", "oscar", "sierra", "tango", "zulu"]
+    domains = [f"{rng.choice(words)}{i}.{rng.choice(['com', 'net', 'org', 'io'])}" for i in range(40)]
+    if kind == "ip":
+        return [f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}" for _ in range(50)]
+    if kind == "domain":
+        return domains
+    if kind == "url":
+        return [f"https://{rng.choice(domains)}/{rng.choice(words)}/{i}" for i in range(60)]
+    if kind == "email":
+        return [f"{rng.choice(words)}.{i}@{rng.choice(domains[:8])}" for i in range(40)]
+    if kind == "hash":
+        length = 64 if "256" in column else 40 if "sha1" in column.lower() else 32
+        return ["".join(rng.choice("0123456789abcdef") for _ in range(length)) for _ in range(60)]
+    return [f"{column}_{i}" for i in range(25)]
+
+
+def _synthetic_column(column: str, col_type: str, rows: int, rng: np.random.Generator, seed: int,
+                      end: np.datetime64, days: int) -> np.ndarray:
+    if col_type == "datetime":
+        return end - rng.integers(0, days * 86_400_000_000, rows).astype("timedelta64[us]")
+    if col_type in _NUMERIC_TYPES:
+        return np.round(rng.exponential(1000.0, rows))
+    if col_type == "bool":
+        return rng.random(rows) < 0.5
+    kind = next((k for k, pattern in COLUMN_KIND_PATTERNS.items() if pattern.search(column)), None)
+    pool = np.array(_value_pool(column, kind, seed))
+    picks = np.minimum(rng.zipf(1.6, rows) - 1, len(pool) - 1)
+    return pool[picks]
+
+
+# --------------------------------------------------------------------------- #
+# Execution
+# --------------------------------------------------------------------------- #
+
+class Frame:
+    """An intermediate or final result: column name -> array, plus where each column was read from."""
+
+    __slots__ = ("columns", "rows", "origin")
+
+    def __init__(self, columns: Dict[str, np.ndarray], rows: int, origin: Optional[Dict[str, Tuple[str, str]]] = None):
+        self.columns = columns
+        self.rows = rows
+        self.origin = origin or {}
+
+    def select(self, index) -> "Frame":
+        """Rows picked by a boolean mask or an integer index array."""
+        index = np.asarray(index)
+        rows = int(np.count_nonzero(index)) if index.dtype == bool else len(index)
+        return Frame({name: values[index] for name, values in self.columns.items()}, rows, dict(self.origin))
+
+
+def _unescape(text: str) -> str:
+    return re.sub(r"\\(.)", lambda m: _ESCAPES.get(m.group(1), m.group(1)), text)
+
+
+def _is_array(value: Any) -> bool:
+    return isinstance(value, np.ndarray)
+
+
+def _full(value: Any, rows: int) -> np.ndarray:
+    if _is_array(value):
+        return value
+    if isinstance(value, (list, dict)) or value is None:
+        out = np.empty(rows, dtype=object)
+        out[:] = [value] * rows
+        return out
+    return np.full(rows, value)
+
+
+def _text(value: Any):
+    if _is_array(value):
+        return value if value.dtype.kind == "U" else value.astype(str)
+    return "" if value is None else str(value)
+
+
+def _per_value(values: Any, fn: Callable[[str], bool]):
+    """Applies a string predicate once per distinct value and broadcasts the result."""
+    values = _text(values)
+    if not _is_array(values):
+        return fn(values)
+    distinct, inverse = np.unique(values, return_inverse=True)
+    hits = np.fromiter((fn(v) for v in distinct.tolist()), dtype=bool, count=len(distinct))
+    return hits[inverse.ravel()]
+
+
+def _term_pattern(needle: str, case_sensitive: bool, left: bool = True, right: bool = True) -> "re.Pattern[str]":
+    """Kusto term semantics: the needle must start and end on term boundaries (runs of letters and digits)."""
+    prefix = r"(?<![0-9A-Za-z])" if left and needle[:1].isalnum() else ""
+    suffix = r"(?![0-9A-Za-z])" if right and needle[-1:].isalnum() else ""
+    return re.compile(prefix + re.escape(needle) + suffix, 0 if case_sensitive else re.IGNORECASE)
+
+
+def _isnull(values: Any):
+    if not _is_array(values):
+        return values is None or (isinstance(values, float) and np.isnan(values))
+    kind = values.dtype.kind
+    if kind in "Mm":
+        return np.isnat(values)
+    if kind == "f":
+        return np.isnan(values)
+    if kind == "O":
+        return np.array([v is None for v in values], dtype=bool)
+    return np.zeros(len(values), dtype=bool)
+
+
+def _isempty(values: Any):
+    if _is_array(values) and values.dtype.kind == "U":
+        return values == ""
+    if isinstance(values, str):
+        return values == ""
+    return _isnull(values)
+
+
+def _codes(values: np.ndarray) -> np.ndarray:
+    return np.unique(values, return_inverse=True)[1].ravel()
+
+
+def _shared_codes(left: Sequence[np.ndarray], right: Sequence[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Integer codes for the key tuples of both sides; equal tuples get equal codes."""
+    n_left = len(left[0]) if left else 0
+    per_key = []
+    for lv, rv in zip(left, right):
+        if lv.dtype.kind != rv.dtype.kind:
+            lv, rv = lv.astype(str), rv.astype(str)
+        per_key.append(_codes(np.concatenate([lv, rv])))
+    if len(per_key) == 1:
+        codes = per_key[0]
+    else:
+        codes = np.unique(np.stack(per_key, axis=1), axis=0, return_inverse=True)[1].ravel()
+    return codes[:n_left], codes[n_left:]
+
+
+_COMPARISONS = {
+    "==": np.equal, "!=": np.not_equal, "<>": np.not_equal,
+    "<": np.less, ">": np.greater, "<=": np.less_equal, ">=": np.greater_equal,
+}
+_ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide, "%": np.mod}
+
+
+class _Run:
+    """State of one query execution: let bindings and what was scanned."""
+
+    def __init__(self, engine: "ExecutionEngine"):
+        self.engine = engine
+        self.text = ""
+        self.tables: Dict[str, Frame] = {}
+        self.scalars: Dict[str, Any] = {}
+        self.reads: Set[Tuple[str, str]] = set()
+        self.rows_scanned = 0
+        self.tables_scanned: List[str] = []
+
+    # -- statements and pipelines ------------------------------------------- #
+
+    def query(self, kql_query: str) -> Frame:
+        self.text = kql_query
+        ast = parse_kql(kql_query)
+        for let in ast.lets:
+            if isinstance(let.value, Pipeline):
+                self.tables[let.name] = self.pipeline(let.value)
+            elif isinstance(let.value, Expr):
+                self.scalars[let.name] = self.expr(let.value, Frame({}, 1))
+            else:
+                raise UnsupportedQuery(f"let {let.name} defines a function or view.")
+        if ast.body is None:
+            raise UnsupportedQuery("The query has no tabular expression.")
+        frame = self.pipeline(ast.body)
+        self.read_all(frame)
+        return frame
+
+    def read_all(self, frame: Frame) -> None:
+        self.reads.update(frame.origin[column] for column in frame.columns if column in frame.origin)
+
+    def pipeline(self, pipeline: Pipeline) -> Frame:
+        frame = self.source(pipeline.source)
+        for op in pipeline.operators:
+            frame = self.operator(op, frame)
+            if frame.rows > MAX_MATERIALIZED_ROWS:
+                raise CardinalityExceeded(frame.rows)
+        return frame
+
+    def table(self, name: str) -> Frame:
+        if name in self.tables:
+            return self.tables[name]
+        data = self.engine.data
+        if "*" in name:
+            matches = [t for t in data if fnmatch.fnmatchcase(t, name)]
+            if not matches:
+                raise UnsupportedQuery(f"No sample data matches '{name}'.")
+            return self.union([self.table(t) for t in matches])
+        if name not in data:
+            raise UnsupportedQuery(f"No sample data for table '{name}'.")
+        sample = data[name]
+        self.rows_scanned += sample.rows
+        self.tables_scanned.append(name)
+        return Frame(dict(sample.columns), sample.rows, {column: (name, column) for column in sample.columns})
+
+    def source(self, source) -> Frame:
+        if isinstance(source, TableSource):
+            return self.table(source.name)
+        if isinstance(source, UnionSource):
+            return self.union([self.pipeline(leg) for leg in source.legs], source.legs, source.with_source)
+        if isinstance(source, DatatableSource):
+            raise UnsupportedQuery("datatable values are not kept by the parser.")
+        raise UnsupportedQuery(f"'{source.token.value}' sources are not supported.")
+
+    # -- operators ---------------------------------------------------------- #
+
+    def operator(self, op, frame: Frame) -> Frame:
+        if isinstance(op, Where):
+            mask = self.expr(op.predicate, frame)
+            if not _is_array(mask):
+                return frame if mask else frame.select(np.zeros(frame.rows, dtype=bool))
+            return frame.select(np.asarray(mask, dtype=bool))
+        if isinstance(op, (Project, Extend)):
+            return self.assign(op, frame)
+        if isinstance(op, Summarize):
+            return self.summarize(op, frame)
+        if isinstance(op, Join):
+            return self.join(op, frame)
+        if isinstance(op, UnionOperator):
+            return self.union([frame] + [self.pipeline(leg) for leg in op.legs], [None] + op.legs, op.with_source)
+        if isinstance(op, Take):
+            return frame.select(np.arange(min(int(self.expr(op.count, frame)), frame.rows)))
+        if isinstance(op, Sort):
+            frame = frame.select(self.sort_order(op, frame))
+            if op.count is None:
+                return frame
+            return frame.select(np.arange(min(int(self.expr(op.count, frame)), frame.rows)))
+        if isinstance(op, Distinct):
+            return self.distinct(op, frame)
+        if isinstance(op, Count):
+            return Frame({"Count": np.array([frame.rows], dtype=float)}, 1)
+        if isinstance(op, ProjectNames):
+            return self.project_names(op, frame)
+        if isinstance(op, ProjectRename):
+            columns, origin = dict(frame.columns), dict(frame.origin)
+            for new, old in op.items:
+                columns[new.name] = columns.pop(old.name)
+                if old.name in origin:
+                    origin[new.name] = origin.pop(old.name)
+            return Frame(columns, frame.rows, origin)
+        raise UnsupportedQuery(f"'{op.name}' is not supported by the dry-run engine.")
+
+    def assign(self, op, frame: Frame) -> Frame:
+        columns = {} if isinstance(op, Project) else dict(frame.columns)
+        origin = {} if isinstance(op, Project) else dict(frame.origin)
+        for i, item in enumerate(op.items, 1):
+            if item.alias is not None and "," in item.alias:
+                raise UnsupportedQuery("Tuple assignments are not supported.")
+            if isinstance(item.expr, Star):
+                raise UnsupportedQuery("'*' in project is not supported.")
+            name = item.alias or (item.expr.name if isinstance(item.expr, Name) else f"Column{i}")
+            columns[name] = _full(self.expr(item.expr, frame), frame.rows)
+            origin.pop(name, None)
+            if isinstance(item.expr, Name) and item.expr.name in frame.origin:
+                origin[name] = frame.origin[item.expr.name]
+        return Frame(columns, frame.rows, origin)
+
+    def sort_order(self, op: Sort, frame: Frame) -> np.ndarray:
+        """Row index for sort/top: a stable sort by the last key, then each key before it."""
+        order = np.arange(frame.rows)
+        for i in reversed(range(len(op.by))):
+            values = _full(self.expr(op.by[i], frame), frame.rows)[order]
+            descending = op.descending[i] if i < len(op.descending) else True
+            nulls_first = op.nulls_first[i] if i < len(op.nulls_first) else not descending
+            nulls = np.asarray(_isnull(values), dtype=bool)
+            present = values[~nulls]
+            rank = np.full(frame.rows, -np.inf if nulls_first else np.inf)
+            if len(present):
+                codes = _codes(present.astype(str) if present.dtype.kind == "O" else present).astype(float)
+                rank[~nulls] = -codes if descending else codes
+            order = order[np.argsort(rank, kind="stable")]
+        return order
+
+    def project_names(self, op: ProjectNames, frame: Frame) -> Frame:
+        patterns = [column.name for column in op.columns]
+        matched = [c for c in frame.columns if any(fnmatch.fnmatchcase(c, p) for p in patterns)]
+        if op.name == "project-away":
+            keep = [c for c in frame.columns if c not in matched]
+        elif op.name == "project-keep":
+            keep = matched
+        else:
+            keep = matched + [c for c in frame.columns if c not in matched]
+        return Frame({c: frame.columns[c] for c in keep}, frame.rows,
+                     {c: o for c, o in frame.origin.items() if c in keep})
+
+    def distinct(self, op: Distinct, frame: Frame) -> Frame:
+        if op.columns:
+            names = [e.name if isinstance(e, Name) else f"Column{i}" for i, e in enumerate(op.columns, 1)]
+            columns = {n: _full(self.expr(e, frame), frame.rows) for n, e in zip(names, op.columns)}
+        else:
+            self.read_all(frame)
+            columns = frame.columns
+        if not columns or frame.rows == 0:
+            return Frame(dict(columns), frame.rows)
+        first = np.unique(np.stack([_codes(v) for v in columns.values()], axis=1), axis=0, return_index=True)[1]
+        first = np.sort(first)
+        return Frame({n: v[first] for n, v in columns.items()}, len(first))
+
+    def union(self, frames: List[Frame], legs: Optional[Sequence[Optional[Pipeline]]] = None,
+              with_source: Optional[str] = None) -> Frame:
+        names: List[str] = []
+        for frame in frames:
+            self.read_all(frame)
+            names.extend(c for c in frame.columns if c not in names)
+        columns = {}
+        for name in names:
+            template = next(f.columns[name] for f in frames if name in f.columns)
+            parts = [f.columns[name] if name in f.columns else _null_like(template, f.rows) for f in frames]
+            columns[name] = np.concatenate(parts) if parts else template[:0]
+        if with_source:
+            labels = [leg.source.name if leg is not None and isinstance(leg.source, TableSource) else ""
+                      for leg in (legs or [None] * len(frames))]
+            columns[with_source] = np.concatenate([np.full(f.rows, label) for f, label in zip(frames, labels)])
+        return Frame(columns, sum(f.rows for f in frames))
+
+    def join(self, op: Join, left: Frame) -> Frame:
+        right = self.pipeline(op.right)
+        for key in op.on:
+            if key.left.name not in left.columns or key.right.name not in right.columns:
+                raise EngineError(f"Join key {key.left.name}/{key.right.name} is missing.")
+            self.reads.update(f.origin[c] for f, c in ((left, key.left.name), (right, key.right.name)) if c in f.origin)
+        lcode, rcode = _shared_codes([left.columns[k.left.name] for k in op.on],
+                                     [right.columns[k.right.name] for k in op.on])
+        kind = op.kind
+        if kind in ("leftsemi", "leftanti", "leftantisemi"):
+            matched = np.isin(lcode, rcode)
+            return left.select(matched if kind == "leftsemi" else ~matched)
+        if kind in ("rightsemi", "rightanti", "rightantisemi"):
+            matched = np.isin(rcode, lcode)
+            return right.select(matched if kind == "rightsemi" else ~matched)
+        if kind not in ("inner", "innerunique", "leftouter"):
+            raise UnsupportedQuery(f"join kind={kind} is not supported by the dry-run engine.")
+        if kind == "innerunique":
+            first = np.sort(np.unique(lcode, return_index=True)[1])
+            left, lcode = left.select(first), lcode[first]
+
+        order = np.argsort(rcode, kind="stable")
+        sorted_codes = rcode[order]
+        lo = np.searchsorted(sorted_codes, lcode, "left")
+        counts = np.searchsorted(sorted_codes, lcode, "right") - lo
+        total = int(counts.sum())
+        unmatched = np.flatnonzero(counts == 0) if kind == "leftouter" else np.array([], dtype=int)
+        if total + len(unmatched) > MAX_MATERIALIZED_ROWS:
+            raise CardinalityExceeded(total + len(unmatched))
+        left_index = np.repeat(np.arange(len(lcode)), counts)
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        right_index = order[np.repeat(lo, counts) + within]
+        if len(unmatched):
+            left_index = np.concatenate([left_index, unmatched])
+            right_index = np.concatenate([right_index, np.full(len(unmatched), -1)])
+
+        columns = {name: values[left_index] for name, values in left.columns.items()}
+        origin = dict(left.origin)
+        skip = {k.right.name for k in op.on} if op.token.value == "lookup" else set()
+        missing = right_index < 0
+        for name, values in right.columns.items():
+            if name in skip:
+                continue
+            out_name, suffix = name, 1
+            while out_name in columns:
+                out_name, suffix = f"{name}{suffix}", suffix + 1
+            picked = values[np.where(missing, 0, right_index)] if len(values) else _null_like(values, len(right_index))
+            if missing.any() and len(values):
+                picked = np.where(missing, _null_like(values, len(picked)), picked)
+            columns[out_name] = picked
+            if name in right.origin:
+                origin[out_name] = right.origin[name]
+        return Frame(columns, len(left_index), origin)
+
+    def summarize(self, op: Summarize, frame: Frame) -> Frame:
+        by_names, by_values = [], []
+        for i, item in enumerate(op.by, 1):
+            expr = item.expr
+            if item.alias:
+                name = item.alias
+            elif isinstance(expr, Name):
+                name = expr.name
+            elif isinstance(expr, Call) and expr.func in ("bin", "floor") and expr.args and isinstance(expr.args[0], Name):
+                name = expr.args[0].name
+            else:
+                name = f"Column{i}"
+            by_names.append(name)
+            by_values.append(_full(self.expr(expr, frame), frame.rows))
+        if by_values:
+            stacked = np.stack([_codes(v) for v in by_values], axis=1) if frame.rows else np.zeros((0, len(by_values)), int)
+            _, first, groups = np.unique(stacked, axis=0, return_index=True, return_inverse=True)
+            groups, n_groups = groups.ravel(), len(first)
+            columns = {name: values[first] for name, values in zip(by_names, by_values)}
+        else:
+            groups, n_groups = np.zeros(frame.rows, dtype=int), 1
+            columns = {}
+        for item in op.aggregates:
+            expr = item.expr
+            if not isinstance(expr, Call):
+                raise UnsupportedQuery("Only aggregation functions are supported in summarize.")
+            default = f"{expr.func}_{expr.args[0].name}" if expr.args and isinstance(expr.args[0], Name) else f"{expr.func}_"
+            columns[item.alias or default] = self.aggregate(expr, frame, groups, n_groups)
+        return Frame(columns, n_groups)
+
+    def aggregate(self, call: Call, frame: Frame, groups: np.ndarray, n: int) -> np.ndarray:
+        func = call.func
+        args = [_full(self.expr(arg, frame), frame.rows) for arg in call.args]
+        if func.endswith("if") and func not in ("countif",):
+            *args, condition = args
+            mask = np.asarray(condition, dtype=bool)
+            groups, args, func = groups[mask], [a[mask] for a in args], func[:-2]
+        if func == "count":
+            if args:
+                return np.bincount(groups, weights=~_isnull(args[0]), minlength=n)
+            return np.bincount(groups, minlength=n).astype(float)
+        if func == "countif":
+            return np.bincount(groups, weights=np.asarray(args[0], dtype=bool), minlength=n)
+        if func == "dcount":
+            codes = _codes(args[0]) if len(args[0]) else np.zeros(0, dtype=int)
+            width = int(codes.max()) + 1 if len(codes) else 1
+            pairs = np.unique(groups.astype(np.int64) * width + codes)
+            return np.bincount(pairs // width, minlength=n).astype(float)
+        if func in ("sum", "avg"):
+            values = args[0].astype(float)
+            valid = ~np.isnan(values)
+            total = np.bincount(groups, weights=np.where(valid, values, 0.0), minlength=n)
+            if func == "sum":
+                return total
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return total / np.bincount(groups, weights=valid, minlength=n)
+        if func in ("min", "max", "take_any", "any"):
+            values = args[0]
+            valid = ~np.asarray(_isnull(values), dtype=bool)
+            order = np.lexsort((values, groups)) if func in ("min", "max") else np.argsort(groups, kind="stable")
+            order = order[valid[order]]
+            if func == "max":
+                order = order[::-1]
+            present, first = np.unique(groups[order], return_index=True)
+            out = _null_like(values, n)
+            out[present] = values[order[first]]
+            return out
+        if func in ("make_set", "make_list"):
+            lists: List[list] = [[] for _ in range(n)]
+            for group, value in zip(groups.tolist(), args[0].tolist()):
+                if func == "make_list" or value not in lists[group]:
+                    lists[group].append(value)
+            return _full(None, n) if not n else np.array(lists + [None], dtype=object)[:-1]
+        raise UnsupportedQuery(f"Aggregation {func}() is not supported by the dry-run engine.")
+
+    # -- expressions -------------------------------------------------------- #
+
+    def expr(self, expr: Expr, frame: Frame) -> Any:
+        if isinstance(expr, Name):
+            if expr.name in frame.columns:
+                if expr.name in frame.origin:
+                    self.reads.add(frame.origin[expr.name])
+                return frame.columns[expr.name]
+            if expr.name in self.scalars:
+                return self.scalars[expr.name]
+            if expr.name in self.tables:
+                # A tabular let used as a value list, e.g. `where ip in (bad_ips)`.
+                return next(iter(self.tables[expr.name].columns.values()), np.array([]))
+            if expr.token.quoted and self.text[expr.token.pos:expr.token.pos + 1] == "[":
+                # ["x"] parses like the bracket-quoted name ['x']; not a column, so a one-item array.
+                return [expr.name]
+            raise EngineError(f"Unknown name '{expr.name}'.")
+        if isinstance(expr, Literal):
+            return self.literal(expr)
+        if isinstance(expr, ListExpr):
+            return [self.expr(item, frame) for item in expr.items]
+        if isinstance(expr, Unary):
+            value = self.expr(expr.operand, frame)
+            if expr.op == "!":
+                return np.logical_not(value)
+            return np.negative(value) if expr.op == "-" else value
+        if isinstance(expr, Call):
+            return self.call(expr, frame)
+        if isinstance(expr, Binary):
+            return self.binary(expr, frame)
+        if isinstance(expr, SubQuery):
+            result = self.pipeline(expr.pipeline)
+            return next(iter(result.columns.values()), np.array([]))
+        raise UnsupportedQuery(f"{type(expr).__name__} expressions are not supported by the dry-run engine.")
+
+    def literal(self, expr: Literal) -> Any:
+        if expr.kind == "string":
+            return expr.value if self.text[expr.token.pos:expr.token.pos + 1] == "@" else _unescape(expr.value)
+        if expr.kind == "number":
+            return float(expr.value)
+        if expr.kind == "timespan":
+            return _parse_timespan(expr.value)
+        if expr.kind == "bool":
+            return expr.value == "true"
+        if expr.kind == "null":
+            return None
+        if expr.kind == "raw":
+            func, _, rest = expr.value.partition("(")
+            inner = rest[:-1].strip()
+            if func == "datetime":
+                return _parse_datetime(inner)
+            if func == "timespan":
+                return _parse_timespan(inner)
+            return inner
+        raise UnsupportedQuery("Property bag literals are not supported.")
+
+    def binary(self, expr: Binary, frame: Frame) -> Any:
+        op = expr.op
+        if op in ("and", "or"):
+            left, right = self.expr(expr.left, frame), self.expr(expr.right, frame)
+            return np.logical_and(left, right) if op == "and" else np.logical_or(left, right)
+        left = self.expr(expr.left, frame)
+        base = op.lstrip("!")
+        negate = op.startswith("!") and op not in ("!=", "!~")
+        if base in ("in", "in~"):
+            values = self.expr(expr.right, frame)
+            flat = []
+            for value in (values if isinstance(values, list) else [values]):
+                flat.extend(value.tolist() if _is_array(value) else value if isinstance(value, list) else [value])
+            if base == "in~":
+                left, flat = np.strings.lower(_text(left)), [str(v).lower() for v in flat]
+            result = np.isin(left, np.array(flat)) if flat else np.zeros(len(left) if _is_array(left) else 1, bool)
+            if not _is_array(left):
+                result = bool(result[0]) if np.ndim(result) else bool(result)
+            return np.logical_not(result) if negate else result
+        if base == "between":
+            low, high = (self.expr(item, frame) for item in expr.right.items)
+            result = np.logical_and(np.greater_equal(left, low), np.less_equal(left, high))
+            return np.logical_not(result) if negate else result
+        if base in ("has_any", "has_all"):
+            needles = [str(v) for v in self.expr(expr.right, frame)]
+            patterns = [_term_pattern(n, False) for n in needles]
+            combine = any if base == "has_any" else all
+            return _per_value(left, lambda v: combine(p.search(v) is not None for p in patterns))
+        right = self.expr(expr.right, frame)
+        if op in ("=~", "!~"):
+            result = np.equal(np.strings.lower(_text(left)), _text(right).lower() if isinstance(right, str)
+                              else np.strings.lower(_text(right)))
+            return np.logical_not(result) if op == "!~" else result
+        if op in _COMPARISONS:
+            return _COMPARISONS[op](left, right)
+        if op in _ARITHMETIC:
+            return _ARITHMETIC[op](left, right)
+        if _is_array(right):
+            raise UnsupportedQuery(f"'{op}' with a column on the right is not supported.")
+        return self.string_operator(op, left, str(right))
+
+    def string_operator(self, op: str, values: Any, needle: str):
+        negate = op.startswith("!")
+        base = op.lstrip("!")
+        case_sensitive = base.endswith("_cs")
+        base = base[:-3] if case_sensitive else base
+        folded = needle if case_sensitive else needle.lower()
+
+        def fold(value: str) -> str:
+            return value if case_sensitive else value.lower()
+
+        if base == "contains":
+            test = lambda v: folded in fold(v)
+        elif base == "startswith":
+            test = lambda v: fold(v).startswith(folded)
+        elif base == "endswith":
+            test = lambda v: fold(v).endswith(folded)
+        elif base in ("has", "hasprefix", "hassuffix"):
+            pattern = _term_pattern(needle, case_sensitive, left=base != "hassuffix", right=base != "hasprefix")
+            test = lambda v: pattern.search(v) is not None
+        elif base == "matches regex":
+            pattern = re.compile(needle)
+            test = lambda v: pattern.search(v) is not None
+        else:
+            raise UnsupportedQuery(f"Operator '{op}' is not supported by the dry-run engine.")
+        result = _per_value(values, test)
+        return np.logical_not(result) if negate else result
+
+    def call(self, expr: Call, frame: Frame) -> Any:
+        func = expr.func
+        if func == "dynamic" or func == "pack_array":
+            values = [self.expr(arg, frame) for arg in expr.args]
+            return values[0] if func == "dynamic" and len(values) == 1 and isinstance(values[0], list) else values
+        args = [self.expr(arg, frame) for arg in expr.args]
+        now = self.engine.now
+        if func == "ago":
+            return now - args[0]
+        if func == "now":
+            return now + args[0] if args else now
+        if func in ("bin", "floor"):
+            value, size = args
+            if np.asarray(value).dtype.kind == "M":
+                epoch = np.datetime64(0, "us")
+                return epoch + ((value - epoch) // size) * size
+            return np.floor(np.divide(value, size)) * size
+        if func == "startofday":
+            return np.asarray(args[0]).astype("datetime64[D]").astype("datetime64[us]")
+        if func in ("tolower", "toupper"):
+            text = _text(args[0])
+            if not _is_array(text):
+                return text.lower() if func == "tolower" else text.upper()
+            return np.strings.lower(text) if func == "tolower" else np.strings.upper(text)
+        if func == "strlen":
+            text = _text(args[0])
+            return np.strings.str_len(text) if _is_array(text) else len(text)
+        if func in ("isempty", "isnotempty"):
+            result = _isempty(args[0])
+            return np.logical_not(result) if func == "isnotempty" else result
+        if func in ("isnull", "isnotnull"):
+            result = _isnull(args[0])
+            return np.logical_not(result) if func == "isnotnull" else result
+        if func == "not":
+            return np.logical_not(args[0])
+        if func in ("iff", "iif"):
+            return np.where(*args)
+        if func == "strcat":
+            parts = [_text(arg) for arg in args]
+            result = parts[0]
+            for part in parts[1:]:
+                result = np.strings.add(result, part) if _is_array(result) or _is_array(part) else result + part
+            return result
+        if func == "tostring":
+            return _text(args[0])
+        if func in ("toint", "tolong", "todouble", "toreal", "todecimal", "todatetime"):
+            target = "datetime" if func == "todatetime" else "real"
+            if _is_array(args[0]):
+                return _column_array(args[0].tolist(), target)
+            return _column_array([args[0]], target)[0]
+        raise UnsupportedQuery(f"Function {func}() is not supported by the dry-run engine.")
+
+
+@dataclass
+class DryRunResult:
+    """
+    Outcome of one dry run.
+
+    Attributes:
+        rows (int): Rows the query returned on the sample (a lower bound when a join was too large to build).
+        rows_scanned (int): Sample rows read from tables.
+        bytes_scanned (int): Approximate size of the table columns the query read.
+        tables (List[str]): Tables read, in order.
+        seconds (float): Execution time.
+        error (Optional[str]): Why the query could not be executed; rows are unknown when set.
+    """
+    rows: int = 0
+    rows_scanned: int = 0
+    bytes_scanned: int = 0
+    tables: List[str] = field(default_factory=list)
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows, "rows_scanned": self.rows_scanned, "bytes_scanned": self.bytes_scanned,
+            "tables": list(self.tables), "seconds": self.seconds, "error": self.error,
+        }
+
+
+class ExecutionEngine:
+    """
+    Executes KQL over SampleData.
+
+    Attributes:
+        data (SampleData): The per-table samples.
+        now (np.datetime64): Reference time for ago() and now(); defaults to the newest sample timestamp.
+    """
+
+    def __init__(self, data: SampleData, now: Optional[str] = None):
+        self.data = data
+        if now is not None:
+            self.now = np.datetime64(now, "us")
+        else:
+            latest = [
+                values.max() for table in data.values() for values in table.columns.values()
+                if values.dtype.kind == "M" and len(values) and not np.isnat(values).all()
+            ]
+            self.now = max(latest) if latest else np.datetime64("now", "us")
+
+    def execute(self, kql_query: str) -> Frame:
+        """Runs the query; raises KQLError, EngineError or UnsupportedQuery."""
+        return _Run(self).query(kql_query.strip())
+
+    def dry_run(self, kql_query: str) -> DryRunResult:
+        """Runs the query and reports its size instead of raising."""
+        start = time.perf_counter()
+        run = _Run(self)
+        result = DryRunResult()
+        try:
+            result.rows = run.query(kql_query.strip()).rows
+        except CardinalityExceeded as e:
+            result.rows = e.rows
+        except (EngineError, KQLError) as e:
+            result.error = str(e)
+        except (TypeError, ValueError) as e:
+            # Type mismatches the schema check does not catch (e.g. string > number).
+            result.error = f"{type(e).__name__}: {e}"
+        result.seconds = time.perf_counter() - start
+        result.rows_scanned = run.rows_scanned
+        result.tables = list(dict.fromkeys(run.tables_scanned))
+        result.bytes_scanned = sum(self.data[table].column_bytes.get(column, 0) for table, column in run.reads
+                                   if table in self.data)
+        DRY_RUN_SECONDS.observe(result.seconds)
+        return result
+
+
+@dataclass
+class DryRunPolicy:
+    """
+    Decides which dry-run results go back to reflection.
+
+    Queries returning fewer than min_rows or more than max_rows rows on the
+    sample are rejected. A query that filters on one of the hunt's own IoCs
+    is exempt from the min_rows check: sample data rarely contains them.
+    Queries the engine cannot execute are accepted.
+    """
+    engine: ExecutionEngine
+    min_rows: int = 1
+    max_rows: Optional[int] = 10_000
+
+    def check(self, kql_query: str, iocs: Sequence[str] = ()) -> Tuple[DryRunResult, Optional[str]]:
+        """Returns the dry run and, if the query should be revised, the reason for the reflection prompt."""
+        result = self.engine.dry_run(kql_query)
+        problem = None
+        scanned = f"{result.rows_scanned:,} sample rows scanned from {', '.join(result.tables) or 'no table'}"
+        if result.error is not None:
+            verdict = "unsupported"
+        elif result.rows < self.min_rows and not any(ioc.lower() in kql_query.lower() for ioc in iocs):
+            verdict = "empty"
+            problem = (f"Dry run on sample data returned {result.rows} rows ({scanned}). Check that the filters "
+                       "use the right columns and value formats and are not contradictory.")
+        elif self.max_rows is not None and result.rows > self.max_rows:
+            verdict = "too_many"
+            problem = (f"Dry run on sample data returned {result.rows:,} rows, above the limit of "
+                       f"{self.max_rows:,} ({scanned}). Join on more selective keys, add filters, or aggregate.")
+        else:
+            verdict = "ok"
+        DRY_RUNS.inc(verdict=verdict)
+        return result, problem
@@ -0,0 +1,208 @@
+"""
+Local stand-in for the Gemini chat model, for benchmarks and offline runs.
+
+FakeChatModel answers every node's prompt with plausible output (JSON for the
+enricher, KQL over the prompt's tables for the generator and the validator's
+fix step) after a configurable delay. It can fail or emit an invalid column
+at a given rate. Each answer is drawn from a generator seeded with the seed
+and the prompt text, so a run is reproducible at any concurrency. It can also
+answer 429 at random or when a requests-per-minute quota is exceeded, to
+exercise the scheduler in llm.py. With prefix_cache=True it behaves like a
+provider with prompt caching and reports the tokens of a previously seen
+leading run of messages as usage_metadata input_token_details.cache_read.
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+from .iocs import column_index, extract_iocs, ioc_columns
+from .schemas import get_registry
+
+_TABLE_LINE = re.compile(r"^Table: (\S+)$", re.MULTILINE)
+
+
+class FakeLLMError(RuntimeError):
+    """Injected failure, raised with probability error_rate."""
+
+
+class FakeRateLimitError(FakeLLMError):
+    """Injected HTTP 429, raised with probability throttle_rate or above the requests_per_minute quota."""
+
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _text(message: BaseMessage) -> str:
+    content = message.content
+    return content if isinstance(content, str) else "".join(part for part in content if isinstance(part, str))
+
+
+def synthetic_response(messages: List[BaseMessage], rng: random.Random, invalid_rate: float = 0.0) -> str:
+    """
+    Default responder. Picks tables from the "Table: ..." blocks of the prompt
+    and filters on the first column that can hold one of the prompt's IoCs;
+    with probability invalid_rate that column name is misspelled.
+    """
+    system = "\n".join(_text(m) for m in messages if isinstance(m, SystemMessage))
+    everything = "\n".join(_text(m) for m in messages)
+    registry = get_registry()
+    tables = [t for t in dict.fromkeys(_TABLE_LINE.findall(system)) if t in registry] or list(registry)[:4]
+
+    if '"shortlisted_tables"' in system:
+        request = _text(messages[-1]).strip()
+        return json.dumps({"enriched_query": f"Hunt for activity matching: {request}", "shortlisted_tables": tables[:4]})
+
+    index = column_index(registry)
+    for ioc in extract_iocs(everything):
+        matches = [(table, column) for table, column, _ in ioc_columns(ioc.type, index) if table in tables]
+        if matches:
+            table, column = min(matches, key=lambda match: tables.index(match[0]))
+            if rng.random() < invalid_rate:
+                column = f"{column}_value"
+            return f'{table}\n| where {column} has "{ioc.value}"\n| take 100'
+    return f"{tables[0]}\n| take 100"
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that sleeps instead of calling an API.
+
+    Attributes:
+        latency (float): Mean seconds per call before the first token.
+        jitter (float): Relative spread of latency, e.g. 0.2 for +/-20%.
+        tokens_per_second (float): Output rate added on top of latency; 0 disables it.
+        error_rate (float): Probability that a call raises FakeLLMError.
+        invalid_rate (float): Probability that generated KQL names an unknown column.
+        seed (int): Base seed; combined with the prompt text for each call.
+        throttle_rate (float): Probability that a call is rejected with FakeRateLimitError.
+        requests_per_minute (int): Emulated provider quota over a sliding minute; 0 disables it.
+        responder (Callable): (messages, rng) -> text; defaults to synthetic_response.
+        prefix_cache (bool): Emulate provider prompt caching at message granularity.
+        prefix_cache_ttl (float): Seconds a cached prefix lives after its last use.
+        prefix_cache_min_tokens (int): Shortest prefix, in tokens, that is reported as cached.
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    tokens_per_second: float = 0.0
+    error_rate: float = 0.0
+    invalid_rate: float = 0.0
+    seed: int = 0
+    throttle_rate: float = 0.0
+    requests_per_minute: int = 0
+    responder: Optional[Callable[[List[BaseMessage], random.Random], str]] = None
+    prefix_cache: bool = False
+    prefix_cache_ttl: float = 300.0
+    prefix_cache_min_tokens: int = 0
+
+    _throttle_rng: Optional[random.Random] = PrivateAttr(default=None)
+    _recent_calls: Deque[float] = PrivateAttr(default_factory=deque)
+    _quota_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _cached_prefixes: Dict[str, float] = PrivateAttr(default_factory=dict)
+    _cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _check_quota(self) -> None:
+        """Raises FakeRateLimitError like a provider would; drawn independently of the prompt."""
+        if not self.throttle_rate and not self.requests_per_minute:
+            return
+        with self._quota_lock:
+            if self._throttle_rng is None:
+                self._throttle_rng = random.Random(self.seed)
+            if self._throttle_rng.random() < self.throttle_rate:
+                raise FakeRateLimitError("Injected rate limit (429).")
+            if self.requests_per_minute:
+                now = time.monotonic()
+                while self._recent_calls and now - self._recent_calls[0] >= 60.0:
+                    self._recent_calls.popleft()
+                if len(self._recent_calls) >= self.requests_per_minute:
+                    raise FakeRateLimitError(
+                        f"Quota of {self.requests_per_minute} requests per minute exceeded (429).",
+                        retry_after=60.0 - (now - self._recent_calls[0]),
+                    )
+                self._recent_calls.append(now)
+
+    def clear_prefix_cache(self) -> None:
+        """Forgets every cached prefix, e.g. between benchmark runs."""
+        with self._cache_lock:
+            self._cached_prefixes.clear()
+
+    def _read_prefix_cache(self, messages: List[BaseMessage]) -> int:
+        """Prompt tokens served from the emulated cache: the longest leading run of messages seen before."""
+        digest = hashlib.sha1()
+        keys = []
+        for message in messages:
+            digest.update(f"{message.type}\x1f{_text(message)}\x1e".encode())
+            keys.append(digest.hexdigest())
+        now = time.monotonic()
+        with self._cache_lock:
+            hits = 0
+            for key in keys:
+                if self._cached_prefixes.get(key, 0.0) <= now:
+                    break
+                hits += 1
+            if len(self._cached_prefixes) > 4096:
+                self._cached_prefixes = {k: t for k, t in self._cached_prefixes.items() if t > now}
+            for key in keys:
+                self._cached_prefixes[key] = now + self.prefix_cache_ttl
+        cached = count_tokens_approximately(messages[:hits]) if hits else 0
+        return cached if cached >= max(self.prefix_cache_min_tokens, 1) else 0
+
+    def _plan(self, messages: List[BaseMessage]):
+        """Draws (delay, result or exception) for one call."""
+        rng = random.Random(f"{self.seed}\x1f" + "\x1f".join(_text(m) for m in messages))
+        delay = self.latency * (1.0 + self.jitter * (2.0 * rng.random() - 1.0))
+        if rng.random() < self.error_rate:
+            return max(delay, 0.0), FakeLLMError("Injected fake LLM failure.")
+
+        if self.responder is not None:
+            content = self.responder(messages, rng)
+        else:
+            content = synthetic_response(messages, rng, self.invalid_rate)
+        input_tokens = count_tokens_approximately(messages)
+        output_tokens = count_tokens_approximately([AIMessage(content=content)])
+        if self.tokens_per_second > 0:
+            delay += output_tokens / self.tokens_per_second
+        usage = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+        if self.prefix_cache:
+            usage["input_token_details"] = {"cache_read": self._read_prefix_cache(messages)}
+        message = AIMessage(content=content, usage_metadata=usage)
+        return max(delay, 0.0), ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self._check_quota()
+        delay, outcome = self._plan(messages)
+        time.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        self._check_quota()
+        delay, outcome = self._plan(messages)
+        await asyncio.sleep(delay)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
@@ -1,20 +1,75 @@
+from typing import Callable, Optional
+from langchain_core.runnables import Runnable, RunnableLambda
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import StateGraph, END
+from .cache import CachedGraph, QueryCache
+from .cost import CostModel
+from .engine import DryRunPolicy
+from .instrumentation import InstrumentedNode, LLMMetricsHandler
 from .tools.enricher import UserQueryEnricher
 from .tools.kql_generator import NL2KQLGenerator
+from .tools.optimizer import KQLOptimizer
 from .tools.validator import QueryValidator
 from .threat_intel_types import ThreatIntelState
 
-def build_graph():
+def _node(name: str, node, instrument: bool = True) -> Runnable:
+    """
+    Exposes a node's sync __call__ and async acall so both invoke and ainvoke work.
+    With instrument=True the node's runs and its LLM calls are recorded in
+    instrumentation.METRICS under the given node name.
+    """
+    runnable_name = type(node).__name__
+    if not instrument:
+        return RunnableLambda(node, afunc=node.acall, name=runnable_name)
+    wrapped = InstrumentedNode(name, node)
+    return RunnableLambda(wrapped, afunc=wrapped.acall, name=runnable_name).with_config(
+        callbacks=[LLMMetricsHandler(name)]
+    )
+
+
+def build_graph(cache: Optional[QueryCache] = None, stream_tokens: bool = False,
+                on_token: Optional[Callable[[str], None]] = None, instrument: bool = True,
+                candidates: int = 1, optimize: bool = True, dry_run: Optional[DryRunPolicy] = None,
+                checkpointer: Optional[BaseCheckpointSaver] = None, cost_model: Optional[CostModel] = None):
+    """
+    Builds the enricher -> generator -> optimizer -> validator workflow.
+
+    When a QueryCache is given, the compiled graph is wrapped so that queries
+    matching a cached IoC template skip every node; follow-up turns, runs
+    with a thread_id and graphs with a checkpointer bypass the cache.
+    stream_tokens=True makes the generator stream its output (to on_token,
+    if given) and abort as soon as the partial query references an unknown
+    table or column.
+    instrument=False leaves out the per-node metrics wrappers. candidates > 1
+    makes the generator request that many queries concurrently and keep the
+    first one that validates locally, so reflection only runs if all fail.
+    optimize=False leaves out the rule-based KQL optimizer, so the generator
+    feeds the validator directly. A DryRunPolicy makes the validator execute
+    each locally valid query on sample data and reflect on empty or
+    oversized results. A CostModel makes it estimate scan bytes and join
+    sizes from table statistics first, reflect on queries over its budget
+    and reject them once retries run out. A checkpointer (e.g. checkpoint.SQLiteCheckpointer)
+    persists the state after every node per thread_id, so an interrupted run
+    resumes at the node that failed and follow-up turns reuse the enrichment.
+    """
     g = StateGraph(ThreatIntelState)
-    g.add_node("enricher", UserQueryEnricher())
-    g.add_node("kql_generator", NL2KQLGenerator())
-    g.add_node("kql_validator", QueryValidator())
+    g.add_node("enricher", _node("enricher", UserQueryEnricher(), instrument))
+    g.add_node("kql_generator", _node("kql_generator", NL2KQLGenerator(stream=stream_tokens, on_token=on_token, candidates=candidates), instrument))
+    g.add_node("kql_validator", _node("kql_validator", QueryValidator(dry_run=dry_run, cost_model=cost_model), instrument))
 
     g.set_entry_point("enricher")
     g.add_edge("enricher", "kql_generator")
-    g.add_edge("kql_generator", "kql_validator")
+    if optimize:
+        g.add_node("kql_optimizer", _node("kql_optimizer", KQLOptimizer(), instrument))
+        g.add_edge("kql_generator", "kql_optimizer")
+        g.add_edge("kql_optimizer", "kql_validator")
+    else:
+        g.add_edge("kql_generator", "kql_validator")
     g.add_conditional_edges(
         "kql_validator",
         lambda s: "kql_generator" if s["validation_status"] == "retrying" else END,
     )
-    return g.compile()
+    app = g.compile(checkpointer=checkpointer)
+    if cache is not None:
+        return CachedGraph(app, cache)
+    return app
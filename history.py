@@ -0,0 +1,83 @@
+"""
+Bounded chat history: a state reducer that caps what is stored, and a policy
+that decides what part of it is sent to the model.
+
+Nodes return only the messages they add; `add_history` merges them into the
+state. Prompts then see a sliding window chosen by token budget, optionally
+preceded by a rolling summary of the messages that fell out of the window, so
+per-call prompt size stays flat however long a session runs.
+"""
+
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langgraph.graph.message import add_messages
+
+# Hard cap on messages kept in the graph state; older ones are discarded.
+MAX_STORED_MESSAGES = 50
+
+
+def add_history(left: Sequence[BaseMessage], right: Sequence[BaseMessage]) -> List[BaseMessage]:
+    """Reducer for ThreatIntelState.chat_history: appends new messages and keeps the newest MAX_STORED_MESSAGES."""
+    merged = add_messages(list(left or []), list(right or []))
+    if len(merged) > MAX_STORED_MESSAGES:
+        merged = merged[-MAX_STORED_MESSAGES:]
+    return merged
+
+
+def _first_line(message: BaseMessage, limit: int = 160) -> str:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    line = content.strip().splitlines()[0] if content.strip() else ""
+    return line if len(line) <= limit else line[:limit - 3] + "..."
+
+
+def condense(messages: Sequence[BaseMessage]) -> str:
+    """Default summarizer: the first line of each dropped message, oldest first."""
+    return "\n".join(f"- {_first_line(m)}" for m in messages if _first_line(m))
+
+
+@dataclass
+class HistoryPolicy:
+    """
+    Chooses the chat history sent with each prompt.
+
+    Attributes:
+        max_tokens (int): Token budget for the most recent messages (approximate count).
+        summarize (bool): Prepend a summary of the messages outside the window.
+        summary_max_tokens (int): Token budget for that summary; oldest lines are dropped first.
+        summarizer (Callable): Turns dropped messages into summary text. Defaults to `condense`,
+            which costs no LLM call; pass an LLM-backed callable for abstractive summaries.
+    """
+    max_tokens: int = 1500
+    summarize: bool = True
+    summary_max_tokens: int = 200
+    summarizer: Optional[Callable[[Sequence[BaseMessage]], str]] = None
+
+    def select(self, messages: Optional[Sequence[BaseMessage]]) -> List[BaseMessage]:
+        messages = list(messages or [])
+        window: List[BaseMessage] = []
+        used = 0
+        for message in reversed(messages):
+            cost = count_tokens_approximately([message])
+            if window and used + cost > self.max_tokens:
+                break
+            window.append(message)
+            used += cost
+        window.reverse()
+        dropped = messages[:len(messages) - len(window)]
+        if not dropped or not self.summarize:
+            return window
+
+        summary = (self.summarizer or condense)(dropped)
+        lines = summary.splitlines()
+        while lines and count_tokens_approximately([SystemMessage(content="\n".join(lines))]) > self.summary_max_tokens:
+            lines.pop(0)
+        if not lines:
+            return window
+        header = f"Summary of {len(dropped)} earlier message(s) in this session:\n"
+        return [SystemMessage(content=header + "\n".join(lines))] + window
+
+
+DEFAULT_HISTORY_POLICY = HistoryPolicy()
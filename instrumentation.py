@@ -0,0 +1,308 @@
+"""
+In-process metrics and structured logging for the pipeline.
+
+build_graph wraps every node in an InstrumentedNode, which times each run and
+records the retry and validation outcome from its state update. An
+LLMMetricsHandler on the node's callbacks times each model call and adds up
+its token usage. Everything lands in the process-wide METRICS registry, which
+renders in the Prometheus text exposition format:
+
+    from nl2kql_agent.instrumentation import METRICS
+    print(METRICS.render_prometheus())
+
+Nodes log through the standard logging module and stay silent until
+configure_logging() (or your own logging setup) enables INFO for
+"nl2kql_agent", so the hot path pays only a level check.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonic counter, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Counters can only increase.")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, value in sorted(self.samples().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram of observed values (seconds, by default)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def summary(self, **labels: str) -> Dict[str, float]:
+        """count, sum and mean for one label set."""
+        series = self._series.get(self._key(labels))
+        if series is None:
+            return {"count": 0, "sum": 0.0, "mean": 0.0}
+        return {"count": series[2], "sum": series[1], "mean": series[1] / series[2]}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            series = {key: (list(s[0]), s[1], s[2]) for key, s in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Named collection of counters and histograms."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered with a different shape.")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def reset(self) -> None:
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def render_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines: List[str] = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+NODE_SECONDS = METRICS.histogram("nl2kql_node_duration_seconds", "Wall time of one node run.", ["node"])
+NODE_ERRORS = METRICS.counter("nl2kql_node_errors_total", "Node runs that raised.", ["node"])
+LLM_SECONDS = METRICS.histogram("nl2kql_llm_duration_seconds", "Latency of one LLM call.", ["node"])
+LLM_ERRORS = METRICS.counter("nl2kql_llm_errors_total", "LLM calls that raised.", ["node"])
+LLM_TOKENS = METRICS.counter("nl2kql_llm_tokens_total", "Tokens sent to and received from the LLM (prompt, completion, and cached: prompt tokens read from the provider's prefix cache).", ["node", "kind"])
+PROMPT_CACHE = METRICS.counter("nl2kql_prompt_cache_total", "LLM calls whose prompt prefix was (hit) or was not (miss) read from the provider's cache.", ["node", "result"])
+RETRIES = METRICS.counter("nl2kql_retries_total", "Reflection retries started by the validator.")
+VALIDATIONS = METRICS.counter("nl2kql_validations_total", "Validation outcomes (valid, failed, retrying, aborted).", ["status"])
+LLM_QUEUE_SECONDS = METRICS.histogram("nl2kql_llm_queue_seconds", "Time an LLM call waited for the scheduler.", ["kind"])
+LLM_RETRIES = METRICS.counter("nl2kql_llm_retries_total", "LLM calls retried by the scheduler.", ["reason"])
+CACHE_LOOKUPS = METRICS.counter("nl2kql_cache_lookups_total", "Query cache lookups.", ["result"])
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Callback handler that times LLM calls made inside one node and counts their tokens."""
+
+    def __init__(self, node: str):
+        self.node = node
+        self._started: Dict[object, float] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs) -> None:
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs) -> None:
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            LLM_SECONDS.observe(time.perf_counter() - started, node=self.node)
+        prompt_tokens = completion_tokens = cached_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+                cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0)
+        if prompt_tokens:
+            LLM_TOKENS.inc(prompt_tokens, node=self.node, kind="prompt")
+            PROMPT_CACHE.inc(node=self.node, result="hit" if cached_tokens else "miss")
+        if completion_tokens:
+            LLM_TOKENS.inc(completion_tokens, node=self.node, kind="completion")
+        if cached_tokens:
+            LLM_TOKENS.inc(cached_tokens, node=self.node, kind="cached")
+
+    def on_llm_error(self, error, *, run_id, **kwargs) -> None:
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            LLM_SECONDS.observe(time.perf_counter() - started, node=self.node)
+        LLM_ERRORS.inc(node=self.node)
+
+
+class InstrumentedNode:
+    """Wraps a node (sync __call__ and async acall) to record its time and outcome."""
+
+    def __init__(self, name: str, node):
+        self.name = name
+        self.node = node
+
+    def _record(self, update) -> None:
+        status = (update or {}).get("validation_status")
+        if status == "retrying":
+            RETRIES.inc()
+        if status and status != "pending":
+            VALIDATIONS.inc(status=status)
+
+    def __call__(self, state):
+        start = time.perf_counter()
+        try:
+            update = self.node(state)
+        except Exception:
+            NODE_ERRORS.inc(node=self.name)
+            raise
+        finally:
+            NODE_SECONDS.observe(time.perf_counter() - start, node=self.name)
+        self._record(update)
+        return update
+
+    async def acall(self, state):
+        start = time.perf_counter()
+        try:
+            update = await self.node.acall(state)
+        except Exception:
+            NODE_ERRORS.inc(node=self.name)
+            raise
+        finally:
+            NODE_SECONDS.observe(time.perf_counter() - start, node=self.name)
+        self._record(update)
+        return update
+
+
+_RESERVED_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any `extra` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RESERVED_RECORD_FIELDS})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: int = logging.INFO, json_format: bool = False) -> None:
+    """Sends the package's logs to stderr, as plain text or JSON lines."""
+    logger = logging.getLogger(__name__.rsplit(".", 1)[0])
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter("%(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
@@ -0,0 +1,227 @@
+"""
+Rule-based Indicator of Compromise (IoC) extraction and table ranking.
+
+This is the enricher's fast path: precompiled patterns pull IPs, domains,
+URLs, emails and file hashes out of the user query, and a column index built
+once per schema registry maps each IoC type to the columns that can hold it.
+"""
+
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .schemas import REFERENCE_TABLES, SchemaRegistry, get_registry
+
+
+@dataclass(frozen=True)
+class IoC:
+    type: str   # ipv4, ipv6, domain, url, email, md5, sha1, sha256
+    value: str
+    start: int
+    end: int
+
+
+_IPV4_OCTET = r"(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)"
+_IPV6_GROUP = r"[0-9A-Fa-f]{1,4}"
+
+IOC_PATTERNS: Dict[str, "re.Pattern[str]"] = {
+    "url": re.compile(r"\b(?:https?|ftp)://[^\s'\"<>()]+", re.IGNORECASE),
+    "email": re.compile(r"\b[A-Za-z0-9._%+-]+@(?:[A-Za-z0-9-]+\.)+[A-Za-z]{2,63}\b"),
+    "sha256": re.compile(r"\b[A-Fa-f0-9]{64}\b"),
+    "sha1": re.compile(r"\b[A-Fa-f0-9]{40}\b"),
+    "md5": re.compile(r"\b[A-Fa-f0-9]{32}\b"),
+    "ipv4": re.compile(rf"(?<![\d.]){_IPV4_OCTET}(?:\.{_IPV4_OCTET}){{3}}(?![\d.]*\d)"),
+    "ipv6": re.compile(
+        rf"(?<![:\w])(?:(?:{_IPV6_GROUP}:){{7}}{_IPV6_GROUP}"
+        rf"|(?:{_IPV6_GROUP}:){{1,7}}:"
+        rf"|(?:{_IPV6_GROUP}:){{1,6}}:{_IPV6_GROUP}"
+        rf"|(?:{_IPV6_GROUP}:){{1,5}}(?::{_IPV6_GROUP}){{1,2}}"
+        rf"|(?:{_IPV6_GROUP}:){{1,4}}(?::{_IPV6_GROUP}){{1,3}}"
+        rf"|(?:{_IPV6_GROUP}:){{1,3}}(?::{_IPV6_GROUP}){{1,4}}"
+        rf"|(?:{_IPV6_GROUP}:){{1,2}}(?::{_IPV6_GROUP}){{1,5}}"
+        rf"|{_IPV6_GROUP}:(?::{_IPV6_GROUP}){{1,6}}"
+        rf"|::(?:{_IPV6_GROUP}:){{0,6}}{_IPV6_GROUP})(?![:\w])"
+    ),
+    "domain": re.compile(r"\b(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+[A-Za-z]{2,63}\b"),
+}
+
+# Extraction order matters: URLs and emails claim their text before the
+# domain pattern can match inside them.
+_EXTRACTION_ORDER = ("url", "email", "sha256", "sha1", "md5", "ipv4", "ipv6", "domain")
+
+# Things that look like domains but are almost always file names.
+_FILE_EXTENSIONS = {
+    "exe", "dll", "sys", "bat", "cmd", "ps1", "vbs", "js", "py", "sh", "bin", "zip", "rar",
+    "7z", "doc", "docx", "xls", "xlsx", "xlsm", "ppt", "pptx", "pdf", "txt", "csv", "log",
+    "lnk", "iso", "img", "msi", "jar", "hta", "scr", "tmp", "dat", "json", "xml", "html", "htm",
+}
+
+IOC_LABELS = {
+    "ipv4": "IP address", "ipv6": "IPv6 address", "domain": "domain", "url": "URL",
+    "email": "email address", "md5": "MD5 hash", "sha1": "SHA1 hash", "sha256": "SHA256 hash",
+}
+
+# Semantic column kinds, recognised from column names and types.
+COLUMN_KIND_PATTERNS: Dict[str, "re.Pattern[str]"] = {
+    "ip": re.compile(r"^(?:src_|dst_|source_|dest_)?ip(?:_addr(?:ess)?)?$", re.IGNORECASE),
+    "domain": re.compile(r"(?:^|_)domain$", re.IGNORECASE),
+    "url": re.compile(r"^(?:url|uri|link)$", re.IGNORECASE),
+    "email": re.compile(r"^(?:sender|recipient|reply_to|email(?:_addr(?:ess)?)?)$", re.IGNORECASE),
+    "hash": re.compile(r"(?:^|_)(?:hash|md5|sha1|sha256)$", re.IGNORECASE),
+}
+
+# IoC type -> (column kind, weight). The first entry is where the indicator
+# lives natively; later entries are columns that merely embed it.
+IOC_COLUMN_KINDS: Dict[str, Tuple[Tuple[str, float], ...]] = {
+    "ipv4": (("ip", 3.0),),
+    "ipv6": (("ip", 3.0),),
+    "domain": (("domain", 3.0), ("url", 2.0), ("email", 1.0)),
+    "url": (("url", 3.0), ("domain", 1.0)),
+    "email": (("email", 3.0),),
+    "md5": (("hash", 3.0),),
+    "sha1": (("hash", 3.0),),
+    "sha256": (("hash", 3.0),),
+}
+
+# Lexical score a table must reach for a keyword-only shortlist to be
+# trusted: about one table keyword or name term (weight 2-3 times its idf),
+# not a column name shared by half the catalog.
+STRONG_LEXICAL_SCORE = 3.0
+
+
+def build_column_index(schemas: Mapping[str, Sequence[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, str]]]:
+    """Maps each column kind (ip, domain, ...) to the (table, column) pairs that hold it."""
+    index: Dict[str, List[Tuple[str, str]]] = {kind: [] for kind in COLUMN_KIND_PATTERNS}
+    for table, columns in schemas.items():
+        seen = set()
+        for column, col_type in columns:
+            if column in seen or col_type != "string":
+                continue
+            seen.add(column)
+            for kind, pattern in COLUMN_KIND_PATTERNS.items():
+                if pattern.search(column) and not column.lower().startswith("password"):
+                    index[kind].append((table, column))
+    return index
+
+
+_column_indexes: Dict[str, Dict[str, List[Tuple[str, str]]]] = {}
+
+
+def column_index(registry: Optional[SchemaRegistry] = None) -> Dict[str, List[Tuple[str, str]]]:
+    """The column index for a registry (default: the process-wide one), built once per schema version."""
+    registry = registry or get_registry()
+    index = _column_indexes.get(registry.version)
+    if index is None:
+        index = _column_indexes[registry.version] = build_column_index(registry)
+    return index
+
+
+def extract_iocs(text: str) -> List[IoC]:
+    """Returns the IoCs found in text, deduplicated, in order of appearance."""
+    claimed: List[Tuple[int, int]] = []
+    found: List[IoC] = []
+    for ioc_type in _EXTRACTION_ORDER:
+        for match in IOC_PATTERNS[ioc_type].finditer(text):
+            start, end = match.span()
+            if any(start < c_end and c_start < end for c_start, c_end in claimed):
+                continue
+            value = match.group(0).rstrip(".,;")
+            if ioc_type == "domain" and value.rsplit(".", 1)[-1].lower() in _FILE_EXTENSIONS:
+                continue
+            if ioc_type == "domain" and value.replace(".", "").isdigit():
+                continue
+            claimed.append((start, end))
+            found.append(IoC(ioc_type, value, start, start + len(value)))
+    found.sort(key=lambda ioc: ioc.start)
+    unique: Dict[Tuple[str, str], IoC] = {}
+    for ioc in found:
+        unique.setdefault((ioc.type, ioc.value.lower()), ioc)
+    return list(unique.values())
+
+
+def ioc_columns(ioc_type: str, index: Mapping[str, List[Tuple[str, str]]]) -> List[Tuple[str, str, float]]:
+    """(table, column, weight) triples that an IoC of the given type should be matched against."""
+    return [
+        (table, column, weight)
+        for kind, weight in IOC_COLUMN_KINDS.get(ioc_type, ())
+        for table, column in index.get(kind, [])
+    ]
+
+
+def rank_tables(text: str, iocs: Sequence[IoC], registry: Optional[SchemaRegistry] = None) -> List[Tuple[str, float]]:
+    """
+    Scores tables by IoC column matches plus lexical relevance, best first.
+
+    Equal scores are ordered event logs first: tables with a datetime column
+    that are not REFERENCE_TABLES, then other tables, then reference tables.
+    """
+    registry = registry or get_registry()
+    index = column_index(registry)
+    scores: Dict[str, float] = registry.score_tables(text)
+    for ioc_type in {ioc.type for ioc in iocs}:
+        best: Dict[str, float] = {}
+        for table, _, weight in ioc_columns(ioc_type, index):
+            best[table] = max(best.get(table, 0.0), weight)
+        for table, weight in best.items():
+            scores[table] = scores.get(table, 0.0) + weight
+
+    def tie_rank(table: str) -> int:
+        if table in REFERENCE_TABLES:
+            return 2
+        return 0 if "datetime" in registry.table(table).types else 1
+
+    return sorted(scores.items(), key=lambda item: (-item[1], tie_rank(item[0])))
+
+
+@dataclass
+class Enrichment:
+    enriched_query: str
+    shortlisted_tables: List[str]
+    iocs: List[IoC]
+    confidence: float
+
+
+def enrich(text: str, k: int = 4, registry: Optional[SchemaRegistry] = None) -> Enrichment:
+    """
+    Builds an enriched hunting request and a k-table shortlist without an LLM.
+
+    Confidence is 1.0 when the query contains IoCs with matching columns,
+    0.6 when only table names/keywords/columns matched with a score of at
+    least STRONG_LEXICAL_SCORE, and 0.0 when nothing matched. It drops to
+    0.4 (IoCs) or 0.3 (lexical) when the match is weak or the top-k cut
+    falls between equally scored tables, so the shortlist is a coin toss;
+    the enricher asks the LLM below 0.5.
+    """
+    registry = registry or get_registry()
+    index = column_index(registry)
+    iocs = extract_iocs(text)
+    ranked = rank_tables(text, iocs, registry)
+    shortlisted = [table for table, score in ranked[:k] if score > 0]
+    for table in registry:
+        if len(shortlisted) >= k:
+            break
+        if table not in shortlisted:
+            shortlisted.append(table)
+
+    lines = [text.strip()]
+    for ioc in iocs:
+        columns = [
+            f"{table}.{column}" for table, column, _ in ioc_columns(ioc.type, index)
+            if table in shortlisted
+        ]
+        line = f"- {IOC_LABELS[ioc.type]} {ioc.value}"
+        if columns:
+            line += f" (match against {', '.join(columns)})"
+        lines.append(line)
+    if iocs:
+        lines.insert(1, "Indicators of compromise:")
+    enriched_query = "\n".join(lines)
+
+    split_tie = len(ranked) > k and ranked[k][1] == ranked[k - 1][1]
+    if any(ioc_columns(ioc.type, index) for ioc in iocs):
+        confidence = 0.4 if split_tie else 1.0
+    elif ranked:
+        confidence = 0.6 if ranked[0][1] >= STRONG_LEXICAL_SCORE and not split_tie else 0.3
+    else:
+        confidence = 0.0
+    return Enrichment(enriched_query, shortlisted, iocs, confidence)
@@ -0,0 +1,1552 @@
+"""
+A small in-process KQL front end: tokenizer, pipeline parser and a
+schema-aware validator.
+
+Only the subset of KQL that the generator is asked to produce is understood
+in depth (tables, `|` pipelines, where/project/extend/summarize/join/union and
+friends). Operators outside that subset are parsed opaquely so they never
+cause false failures; column checks are simply switched off after them.
+"""
+
+import difflib
+import fnmatch
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+from .schemas import get_registry
+
+
+# --------------------------------------------------------------------------- #
+# Errors
+# --------------------------------------------------------------------------- #
+
+class KQLError(Exception):
+    """Base class for errors that carry a location inside the query text."""
+
+    kind = "KQL error"
+
+    def __init__(self, message: str, line: int = 1, column: int = 1):
+        super().__init__(message)
+        self.message = message
+        self.line = line
+        self.column = column
+
+    def format(self, query: str) -> str:
+        """Render the error with its location and a caret under the offending text."""
+        lines = query.splitlines() or [""]
+        text = f"{self.kind} at line {self.line}, column {self.column}: {self.message}"
+        if 1 <= self.line <= len(lines):
+            source_line = lines[self.line - 1]
+            text += f"\n    {source_line}\n    {' ' * (self.column - 1)}^"
+        return text
+
+
+class KQLSyntaxError(KQLError):
+    kind = "Syntax error"
+
+
+class KQLSemanticError(KQLError):
+    kind = "Semantic error"
+
+
+# --------------------------------------------------------------------------- #
+# Tokenizer
+# --------------------------------------------------------------------------- #
+
+@dataclass(frozen=True)
+class Token:
+    kind: str  # IDENT, STRING, NUMBER, TIMESPAN, RAW, OP, EOF
+    value: str
+    pos: int
+    line: int
+    column: int
+    quoted: bool = False
+
+
+HYPHENATED_OPERATORS = {
+    "project-away", "project-keep", "project-rename", "project-reorder",
+    "mv-expand", "mv-apply", "make-series", "parse-where", "parse-kv",
+    "top-nested", "top-hitters",
+}
+
+# Keyword operators that may be prefixed with "!" and/or suffixed with "~".
+NEGATABLE_WORDS = {
+    "contains", "contains_cs", "has", "has_cs", "hasprefix", "hasprefix_cs",
+    "hassuffix", "hassuffix_cs", "startswith", "startswith_cs", "endswith",
+    "endswith_cs", "in", "between", "has_any", "has_all",
+}
+
+TIMESPAN_UNITS = (
+    "microseconds", "microsecond", "milliseconds", "millisecond", "seconds", "second",
+    "minutes", "minute", "hours", "hour", "days", "day", "ticks", "tick",
+    "ms", "min", "sec", "d", "h", "m", "s",
+)
+
+RAW_LITERAL_FUNCTIONS = {"datetime", "timespan", "guid"}
+
+PUNCTUATION = (
+    "==", "!=", "<>", "<=", ">=", "=~", "!~", "..",
+    "|", "(", ")", "[", "]", "{", "}", ",", ";", ".", "<", ">", "=",
+    "+", "-", "*", "/", "%", ":", "!", "?",
+)
+
+
+def _is_ident_start(ch: str) -> bool:
+    return ch.isalpha() or ch in "_$"
+
+
+def _is_ident_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+def tokenize(query: str) -> List[Token]:
+    """Split a KQL query into tokens, raising KQLSyntaxError on bad input."""
+    tokens: List[Token] = []
+    i, n = 0, len(query)
+    line, line_start = 1, 0
+
+    def make(kind: str, value: str, start: int, quoted: bool = False) -> Token:
+        return Token(kind, value, start, line, start - line_start + 1, quoted)
+
+    while i < n:
+        ch = query[i]
+
+        if ch == "\n":
+            i += 1
+            line, line_start = line + 1, i
+            continue
+        if ch.isspace():
+            i += 1
+            continue
+        if query.startswith("//", i):
+            while i < n and query[i] != "\n":
+                i += 1
+            continue
+
+        start = i
+
+        # String literals: '...', "...", @'...', @"...", h'...'
+        verbatim = False
+        if ch in "@hH" and i + 1 < n and query[i + 1] in "'\"":
+            verbatim = ch == "@"
+            i += 1
+            ch = query[i]
+        if ch in "'\"":
+            quote = ch
+            i += 1
+            chars = []
+            while i < n and query[i] != quote:
+                if query[i] == "\n":
+                    break
+                if query[i] == "\\" and not verbatim and i + 1 < n:
+                    chars.append(query[i:i + 2])
+                    i += 2
+                    continue
+                chars.append(query[i])
+                i += 1
+            if i >= n or query[i] != quote:
+                raise KQLSyntaxError("Unterminated string literal.", line, start - line_start + 1)
+            i += 1
+            tokens.append(make("STRING", "".join(chars), start))
+            continue
+
+        if ch.isdigit():
+            while i < n and (query[i].isdigit() or query[i] == "."):
+                if query[i] == "." and (i + 1 >= n or not query[i + 1].isdigit()):
+                    break
+                i += 1
+            if i < n and query[i] in "eE" and i + 1 < n and (query[i + 1].isdigit() or query[i + 1] in "+-"):
+                i += 2
+                while i < n and query[i].isdigit():
+                    i += 1
+            number = query[start:i]
+            for unit in TIMESPAN_UNITS:
+                end = i + len(unit)
+                if query.startswith(unit, i) and (end >= n or not _is_ident_char(query[end])):
+                    i = end
+                    tokens.append(make("TIMESPAN", query[start:i], start))
+                    break
+            else:
+                if i < n and _is_ident_char(query[i]):
+                    raise KQLSyntaxError(f"Invalid numeric literal '{query[start:i + 1]}'.", line, start - line_start + 1)
+                tokens.append(make("NUMBER", number, start))
+            continue
+
+        if _is_ident_start(ch):
+            i += 1
+            while i < n and _is_ident_char(query[i]):
+                i += 1
+            word = query[start:i]
+            # Hyphenated operator names such as project-away or mv-expand.
+            if i < n and query[i] == "-":
+                j = i + 1
+                while j < n and _is_ident_char(query[j]):
+                    j += 1
+                if query[start:j] in HYPHENATED_OPERATORS:
+                    i = j
+                    word = query[start:i]
+            if word in ("in", "has_any") and i < n and query[i] == "~":
+                i += 1
+                word += "~"
+            # datetime(2024-01-01) and friends take an unquoted literal.
+            if word in RAW_LITERAL_FUNCTIONS:
+                j = i
+                while j < n and query[j] in " \t":
+                    j += 1
+                if j < n and query[j] == "(":
+                    close = query.find(")", j)
+                    if close == -1:
+                        raise KQLSyntaxError(f"Unterminated {word}() literal.", line, start - line_start + 1)
+                    i = close + 1
+                    tokens.append(make("RAW", query[start:i], start))
+                    continue
+            tokens.append(make("IDENT", word, start))
+            continue
+
+        if ch == "!" and i + 1 < n and query[i + 1].isalpha():
+            j = i + 1
+            while j < n and _is_ident_char(query[j]):
+                j += 1
+            word = query[i + 1:j]
+            if word in NEGATABLE_WORDS:
+                if j < n and query[j] == "~":
+                    j += 1
+                i = j
+                tokens.append(make("IDENT", query[start:i], start))
+                continue
+
+        for punct in PUNCTUATION:
+            if query.startswith(punct, i):
+                i += len(punct)
+                tokens.append(make("OP", punct, start))
+                break
+        else:
+            raise KQLSyntaxError(f"Unexpected character '{ch}'.", line, start - line_start + 1)
+
+    tokens.append(Token("EOF", "", n, line, n - line_start + 1))
+    return tokens
+
+
+# --------------------------------------------------------------------------- #
+# AST
+# --------------------------------------------------------------------------- #
+
+@dataclass
+class Expr:
+    token: Token
+
+
+@dataclass
+class Name(Expr):
+    name: str
+
+
+@dataclass
+class Literal(Expr):
+    value: str
+    kind: str  # string, number, timespan, raw, bool, null
+
+
+@dataclass
+class Call(Expr):
+    func: str
+    args: List[Expr]
+
+
+@dataclass
+class Binary(Expr):
+    op: str
+    left: Expr
+    right: Expr
+
+
+@dataclass
+class Unary(Expr):
+    op: str
+    operand: Expr
+
+
+@dataclass
+class Member(Expr):
+    obj: Expr
+    attr: str
+
+
+@dataclass
+class Index(Expr):
+    obj: Expr
+    index: Expr
+
+
+@dataclass
+class ListExpr(Expr):
+    items: List[Expr]
+
+
+@dataclass
+class Star(Expr):
+    pass
+
+
+@dataclass
+class SubQuery(Expr):
+    """A tabular expression used as a scalar operand, e.g. `x in (T | project y)`."""
+    pipeline: "Pipeline"
+
+
+@dataclass
+class Assignment:
+    """An `[alias =] expr` item of project/extend/summarize."""
+    alias: Optional[str]
+    expr: Expr
+
+
+@dataclass
+class Source:
+    token: Token
+
+
+@dataclass
+class TableSource(Source):
+    name: str
+
+
+@dataclass
+class UnionSource(Source):
+    legs: List["Pipeline"]
+    with_source: Optional[str] = None
+
+
+@dataclass
+class DatatableSource(Source):
+    columns: List[Tuple[str, str]]
+
+
+@dataclass
+class OpaqueSource(Source):
+    pass
+
+
+@dataclass
+class Operator:
+    token: Token
+
+    @property
+    def name(self) -> str:
+        return self.token.value
+
+
+@dataclass
+class Where(Operator):
+    predicate: Expr
+
+
+@dataclass
+class Project(Operator):
+    items: List[Assignment]
+
+
+@dataclass
+class ProjectNames(Operator):
+    """project-away / project-keep / project-reorder: a list of column names or wildcards."""
+    columns: List[Name]
+
+
+@dataclass
+class ProjectRename(Operator):
+    items: List[Tuple[Name, Name]]
+
+
+@dataclass
+class Extend(Operator):
+    items: List[Assignment]
+
+
+@dataclass
+class Summarize(Operator):
+    aggregates: List[Assignment]
+    by: List[Assignment]
+
+
+@dataclass
+class JoinKey:
+    left: Name
+    right: Name
+
+
+@dataclass
+class Join(Operator):
+    kind: str
+    right: "Pipeline"
+    on: List[JoinKey]
+
+
+@dataclass
+class UnionOperator(Operator):
+    legs: List["Pipeline"]
+    with_source: Optional[str] = None
+
+
+@dataclass
+class Take(Operator):
+    count: Expr
+
+
+@dataclass
+class Sort(Operator):
+    by: List[Expr]
+    count: Optional[Expr] = None  # set for `top N by ...`
+    descending: List[bool] = field(default_factory=list)  # per key; KQL sorts descending unless `asc`
+    nulls_first: List[bool] = field(default_factory=list)  # per key; by default first when ascending
+
+
+@dataclass
+class Distinct(Operator):
+    columns: List[Expr]
+
+
+@dataclass
+class Count(Operator):
+    pass
+
+
+@dataclass
+class OpaqueOperator(Operator):
+    """Any operator outside the supported subset; its output columns are unknown."""
+    pass
+
+
+@dataclass
+class Pipeline:
+    source: Source
+    operators: List[Operator] = field(default_factory=list)
+
+
+@dataclass
+class LetStatement:
+    token: Token
+    name: str
+    value: Optional[object]  # Pipeline, Expr, or None for unanalysed definitions
+
+
+@dataclass
+class Query:
+    lets: List[LetStatement]
+    body: Optional[Pipeline]
+
+    def pipelines(self) -> List[Pipeline]:
+        """All tabular pipelines in the query, top level first."""
+        found = [let.value for let in self.lets if isinstance(let.value, Pipeline)]
+        if self.body is not None:
+            found.append(self.body)
+        return found
+
+
+# --------------------------------------------------------------------------- #
+# Parser
+# --------------------------------------------------------------------------- #
+
+COMPARISON_OPERATORS = {
+    "==", "!=", "<>", "<", ">", "<=", ">=", "=~", "!~",
+}
+STRING_OPERATORS = (
+    {w for w in NEGATABLE_WORDS} | {"!" + w for w in NEGATABLE_WORDS}
+    | {"in~", "!in~", "has_any~", "matches"}
+)
+JOIN_KINDS = {
+    "inner", "innerunique", "leftouter", "rightouter", "fullouter",
+    "leftanti", "rightanti", "leftsemi", "rightsemi", "leftantisemi", "rightantisemi",
+}
+AGGREGATE_FUNCTIONS = {
+    "count", "countif", "dcount", "dcountif", "sum", "sumif", "avg", "avgif", "min", "max",
+    "minif", "maxif", "make_set", "make_list", "make_set_if", "make_list_if", "arg_max",
+    "arg_min", "any", "take_any", "percentile", "percentiles", "stdev", "variance",
+}
+BUILTIN_SCALARS = {"true": "bool", "false": "bool", "null": "null"}
+
+
+class Parser:
+    """Recursive-descent parser producing a Query AST."""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.i = 0
+
+    # -- token helpers ------------------------------------------------------ #
+
+    @property
+    def tok(self) -> Token:
+        return self.tokens[self.i]
+
+    def peek(self, offset: int = 1) -> Token:
+        return self.tokens[min(self.i + offset, len(self.tokens) - 1)]
+
+    def advance(self) -> Token:
+        tok = self.tokens[self.i]
+        if tok.kind != "EOF":
+            self.i += 1
+        return tok
+
+    def at(self, value: str, kind: Optional[str] = None) -> bool:
+        tok = self.tok
+        return tok.value == value and (kind is None or tok.kind == kind) and not tok.quoted
+
+    def at_word(self, *words: str) -> bool:
+        return self.tok.kind == "IDENT" and not self.tok.quoted and self.tok.value in words
+
+    def accept(self, value: str) -> Optional[Token]:
+        if self.tok.kind in ("OP", "IDENT") and self.at(value):
+            return self.advance()
+        return None
+
+    def expect(self, value: str, context: str = "") -> Token:
+        if self.tok.kind in ("OP", "IDENT") and self.at(value):
+            return self.advance()
+        self.error(f"Expected '{value}'{context} but found {self.describe(self.tok)}.")
+
+    def expect_ident(self, what: str = "an identifier") -> Token:
+        if self.tok.kind == "IDENT":
+            return self.advance()
+        if self.at("[") and self.peek().kind == "STRING" and self.peek(2).value == "]":
+            return self._bracketed_name()
+        self.error(f"Expected {what} but found {self.describe(self.tok)}.")
+
+    def error(self, message: str, tok: Optional[Token] = None):
+        tok = tok or self.tok
+        raise KQLSyntaxError(message, tok.line, tok.column)
+
+    @staticmethod
+    def describe(tok: Token) -> str:
+        if tok.kind == "EOF":
+            return "end of query"
+        return f"'{tok.value}'"
+
+    def _bracketed_name(self) -> Token:
+        open_tok = self.advance()
+        name_tok = self.advance()
+        self.advance()
+        return Token("IDENT", name_tok.value, open_tok.pos, open_tok.line, open_tok.column, quoted=True)
+
+    def at_pipe_end(self) -> bool:
+        return self.tok.kind == "EOF" or self.at("|", "OP") or self.at(";", "OP") or self.at(")", "OP")
+
+    def skip_balanced(self, stop_at_comma: bool = False) -> None:
+        """Skip tokens up to the next top-level pipe, semicolon or closing paren."""
+        depth = 0
+        while self.tok.kind != "EOF":
+            if self.tok.kind == "OP":
+                if self.tok.value in "([{":
+                    depth += 1
+                elif self.tok.value in ")]}":
+                    if depth == 0:
+                        return
+                    depth -= 1
+                elif depth == 0 and self.tok.value in ("|", ";"):
+                    return
+                elif depth == 0 and stop_at_comma and self.tok.value == ",":
+                    return
+            self.advance()
+
+    # -- statements --------------------------------------------------------- #
+
+    def parse(self) -> Query:
+        lets: List[LetStatement] = []
+        body: Optional[Pipeline] = None
+        while self.tok.kind != "EOF":
+            if self.accept(";"):
+                continue
+            if self.at_word("let"):
+                lets.append(self.parse_let())
+            elif self.at_word("set"):
+                self.skip_balanced()
+            else:
+                if body is not None:
+                    self.error("Only one tabular expression statement is supported per query.")
+                body = self.parse_pipeline()
+            if self.tok.kind != "EOF":
+                self.expect(";", " between statements")
+        if body is None and not lets:
+            self.error("Query is empty.")
+        return Query(lets=lets, body=body)
+
+    def parse_let(self) -> LetStatement:
+        let_tok = self.advance()
+        name_tok = self.expect_ident("a name after 'let'")
+        self.expect("=", f" after 'let {name_tok.value}'")
+        if self.at("(", "OP") and self._looks_like_lambda():
+            # Function definitions are accepted but not analysed.
+            self.skip_balanced()
+            return LetStatement(let_tok, name_tok.value, None)
+        if self.at_word("view", "materialize", "toscalar") and self.peek().value == "(":
+            self.skip_balanced()
+            return LetStatement(let_tok, name_tok.value, None)
+        if self._starts_tabular():
+            return LetStatement(let_tok, name_tok.value, self.parse_pipeline())
+        return LetStatement(let_tok, name_tok.value, self.parse_expr())
+
+    def _looks_like_lambda(self) -> bool:
+        # `(x: string) { ... }` or `() { ... }`
+        depth, j = 0, self.i
+        while j < len(self.tokens):
+            tok = self.tokens[j]
+            if tok.value == "(":
+                depth += 1
+            elif tok.value == ")":
+                depth -= 1
+                if depth == 0:
+                    return self.tokens[j + 1].value == "{" if j + 1 < len(self.tokens) else False
+            j += 1
+        return False
+
+    def _starts_tabular(self) -> bool:
+        tok = self.tok
+        if tok.kind != "IDENT":
+            return self.at("(", "OP") and self.peek().kind == "IDENT" and self.peek(2).value == "|"
+        if tok.value in ("union", "datatable", "range", "print", "find", "search"):
+            return True
+        nxt = self.peek()
+        return (nxt.kind == "OP" and nxt.value in ("|", ";")) or nxt.kind == "EOF"
+
+    # -- pipelines ---------------------------------------------------------- #
+
+    def parse_pipeline(self) -> Pipeline:
+        source = self.parse_source()
+        pipeline = Pipeline(source=source)
+        while self.accept("|"):
+            pipeline.operators.append(self.parse_operator())
+        if not self.at_pipe_end():
+            self.error(f"Unexpected {self.describe(self.tok)}; expected '|' before the next operator.")
+        return pipeline
+
+    def parse_source(self) -> Source:
+        tok = self.tok
+        if self.accept("("):
+            inner = self.parse_pipeline()
+            self.expect(")", " to close the sub-query")
+            return UnionSource(tok, [inner])
+        if tok.kind == "IDENT" and not tok.quoted:
+            if tok.value == "union":
+                self.advance()
+                legs, with_source = self.parse_union_args()
+                return UnionSource(tok, legs, with_source)
+            if tok.value == "datatable":
+                return self.parse_datatable()
+            if tok.value in ("range", "print", "find", "search", "externaldata", "evaluate"):
+                self.advance()
+                self.skip_balanced()
+                return OpaqueSource(tok)
+            if self.peek().value == "(" and self.peek().kind == "OP":
+                # table("Name"), materialize(T) and other tabular functions.
+                self.advance()
+                self.skip_balanced()
+                return OpaqueSource(tok)
+        if tok.kind == "IDENT" or self.at("[", "OP"):
+            name_tok = self.expect_ident("a table name")
+            return TableSource(name_tok, name_tok.value)
+        self.error(f"Expected a table name at the start of the query but found {self.describe(tok)}.")
+
+    def parse_datatable(self) -> DatatableSource:
+        tok = self.advance()
+        self.expect("(", " after 'datatable'")
+        columns: List[Tuple[str, str]] = []
+        while not self.at(")", "OP"):
+            col = self.expect_ident("a column name")
+            self.expect(":", " in datatable schema")
+            col_type = self.expect_ident("a column type")
+            columns.append((col.value, col_type.value))
+            if not self.accept(","):
+                break
+        self.expect(")", " to close the datatable schema")
+        self.expect("[", " before datatable values")
+        depth = 1
+        while depth and self.tok.kind != "EOF":
+            if self.at("[", "OP"):
+                depth += 1
+            elif self.at("]", "OP"):
+                depth -= 1
+            self.advance()
+        if depth:
+            self.error("Unterminated datatable values.")
+        return DatatableSource(tok, columns)
+
+    def parse_union_args(self) -> Tuple[List[Pipeline], Optional[str]]:
+        with_source = None
+        while self.tok.kind == "IDENT" and self.peek().value == "=" and self.tok.value in ("kind", "withsource", "isfuzzy"):
+            key = self.advance().value
+            self.advance()
+            value = self.expect_ident(f"a value for '{key}'")
+            if key == "withsource":
+                with_source = value.value
+        legs: List[Pipeline] = []
+        while True:
+            tok = self.tok
+            if self.accept("("):
+                legs.append(self.parse_pipeline())
+                self.expect(")", " to close the union leg")
+            else:
+                name_tok = self.expect_ident("a table name in union")
+                name = name_tok.value
+                while self.at("*", "OP") and self.tok.pos == name_tok.pos + len(name):
+                    name += self.advance().value
+                legs.append(Pipeline(TableSource(name_tok, name)))
+            if not self.accept(","):
+                break
+        if not legs:
+            self.error("Expected at least one table after 'union'.", tok)
+        return legs, with_source
+
+    def parse_operator(self) -> Operator:
+        tok = self.tok
+        if tok.kind != "IDENT":
+            self.error(f"Expected an operator after '|' but found {self.describe(tok)}.")
+        op = tok.value
+        self.advance()
+
+        if op in ("where", "filter"):
+            return Where(tok, self.parse_expr())
+        if op == "project":
+            return Project(tok, self.parse_assignments())
+        if op == "extend":
+            return Extend(tok, self.parse_assignments())
+        if op in ("project-away", "project-keep", "project-reorder"):
+            columns = []
+            while True:
+                columns.append(self.parse_column_pattern())
+                if op == "project-reorder" and self.at_word("asc", "desc", "granny-asc", "granny-desc"):
+                    self.advance()
+                if not self.accept(","):
+                    break
+            return ProjectNames(tok, columns)
+        if op == "project-rename":
+            items = []
+            while True:
+                new_tok = self.expect_ident("a new column name")
+                self.expect("=", " in project-rename")
+                old_tok = self.expect_ident("an existing column name")
+                items.append((Name(new_tok, new_tok.value), Name(old_tok, old_tok.value)))
+                if not self.accept(","):
+                    break
+            return ProjectRename(tok, items)
+        if op == "summarize":
+            self.skip_hints()
+            aggregates: List[Assignment] = []
+            if not self.at_word("by"):
+                aggregates = self.parse_assignments()
+            by: List[Assignment] = []
+            if self.accept("by"):
+                by = self.parse_assignments()
+            if not aggregates and not by:
+                self.error("'summarize' requires at least one aggregation or 'by' clause.", tok)
+            return Summarize(tok, aggregates, by)
+        if op in ("join", "lookup"):
+            return self.parse_join(tok)
+        if op == "union":
+            legs, with_source = self.parse_union_args()
+            return UnionOperator(tok, legs, with_source)
+        if op in ("take", "limit", "sample"):
+            return Take(tok, self.parse_expr())
+        if op in ("sort", "order"):
+            self.expect("by", f" after '{op}'")
+            keys, descending, nulls_first = self.parse_sort_keys()
+            return Sort(tok, keys, None, descending, nulls_first)
+        if op == "top":
+            count = self.parse_expr()
+            self.expect("by", " after 'top N'")
+            keys, descending, nulls_first = self.parse_sort_keys()
+            return Sort(tok, keys, count, descending, nulls_first)
+        if op == "distinct":
+            if self.accept("*"):
+                return Distinct(tok, [])
+            return Distinct(tok, [item.expr for item in self.parse_assignments()])
+        if op == "count":
+            return Count(tok)
+        if op in ("render", "mv-expand", "mv-apply", "parse", "parse-where", "parse-kv", "make-series",
+                  "evaluate", "invoke", "as", "serialize", "getschema", "top-nested", "top-hitters",
+                  "reduce", "fork", "facet", "partition", "scan", "consume", "sample-distinct", "search",
+                  "find", "project-smart"):
+            self.skip_balanced()
+            return OpaqueOperator(tok)
+        self.error(f"Unknown query operator '{op}'.", tok)
+
+    def parse_column_pattern(self) -> Name:
+        """A column name that may contain `*` wildcards, e.g. `timestamp*`."""
+        first = self.tok
+        if not (first.kind == "IDENT" or self.at("*", "OP") or self.at("[", "OP")):
+            self.error(f"Expected a column name but found {self.describe(first)}.")
+        if self.at("[", "OP"):
+            name_tok = self.expect_ident("a column name")
+            return Name(name_tok, name_tok.value)
+        name, end = "", first.pos
+        while (self.tok.kind == "IDENT" or self.at("*", "OP")) and self.tok.pos == end:
+            tok = self.advance()
+            name += tok.value
+            end = tok.pos + len(tok.value)
+        return Name(first, name)
+
+    def skip_hints(self) -> None:
+        while self.tok.kind == "IDENT" and self.tok.value.startswith("hint") and self.peek().value in (".", "="):
+            while not self.at("=", "OP"):
+                self.advance()
+            self.advance()
+            self.advance()
+
+    def parse_join(self, tok: Token) -> Join:
+        kind = "innerunique" if tok.value == "join" else "leftouter"
+        while self.tok.kind == "IDENT" and (self.tok.value in ("kind",) or self.tok.value.startswith("hint")):
+            if self.tok.value == "kind":
+                self.advance()
+                self.expect("=", " after 'kind'")
+                kind_tok = self.expect_ident("a join kind")
+                if kind_tok.value not in JOIN_KINDS:
+                    self.error(f"Unknown join kind '{kind_tok.value}'.", kind_tok)
+                kind = kind_tok.value
+            else:
+                self.skip_hints()
+        if self.accept("("):
+            right = self.parse_pipeline()
+            self.expect(")", " to close the join sub-query")
+        else:
+            name_tok = self.expect_ident("a table or sub-query on the right side of join")
+            right = Pipeline(TableSource(name_tok, name_tok.value))
+        self.expect("on", f" after the right side of {tok.value}")
+        keys: List[JoinKey] = []
+        while True:
+            first = self.parse_additive()
+            if self.accept("=="):
+                sides = dict([self._join_side(first), self._join_side(self.parse_additive())])
+                if set(sides) != {"$left", "$right"}:
+                    self.error("Join conditions must compare '$left.col == $right.col'.", first.token)
+                keys.append(JoinKey(sides["$left"], sides["$right"]))
+            elif isinstance(first, Name):
+                keys.append(JoinKey(first, first))
+            else:
+                self.error("Join keys must be column names or '$left.col == $right.col'.", first.token)
+            if not (self.accept(",") or self.accept("and")):
+                break
+        return Join(tok, kind, right, keys)
+
+    def _join_side(self, expr: Expr) -> Tuple[str, Name]:
+        if isinstance(expr, Member) and isinstance(expr.obj, Name) and expr.obj.name in ("$left", "$right"):
+            return expr.obj.name, Name(expr.token, expr.attr)
+        self.error("Join conditions must compare '$left.col == $right.col'.", expr.token)
+
+    def parse_assignments(self) -> List[Assignment]:
+        items: List[Assignment] = []
+        while True:
+            alias = None
+            if self.tok.kind == "IDENT" and self.peek().value == "=" and self.peek().kind == "OP":
+                alias = self.advance().value
+                self.advance()
+            elif self.at("[", "OP") and self.peek().kind == "STRING" and self.peek(2).value == "]" and self.peek(3).value == "=":
+                alias = self._bracketed_name().value
+                self.advance()
+            elif self.at("(", "OP") and self._is_tuple_alias():
+                # (a, b) = arg_max(...) style multi-assignments.
+                self.advance()
+                names = []
+                while not self.at(")", "OP"):
+                    names.append(self.expect_ident("a column name").value)
+                    self.accept(",")
+                self.advance()
+                self.expect("=")
+                alias = ",".join(names)
+            items.append(Assignment(alias, self.parse_expr()))
+            if not self.accept(","):
+                break
+        return items
+
+    def _is_tuple_alias(self) -> bool:
+        j = self.i + 1
+        while j < len(self.tokens) and self.tokens[j].value != ")":
+            if self.tokens[j].kind not in ("IDENT",) and self.tokens[j].value != ",":
+                return False
+            j += 1
+        return j + 1 < len(self.tokens) and self.tokens[j + 1].value == "="
+
+    def parse_sort_keys(self) -> Tuple[List[Expr], List[bool], List[bool]]:
+        """Sort keys with their direction and null placement."""
+        keys, descending, nulls_first = [], [], []
+        while True:
+            keys.append(self.parse_expr())
+            desc = True
+            if self.at_word("asc", "desc"):
+                desc = self.tok.value == "desc"
+                self.advance()
+            first = not desc
+            if self.at_word("nulls"):
+                self.advance()
+                if not self.at_word("first", "last"):
+                    self.error("Expected 'first' or 'last' after 'nulls'.")
+                first = self.tok.value == "first"
+                self.advance()
+            descending.append(desc)
+            nulls_first.append(first)
+            if not self.accept(","):
+                break
+        return keys, descending, nulls_first
+
+    # -- expressions -------------------------------------------------------- #
+
+    def parse_expr(self) -> Expr:
+        return self.parse_or()
+
+    def parse_or(self) -> Expr:
+        left = self.parse_and()
+        while self.at_word("or"):
+            tok = self.advance()
+            left = Binary(tok, "or", left, self.parse_and())
+        return left
+
+    def parse_and(self) -> Expr:
+        left = self.parse_comparison()
+        while self.at_word("and"):
+            tok = self.advance()
+            left = Binary(tok, "and", left, self.parse_comparison())
+        return left
+
+    def parse_comparison(self) -> Expr:
+        left = self.parse_additive()
+        while True:
+            tok = self.tok
+            if tok.kind == "OP" and tok.value in COMPARISON_OPERATORS:
+                self.advance()
+                left = Binary(tok, tok.value, left, self.parse_additive())
+            elif tok.kind == "IDENT" and not tok.quoted and tok.value in STRING_OPERATORS:
+                self.advance()
+                op = tok.value
+                if op == "matches":
+                    self.expect("regex", " after 'matches'")
+                    op = "matches regex"
+                if op.lstrip("!").rstrip("~") in ("in", "has_any", "has_all"):
+                    right = self.parse_in_list()
+                elif op.lstrip("!") == "between":
+                    right = self.parse_between()
+                else:
+                    right = self.parse_additive()
+                left = Binary(tok, op, left, right)
+            else:
+                return left
+
+    def parse_in_list(self) -> Expr:
+        tok = self.expect("(", " to start the value list")
+        if self.tok.kind == "IDENT" and self.peek().value == "|":
+            pipeline = self.parse_pipeline()
+            self.expect(")", " to close the sub-query")
+            return SubQuery(tok, pipeline)
+        items = []
+        while not self.at(")", "OP"):
+            items.append(self.parse_expr())
+            if not self.accept(","):
+                break
+        self.expect(")", " to close the value list")
+        return ListExpr(tok, items)
+
+    def parse_between(self) -> Expr:
+        tok = self.expect("(", " after 'between'")
+        low = self.parse_additive()
+        self.expect("..", " in between range")
+        high = self.parse_additive()
+        self.expect(")", " to close the between range")
+        return ListExpr(tok, [low, high])
+
+    def parse_additive(self) -> Expr:
+        left = self.parse_multiplicative()
+        while self.tok.kind == "OP" and self.tok.value in ("+", "-"):
+            tok = self.advance()
+            left = Binary(tok, tok.value, left, self.parse_multiplicative())
+        return left
+
+    def parse_multiplicative(self) -> Expr:
+        left = self.parse_unary()
+        while self.tok.kind == "OP" and self.tok.value in ("*", "/", "%"):
+            tok = self.advance()
+            left = Binary(tok, tok.value, left, self.parse_unary())
+        return left
+
+    def parse_unary(self) -> Expr:
+        if self.tok.kind == "OP" and self.tok.value in ("-", "+", "!"):
+            tok = self.advance()
+            return Unary(tok, tok.value, self.parse_unary())
+        return self.parse_postfix()
+
+    def parse_postfix(self) -> Expr:
+        expr = self.parse_primary()
+        while True:
+            tok = self.tok
+            if tok.kind == "OP" and tok.value == "." and self.peek().kind == "IDENT":
+                self.advance()
+                attr = self.advance()
+                expr = Member(tok, expr, attr.value)
+            elif tok.kind == "OP" and tok.value == "[":
+                self.advance()
+                index = self.parse_expr()
+                self.expect("]", " to close the index")
+                expr = Index(tok, expr, index)
+            else:
+                return expr
+
+    def parse_primary(self) -> Expr:
+        tok = self.tok
+        if tok.kind == "STRING":
+            self.advance()
+            return Literal(tok, tok.value, "string")
+        if tok.kind == "NUMBER":
+            self.advance()
+            return Literal(tok, tok.value, "number")
+        if tok.kind == "TIMESPAN":
+            self.advance()
+            return Literal(tok, tok.value, "timespan")
+        if tok.kind == "RAW":
+            self.advance()
+            return Literal(tok, tok.value, "raw")
+        if tok.kind == "OP" and tok.value == "(":
+            self.advance()
+            inner = self.parse_expr()
+            self.expect(")", " to close the parenthesis")
+            return inner
+        if tok.kind == "OP" and tok.value == "*":
+            self.advance()
+            return Star(tok)
+        if tok.kind == "OP" and tok.value == "[":
+            if self.peek().kind == "STRING" and self.peek(2).value == "]":
+                name_tok = self._bracketed_name()
+                return Name(name_tok, name_tok.value)
+            self.advance()
+            items = []
+            while not self.at("]", "OP"):
+                items.append(self.parse_expr())
+                if not self.accept(","):
+                    break
+            self.expect("]", " to close the array")
+            return ListExpr(tok, items)
+        if tok.kind == "OP" and tok.value == "{":
+            # Property bags inside dynamic(...) are not analysed.
+            depth = 0
+            while self.tok.kind != "EOF":
+                if self.at("{", "OP"):
+                    depth += 1
+                elif self.at("}", "OP"):
+                    depth -= 1
+                    if depth == 0:
+                        self.advance()
+                        break
+                self.advance()
+            return Literal(tok, "{}", "dynamic")
+        if tok.kind == "IDENT":
+            self.advance()
+            if not tok.quoted and tok.value in BUILTIN_SCALARS and not self.at("(", "OP"):
+                return Literal(tok, tok.value, BUILTIN_SCALARS[tok.value])
+            if not tok.quoted and self.at("(", "OP"):
+                self.advance()
+                args = []
+                while not self.at(")", "OP"):
+                    if self.tok.kind == "IDENT" and self.peek().value == "|":
+                        arg_tok = self.tok
+                        args.append(SubQuery(arg_tok, self.parse_pipeline()))
+                    else:
+                        args.append(self.parse_expr())
+                    if not self.accept(","):
+                        break
+                self.expect(")", f" to close the call to '{tok.value}'")
+                return Call(tok, tok.value, args)
+            return Name(tok, tok.value)
+        self.error(f"Expected an expression but found {self.describe(tok)}.")
+
+
+@lru_cache(maxsize=512)
+def _parse_cached(query: str) -> Tuple[Optional[Query], Optional[KQLSyntaxError]]:
+    try:
+        return Parser(query).parse(), None
+    except KQLSyntaxError as e:
+        return None, e
+
+
+def parse_kql(query: str) -> Query:
+    """
+    Parses a KQL query into a Query AST.
+
+    Results (including syntax errors) are memoized by the query text, so the
+    validator, optimizer and retries never re-parse an identical candidate.
+    Callers must treat the returned AST as read-only.
+    """
+    ast, error = _parse_cached(query.strip())
+    if error is not None:
+        raise error
+    return ast
+
+
+# --------------------------------------------------------------------------- #
+# Rendering
+# --------------------------------------------------------------------------- #
+
+class KQLRenderError(ValueError):
+    """The expression holds parts the AST does not keep (sub-queries, property bags)."""
+
+
+_PRECEDENCE = {"or": 1, "and": 2, "+": 4, "-": 4, "*": 5, "/": 5, "%": 5}
+
+
+def _precedence(expr: Expr) -> int:
+    if isinstance(expr, Binary):
+        return _PRECEDENCE.get(expr.op, 3)
+    if isinstance(expr, Unary):
+        return 6
+    return 7
+
+
+def render_name(name: str) -> str:
+    """A column or table name, bracket-quoted when it is not a plain identifier."""
+    if name and _is_ident_start(name[0]) and all(_is_ident_char(ch) for ch in name[1:]):
+        return name
+    return "['" + name.replace("\\", "\\\\").replace("'", "\\'") + "']"
+
+
+def _render_literal(expr: Literal, query: str) -> str:
+    if expr.kind == "dynamic":
+        raise KQLRenderError("Property bag literals are not kept in the AST.")
+    if expr.kind != "string":
+        return expr.value
+    # Copy the literal from the query so its quotes, prefix and escapes survive.
+    start = expr.token.pos
+    if query[start:start + 1] in ("@", "h", "H"):
+        return query[start:start + len(expr.value) + 3]
+    return query[start:start + len(expr.value) + 2]
+
+
+def render_expr(expr: Expr, query: str) -> str:
+    """
+    Renders an expression back to KQL, adding only the parentheses that
+    precedence requires. query is the text the expression was parsed from;
+    string literals are copied from it verbatim. Raises KQLRenderError for
+    sub-queries and property bags.
+    """
+    if isinstance(expr, Name):
+        if expr.token.quoted:
+            return query[expr.token.pos:expr.token.pos + len(expr.name) + 4]
+        return expr.name
+    if isinstance(expr, Literal):
+        return _render_literal(expr, query)
+    if isinstance(expr, Star):
+        return "*"
+    if isinstance(expr, Call):
+        return f"{expr.func}({', '.join(render_expr(arg, query) for arg in expr.args)})"
+    if isinstance(expr, Member):
+        return f"{_render_operand(expr.obj, 7, query)}.{expr.attr}"
+    if isinstance(expr, Index):
+        return f"{_render_operand(expr.obj, 7, query)}[{render_expr(expr.index, query)}]"
+    if isinstance(expr, ListExpr):
+        items = ", ".join(render_expr(item, query) for item in expr.items)
+        return f"[{items}]" if expr.token.value == "[" else f"({items})"
+    if isinstance(expr, Unary):
+        return f"{expr.op}{_render_operand(expr.operand, 6, query)}"
+    if isinstance(expr, Binary):
+        precedence = _precedence(expr)
+        left = _render_operand(expr.left, precedence, query)
+        if expr.op.lstrip("!") == "between" and isinstance(expr.right, ListExpr):
+            low, high = (render_expr(item, query) for item in expr.right.items)
+            return f"{left} {expr.op} ({low} .. {high})"
+        if isinstance(expr.right, ListExpr) and expr.op.lstrip("!").rstrip("~") in ("in", "has_any", "has_all"):
+            items = ", ".join(render_expr(item, query) for item in expr.right.items)
+            return f"{left} {expr.op} ({items})"
+        return f"{left} {expr.op} {_render_operand(expr.right, precedence + 1, query)}"
+    raise KQLRenderError(f"Cannot render {type(expr).__name__} expressions.")
+
+
+def _render_operand(expr: Expr, min_precedence: int, query: str) -> str:
+    text = render_expr(expr, query)
+    return f"({text})" if _precedence(expr) < min_precedence else text
+
+
+# --------------------------------------------------------------------------- #
+# Semantic analysis
+# --------------------------------------------------------------------------- #
+
+Scope = Optional[Dict[str, str]]  # column -> type; None once columns are unknown
+
+
+class SchemaChecker:
+    """Resolves tables and columns of a parsed query against a schema catalog."""
+
+    def __init__(self, schemas: Mapping[str, Sequence[Tuple[str, str]]]):
+        self.schemas = schemas
+        self.tabular_lets: Dict[str, Scope] = {}
+        self.scalar_lets: Set[str] = set()
+        self.tables_referenced: List[str] = []
+
+    def table_columns(self, name: str) -> Scope:
+        columns: Dict[str, str] = {}
+        for column, col_type in self.schemas[name]:
+            columns.setdefault(column, col_type)
+        return columns
+
+    def check_query(self, query: Query) -> None:
+        for let in query.lets:
+            if isinstance(let.value, Pipeline):
+                self.tabular_lets[let.name] = self.check_pipeline(let.value)
+            else:
+                if isinstance(let.value, Expr):
+                    self.check_expr(let.value, None)
+                self.scalar_lets.add(let.name)
+        if query.body is not None:
+            self.check_pipeline(query.body)
+
+    def check_source(self, source: Source) -> Scope:
+        if isinstance(source, TableSource):
+            if source.name in self.tabular_lets:
+                return self.tabular_lets[source.name]
+            if "*" in source.name:
+                matches = [t for t in self.schemas if fnmatch.fnmatchcase(t, source.name)]
+                if not matches:
+                    self.fail(f"No table matches the pattern '{source.name}'.", source.token)
+                self.tables_referenced.extend(matches)
+                return self.merge_scopes([self.table_columns(t) for t in matches])
+            if source.name not in self.schemas:
+                self.fail(
+                    f"Table '{source.name}' does not exist.{self.suggest(source.name, self.schemas)}"
+                    f"{self.listing('tables', list(self.schemas))}",
+                    source.token,
+                )
+            self.tables_referenced.append(source.name)
+            return self.table_columns(source.name)
+        if isinstance(source, UnionSource):
+            scope = self.merge_scopes([self.check_pipeline(leg) for leg in source.legs])
+            if scope is not None and source.with_source:
+                scope[source.with_source] = "string"
+            return scope
+        if isinstance(source, DatatableSource):
+            return dict(source.columns)
+        return None
+
+    @staticmethod
+    def merge_scopes(scopes: List[Scope]) -> Scope:
+        if any(scope is None for scope in scopes):
+            return None
+        merged: Dict[str, str] = {}
+        for scope in scopes:
+            for column, col_type in scope.items():
+                merged.setdefault(column, col_type)
+        return merged
+
+    def check_pipeline(self, pipeline: Pipeline) -> Scope:
+        scope = self.check_source(pipeline.source)
+        for op in pipeline.operators:
+            scope = self.check_operator(op, scope)
+        return scope
+
+    def check_operator(self, op: Operator, scope: Scope) -> Scope:
+        if isinstance(op, Where):
+            self.check_expr(op.predicate, scope)
+            return scope
+        if isinstance(op, Extend):
+            new_scope = dict(scope) if scope is not None else None
+            for item in op.items:
+                # Columns introduced earlier in the same extend are visible to later items.
+                self.check_expr(item.expr, new_scope)
+                if new_scope is not None:
+                    for name in self.output_names(item, len(new_scope)):
+                        new_scope[name] = self.expr_type(item.expr, new_scope)
+            return new_scope
+        if isinstance(op, Project):
+            projected: Dict[str, str] = {}
+            for n, item in enumerate(op.items, 1):
+                self.check_expr(item.expr, scope)
+                for name in self.output_names(item, n):
+                    projected[name] = self.expr_type(item.expr, scope)
+            return projected if scope is not None else None
+        if isinstance(op, ProjectNames):
+            if scope is None:
+                return None
+            selected: List[str] = []
+            for col in op.columns:
+                if "*" in col.name:
+                    selected.extend(c for c in scope if fnmatch.fnmatchcase(c, col.name))
+                else:
+                    self.require_column(col, scope)
+                    selected.append(col.name)
+            if op.name == "project-away":
+                return {c: t for c, t in scope.items() if c not in selected}
+            if op.name == "project-keep":
+                return {c: t for c, t in scope.items() if c in selected}
+            return scope
+        if isinstance(op, ProjectRename):
+            if scope is None:
+                return None
+            renamed = dict(scope)
+            for new, old in op.items:
+                self.require_column(old, scope)
+                renamed[new.name] = renamed.pop(old.name)
+            return renamed
+        if isinstance(op, Summarize):
+            result: Dict[str, str] = {}
+            for n, item in enumerate(op.by, 1):
+                self.check_expr(item.expr, scope)
+                for name in self.output_names(item, n):
+                    result[name] = self.expr_type(item.expr, scope)
+            for n, item in enumerate(op.aggregates, 1):
+                self.check_expr(item.expr, scope, aggregate=True)
+                for name in self.output_names(item, n):
+                    result[name] = self.expr_type(item.expr, scope)
+            return result if scope is not None else None
+        if isinstance(op, Join):
+            right_scope = self.check_pipeline(op.right)
+            for key in op.on:
+                if scope is not None:
+                    self.require_column(key.left, scope, side="left side of the join")
+                if right_scope is not None:
+                    self.require_column(key.right, right_scope, side="right side of the join")
+            if scope is None or right_scope is None:
+                return None
+            if op.kind in ("leftsemi", "leftanti", "leftantisemi"):
+                return scope
+            if op.kind in ("rightsemi", "rightanti", "rightantisemi"):
+                return right_scope
+            joined = dict(scope)
+            for column, col_type in right_scope.items():
+                joined[column if column not in joined else f"{column}1"] = col_type
+            return joined
+        if isinstance(op, UnionOperator):
+            scopes = [scope] + [self.check_pipeline(leg) for leg in op.legs]
+            merged = self.merge_scopes(scopes)
+            if merged is not None and op.with_source:
+                merged[op.with_source] = "string"
+            return merged
+        if isinstance(op, Take):
+            self.check_expr(op.count, scope)
+            return scope
+        if isinstance(op, Sort):
+            if op.count is not None:
+                self.check_expr(op.count, scope)
+            for key in op.by:
+                self.check_expr(key, scope)
+            return scope
+        if isinstance(op, Distinct):
+            if not op.columns:
+                return scope
+            for col in op.columns:
+                self.check_expr(col, scope)
+            if scope is None:
+                return None
+            return {c.name: scope.get(c.name, "dynamic") for c in op.columns if isinstance(c, Name)}
+        if isinstance(op, Count):
+            return {"Count": "long"}
+        return None
+
+    @staticmethod
+    def output_names(item: Assignment, position: int) -> List[str]:
+        if item.alias:
+            return item.alias.split(",")
+        expr = item.expr
+        if isinstance(expr, Name):
+            return [expr.name]
+        if isinstance(expr, Call):
+            func = expr.func
+            if func == "bin" and expr.args and isinstance(expr.args[0], Name):
+                return [expr.args[0].name]
+            if func in AGGREGATE_FUNCTIONS:
+                if expr.args and isinstance(expr.args[0], Name):
+                    return [f"{func}_{expr.args[0].name}"]
+                return [f"{func}_"]
+        if isinstance(expr, Member) and isinstance(expr.obj, Name):
+            return [f"{expr.obj.name}_{expr.attr}"]
+        return [f"Column{position}"]
+
+    @staticmethod
+    def expr_type(expr: Expr, scope: Scope) -> str:
+        if isinstance(expr, Name) and scope is not None:
+            return scope.get(expr.name, "dynamic")
+        if isinstance(expr, Call) and expr.func in ("count", "dcount", "countif", "dcountif"):
+            return "long"
+        if isinstance(expr, Literal):
+            return {"number": "long", "timespan": "timespan", "string": "string"}.get(expr.kind, "dynamic")
+        return "dynamic"
+
+    def check_expr(self, expr: Expr, scope: Scope, aggregate: bool = False) -> None:
+        if isinstance(expr, Name):
+            if expr.name in self.scalar_lets or expr.name in self.tabular_lets:
+                return
+            if scope is not None:
+                self.require_column(expr, scope)
+        elif isinstance(expr, Call):
+            for arg in expr.args:
+                self.check_expr(arg, scope)
+        elif isinstance(expr, Binary):
+            self.check_expr(expr.left, scope)
+            self.check_expr(expr.right, scope)
+        elif isinstance(expr, Unary):
+            self.check_expr(expr.operand, scope)
+        elif isinstance(expr, Member):
+            if isinstance(expr.obj, Name) and expr.obj.name.startswith("$"):
+                return
+            self.check_expr(expr.obj, scope)
+        elif isinstance(expr, Index):
+            self.check_expr(expr.obj, scope)
+            self.check_expr(expr.index, scope)
+        elif isinstance(expr, ListExpr):
+            for item in expr.items:
+                self.check_expr(item, scope)
+        elif isinstance(expr, SubQuery):
+            self.check_pipeline(expr.pipeline)
+
+    def require_column(self, col: Name, scope: Scope, side: str = "") -> None:
+        if scope is None or col.name in scope:
+            return
+        where = f" on the {side}" if side else ""
+        self.fail(
+            f"Column '{col.name}' does not exist{where}.{self.suggest(col.name, scope)}"
+            f"{self.listing('columns', list(scope))}",
+            col.token,
+        )
+
+    # Catalogs larger than this are not spelled out in error messages.
+    MAX_LISTED_NAMES = 40
+
+    def listing(self, what: str, names: List[str]) -> str:
+        if not names:
+            return f" Available {what}: none."
+        if len(names) > self.MAX_LISTED_NAMES:
+            return ""
+        return f" Available {what}: {', '.join(names)}."
+
+    @staticmethod
+    def suggest(name: str, candidates) -> str:
+        by_lower = {c.lower(): c for c in candidates}
+        if name.lower() in by_lower:
+            return f" Did you mean '{by_lower[name.lower()]}'? (names are case-sensitive)"
+        close = difflib.get_close_matches(name.lower(), list(by_lower), n=1, cutoff=0.6)
+        return f" Did you mean '{by_lower[close[0]]}'?" if close else ""
+
+    @staticmethod
+    def fail(message: str, tok: Token):
+        raise KQLSemanticError(message, tok.line, tok.column)
+
+
+def validate_kql(
+    kql_query: str,
+    shortlisted_tables: Optional[Sequence[str]] = None,
+    schemas: Optional[Mapping[str, Sequence[Tuple[str, str]]]] = None,
+) -> dict:
+    """
+    Validates a KQL query locally.
+
+    Returns a dict with "is_valid", "error" (formatted with line/column and a
+    caret excerpt, or None), "line" and "column" (0 when valid) and
+    "tables" (the tables the query reads).
+    """
+    schemas = get_registry() if schemas is None else schemas
+    query_text = kql_query.strip()
+    result = {"is_valid": True, "error": None, "line": 0, "column": 0, "tables": []}
+    try:
+        ast = parse_kql(query_text)
+        checker = SchemaChecker(schemas)
+        checker.check_query(ast)
+        result["tables"] = list(dict.fromkeys(checker.tables_referenced))
+        if shortlisted_tables and not set(result["tables"]) & set(shortlisted_tables):
+            tok = ast.body.source.token if ast.body is not None else Token("EOF", "", 0, 1, 1)
+            raise KQLSemanticError(
+                "Query does not reference any of the shortlisted tables "
+                f"({', '.join(shortlisted_tables)}).",
+                tok.line, tok.column,
+            )
+    except KQLError as e:
+        result.update(is_valid=False, error=e.format(query_text), line=e.line, column=e.column)
+    return result
+
+
+# Leading words that start a statement rather than name a table.
+_STATEMENT_KEYWORDS = {
+    "let", "set", "union", "datatable", "print", "range", "search", "find", "evaluate",
+    "externaldata", "declare", "alias", "pattern", "restrict", "materialize", "view",
+}
+
+
+class IncrementalValidator:
+    """
+    Checks a KQL query while it is still being generated.
+
+    Text is fed in chunks. Once the leading table name is complete, and each
+    time a new top-level `|` arrives, the prefix before it is parsed and
+    checked against the schemas. Only semantic errors (unknown tables or
+    columns) abort: a prefix that fails to parse may still be completed into a
+    valid query, and the shortlist check needs the whole query. Anything
+    reported here is also reported by validate_kql for the finished query.
+    """
+
+    def __init__(self, schemas: Optional[Mapping[str, Sequence[Tuple[str, str]]]] = None):
+        self.schemas = get_registry() if schemas is None else schemas
+        self.text = ""
+        self.error: Optional[dict] = None
+        self._scan_pos = 0
+        self._depth = 0
+        self._quote: Optional[str] = None
+        self._in_comment = False
+        self._checked_first_word = False
+
+    def feed(self, chunk: str) -> Optional[dict]:
+        """Adds generated text; returns a validate_kql-style failure once the prefix cannot be valid."""
+        if self.error is not None:
+            return self.error
+        self.text += chunk
+        prefixes: List[str] = []
+        if not self._checked_first_word:
+            stripped = self.text.lstrip()
+            word_end = 0
+            while word_end < len(stripped) and _is_ident_char(stripped[word_end]):
+                word_end += 1
+            if word_end < len(stripped):
+                self._checked_first_word = True
+                word = stripped[:word_end]
+                if word and _is_ident_start(word[0]) and word not in _STATEMENT_KEYWORDS and stripped[word_end] in " \t\r\n|":
+                    prefixes.append(word)
+        prefixes.extend(self._scan_pipes())
+        for prefix in prefixes:
+            error = self._check(prefix)
+            if error is not None:
+                self.error = error
+                return error
+        return None
+
+    def _scan_pipes(self) -> List[str]:
+        """Prefixes ending at each new top-level pipe, tracking strings, comments and brackets across chunks."""
+        text, i, n = self.text, self._scan_pos, len(self.text)
+        prefixes = []
+        while i < n:
+            ch = text[i]
+            if self._in_comment:
+                if ch == "\n":
+                    self._in_comment = False
+            elif self._quote is not None:
+                if ch == "\\":
+                    if i + 1 >= n:
+                        break
+                    i += 1
+                elif ch == self._quote:
+                    self._quote = None
+            elif ch == "/":
+                if i + 1 >= n:
+                    break
+                if text[i + 1] == "/":
+                    self._in_comment = True
+                    i += 1
+            elif ch in "'\"":
+                self._quote = ch
+            elif ch in "([{":
+                self._depth += 1
+            elif ch in ")]}":
+                self._depth = max(self._depth - 1, 0)
+            elif ch == "|" and self._depth == 0:
+                prefixes.append(text[:i])
+            i += 1
+        self._scan_pos = i
+        return prefixes
+
+    def _check(self, prefix: str) -> Optional[dict]:
+        query_text = prefix.strip()
+        try:
+            SchemaChecker(self.schemas).check_query(parse_kql(query_text))
+        except KQLSemanticError as e:
+            return {"is_valid": False, "error": e.format(query_text), "line": e.line, "column": e.column, "tables": []}
+        except KQLSyntaxError:
+            return None
+        return None
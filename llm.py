@@ -1,10 +1,539 @@
+"""
+Chat model construction and scheduling.
+
+Providers are registered by name and looked up on first use, so importing
+this module imports no provider SDK and needs no credentials. The provider is
+chosen with NL2KQL_LLM_PROVIDER (default "google") and the model with
+NL2KQL_LLM_MODEL (default: the provider's own).
+
+Every model returned by get_llm goes through one process-wide LLMScheduler:
+token buckets for requests and tokens per minute (NL2KQL_LLM_RPM,
+NL2KQL_LLM_TPM), priority order when they run short (interactive before batch,
+first-pass generation before reflection), and jittered exponential backoff on
+429 and 5xx errors. Clients that differ only in temperature share one
+underlying connection.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from functools import lru_cache
-from langchain_google_genai import ChatGoogleGenerativeAI
-from .config import GOOGLE_API_KEY
+from typing import Any, Awaitable, Callable, Dict, Generator, Iterator, List, Optional, Tuple, TypeVar
+
+from langchain_core.messages.ai import add_usage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import Runnable
+
+from .config import get_setting, require_google_api_key
+from .instrumentation import LLM_QUEUE_SECONDS, LLM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# (model, temperature) -> chat model
+ProviderFactory = Callable[[str, float], object]
+
+DEFAULT_PROVIDER = "google"
+
+_providers: Dict[str, Tuple[ProviderFactory, str]] = {}
+
+# When set, get_llm returns factory(model, temperature) whatever the provider;
+# used by the offline benchmark to plug in fake_llm.FakeChatModel.
+_llm_factory: Optional[ProviderFactory] = None
+
+
+def register_provider(name: str, factory: ProviderFactory, default_model: str) -> None:
+    """Makes factory available as NL2KQL_LLM_PROVIDER=name. The factory should import its SDK lazily."""
+    _providers[name] = (factory, default_model)
+    _base_client.cache_clear()
+    _client.cache_clear()
+
+
+def set_llm_factory(factory: Optional[ProviderFactory]) -> None:
+    """Overrides the chat model returned by get_llm for models resolved afterwards; None restores the provider."""
+    global _llm_factory
+    _llm_factory = factory
+
+
+def _google(model: str, temperature: float):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=model, temperature=temperature, google_api_key=require_google_api_key())
+
+
+def _fake(model: str, temperature: float):
+    from .fake_llm import FakeChatModel
+    return FakeChatModel()
+
+
+@lru_cache(maxsize=None)
+def _base_client(provider: str, model: Optional[str]):
+    if provider not in _providers:
+        raise ValueError(f"Unknown LLM provider '{provider}'. Registered providers: {', '.join(sorted(_providers))}.")
+    factory, default_model = _providers[provider]
+    model = model or get_setting("NL2KQL_LLM_MODEL") or default_model
+    logger.info("--- Initializing %s LLM %s ---", provider, model)
+    return factory(model, 0.0)
+
+
+@lru_cache(maxsize=32)
+def _client(provider: str, model: Optional[str], temperature: float):
+    # Temperature variants are shallow copies, so they reuse the base client's connection.
+    base = _base_client(provider, model)
+    if getattr(base, "temperature", temperature) == temperature or not hasattr(base, "model_copy"):
+        return base
+    return base.model_copy(update={"temperature": temperature})
+
+
+register_provider("google", _google, "gemini-pro")
+register_provider("fake", _fake, "fake")
+
+
+# -- scheduling ---------------------------------------------------------- #
+
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+CALL_KINDS = {"generation": 0, "reflection": 1}
+
+_priority_class: ContextVar[str] = ContextVar("nl2kql_priority_class", default="interactive")
+
+# HTTP statuses worth retrying; 429 also pauses every caller of the scheduler.
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+_RATE_LIMIT_NAMES = ("RateLimit", "ResourceExhausted", "TooManyRequests")
+_TRANSIENT_NAMES = _RATE_LIMIT_NAMES + ("ServiceUnavailable", "DeadlineExceeded", "InternalServerError")
+
+
+def set_priority_class(name: str):
+    """Schedules LLM calls in the current context (and tasks it spawns) as `name`; returns the ContextVar token."""
+    if name not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class '{name}'. Use one of: {', '.join(PRIORITY_CLASSES)}.")
+    return _priority_class.set(name)
+
+
+@contextmanager
+def priority_class(name: str) -> Iterator[None]:
+    """Context manager form of set_priority_class."""
+    token = set_priority_class(name)
+    try:
+        yield
+    finally:
+        _priority_class.reset(token)
+
+
+def _status_code(error: BaseException) -> Optional[int]:
+    for source in (error, getattr(error, "response", None)):
+        for attribute in ("status_code", "code", "http_status"):
+            value = getattr(source, attribute, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    code = _status_code(error)
+    if code is not None:
+        return code == 429
+    return any(name in type(error).__name__ for name in _RATE_LIMIT_NAMES)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """True for rate limits, timeouts and 5xx errors, recognised by status code or exception name."""
+    code = _status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    return any(name in type(error).__name__ for name in _TRANSIENT_NAMES)
+
+
+class TokenBucket:
+    """Refills continuously at rate_per_minute, up to capacity (default: one minute's worth)."""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute must be positive.")
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else float(rate_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount is available (amounts above capacity wait for a full bucket)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.level -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Charges (or refunds, if negative) amount after the fact; the level may go below zero."""
+        self.level = min(self.capacity, self.level - amount)
+
+
+@dataclass(order=True)
+class _Ticket:
+    priority: Tuple[int, int]
+    seq: int
+    requests: int = field(default=1, compare=False)
+    tokens: float = field(default=0.0, compare=False)
+
+
+class LLMScheduler:
+    """
+    Admission control and retries for LLM calls, shared by every model from get_llm.
+
+    A call may start once the buckets hold enough for it and for every
+    higher-priority (or earlier, equal-priority) call still waiting, so
+    priority only matters while a limit is binding.
+
+    Attributes:
+        requests_per_minute (int): Request budget; None for unlimited.
+        tokens_per_minute (int): Prompt + completion token budget; None for unlimited.
+        max_retries (int): Retries of a retryable failure before it is raised.
+        base_delay (float): First backoff ceiling in seconds; doubles per attempt up to max_delay.
+        expected_output_tokens (int): Completion size charged up front, corrected from usage afterwards.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                 max_retries: int = 4, base_delay: float = 0.5, max_delay: float = 30.0,
+                 expected_output_tokens: int = 256, seed: Optional[int] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.expected_output_tokens = expected_output_tokens
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._waiting: List[_Ticket] = []
+        self._condition = threading.Condition()
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._rng = random.Random(seed)
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "queued_seconds": 0.0}
+
+    # -- admission ---------------------------------------------------------- #
+
+    def ticket(self, kind: str, messages: Any) -> _Ticket:
+        """A queue entry for one call, prioritised by the context's class and the call kind."""
+        try:
+            prompt_tokens = count_tokens_approximately(messages) if isinstance(messages, list) else len(str(messages)) // 4
+        except Exception:
+            prompt_tokens = len(str(messages)) // 4
+        priority = (PRIORITY_CLASSES[_priority_class.get()], CALL_KINDS.get(kind, 0))
+        return _Ticket(priority, next(self._seq), 1, prompt_tokens + self.expected_output_tokens)
+
+    def _try_acquire(self, ticket: _Ticket) -> float:
+        """Takes capacity for ticket and returns 0.0, or returns how long to wait. Caller holds the lock."""
+        now = time.monotonic()
+        wait = max(0.0, self._paused_until - now)
+        ahead = [t for t in self._waiting if t < ticket]
+        if self._request_bucket is not None:
+            wait = max(wait, self._request_bucket.wait_time(len(ahead) + 1, now))
+        if self._token_bucket is not None:
+            wait = max(wait, self._token_bucket.wait_time(sum(t.tokens for t in ahead) + ticket.tokens, now))
+        if wait > 0:
+            return wait
+        if self._request_bucket is not None:
+            self._request_bucket.take(ticket.requests, now)
+        if self._token_bucket is not None:
+            self._token_bucket.take(ticket.tokens, now)
+        return 0.0
+
+    def _enqueue(self, ticket: _Ticket) -> None:
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+
+    def _leave(self, ticket: _Ticket) -> None:
+        with self._condition:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._condition.notify_all()
+
+    def _admitted(self, ticket: _Ticket, start: float) -> None:
+        waited = time.monotonic() - start
+        self.stats["calls"] += 1
+        self.stats["queued_seconds"] += waited
+        kind = "reflection" if ticket.priority[1] == CALL_KINDS["reflection"] else "generation"
+        LLM_QUEUE_SECONDS.observe(waited, kind=kind)
+
+    def acquire(self, ticket: _Ticket) -> None:
+        """Blocks until ticket may start."""
+        start = time.monotonic()
+        self._enqueue(ticket)
+        try:
+            with self._condition:
+                while True:
+                    wait = self._try_acquire(ticket)
+                    if wait == 0.0:
+                        break
+                    self._condition.wait(min(wait, self.max_delay))
+        finally:
+            self._leave(ticket)
+        self._admitted(ticket, start)
+
+    async def aacquire(self, ticket: _Ticket) -> None:
+        """Async variant of acquire."""
+        start = time.monotonic()
+        self._enqueue(ticket)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_acquire(ticket)
+                if wait == 0.0:
+                    break
+                # Calls leaving the queue do not wake async waiters, so re-check regularly.
+                await asyncio.sleep(min(wait, self.POLL_INTERVAL) if len(self._waiting) > 1 else wait)
+        finally:
+            self._leave(ticket)
+        self._admitted(ticket, start)
+
+    def settle(self, ticket: _Ticket, usage: Optional[dict]) -> None:
+        """Corrects the token charge with the usage_metadata the provider reported."""
+        if self._token_bucket is None or not usage:
+            return
+        actual = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+        with self._condition:
+            self._token_bucket.adjust(actual - ticket.tokens)
+
+    # -- retries ------------------------------------------------------------ #
+
+    def backoff(self, error: BaseException, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying, or None when error should be raised."""
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        retry_after = getattr(error, "retry_after", None)
+        if isinstance(retry_after, (int, float)) and retry_after > 0:
+            delay = min(float(retry_after), self.max_delay)
+        else:
+            # Full jitter: uniform over [0, min(max_delay, base * 2**attempt)].
+            delay = self._rng.uniform(0.0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        self.stats["retries"] += 1
+        rate_limited = is_rate_limit(error)
+        LLM_RETRIES.inc(reason="rate_limit" if rate_limited else "transient")
+        if rate_limited:
+            self.stats["rate_limited"] += 1
+            with self._condition:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning("LLM call failed (%s); retry %d/%d in %.2fs", type(error).__name__, attempt + 1,
+                       self.max_retries, delay)
+        return delay
+
+    def run(self, kind: str, messages: Any, call: Callable[[], Any]) -> Any:
+        """Runs call() once admitted, retrying transient failures."""
+        for attempt in itertools.count():
+            ticket = self.ticket(kind, messages)
+            self.acquire(ticket)
+            try:
+                response = call()
+            except Exception as e:
+                delay = self.backoff(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.settle(ticket, getattr(response, "usage_metadata", None))
+            return response
+
+    async def arun(self, kind: str, messages: Any, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Async variant of run."""
+        for attempt in itertools.count():
+            ticket = self.ticket(kind, messages)
+            await self.aacquire(ticket)
+            try:
+                response = await call()
+            except Exception as e:
+                delay = self.backoff(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.settle(ticket, getattr(response, "usage_metadata", None))
+            return response
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> LLMScheduler:
+    """The process-wide scheduler, configured from NL2KQL_LLM_RPM / NL2KQL_LLM_TPM on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            rpm = get_setting("NL2KQL_LLM_RPM")
+            tpm = get_setting("NL2KQL_LLM_TPM")
+            _scheduler = LLMScheduler(int(rpm) if rpm else None, int(tpm) if tpm else None)
+        return _scheduler
+
+
+def set_scheduler(scheduler: Optional[LLMScheduler]) -> None:
+    """Replaces the shared scheduler for models resolved afterwards; None rebuilds it from settings."""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+
+
+def _add_usage(usage: Optional[dict], chunk: Any) -> Optional[dict]:
+    # Streamed chunks carry partial usage_metadata (often only the last one does); it adds up.
+    chunk_usage = getattr(chunk, "usage_metadata", None)
+    return add_usage(usage, chunk_usage) if chunk_usage else usage
+
+
+class ScheduledLLM(Runnable):
+    """A chat model whose calls are admitted, prioritised and retried by an LLMScheduler."""
+
+    def __init__(self, model, scheduler: LLMScheduler, kind: str = "generation"):
+        super().__init__()
+        self.model = model
+        self.scheduler = scheduler
+        self.kind = kind
+
+    def invoke(self, input, config=None, **kwargs):
+        return self.scheduler.run(self.kind, input, lambda: self.model.invoke(input, config, **kwargs))
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        return await self.scheduler.arun(self.kind, input, lambda: self.model.ainvoke(input, config, **kwargs))
+
+    def stream(self, input, config=None, **kwargs):
+        # Retried only until the first chunk arrives; later failures are raised.
+        # The usage reported by the chunks settles the charge, even when the
+        # caller stops reading early.
+        for attempt in itertools.count():
+            ticket = self.scheduler.ticket(self.kind, input)
+            self.scheduler.acquire(ticket)
+            chunks = self.model.stream(input, config, **kwargs)
+            usage = None
+            try:
+                try:
+                    first = next(chunks)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    delay = self.scheduler.backoff(e, attempt)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                usage = _add_usage(usage, first)
+                yield first
+                for chunk in chunks:
+                    usage = _add_usage(usage, chunk)
+                    yield chunk
+                return
+            finally:
+                chunks.close()
+                self.scheduler.settle(ticket, usage)
+
+    async def astream(self, input, config=None, **kwargs):
+        for attempt in itertools.count():
+            ticket = self.scheduler.ticket(self.kind, input)
+            await self.scheduler.aacquire(ticket)
+            chunks = self.model.astream(input, config, **kwargs)
+            usage = None
+            try:
+                try:
+                    first = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    delay = self.scheduler.backoff(e, attempt)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                usage = _add_usage(usage, first)
+                yield first
+                async for chunk in chunks:
+                    usage = _add_usage(usage, chunk)
+                    yield chunk
+                return
+            finally:
+                await chunks.aclose()
+                self.scheduler.settle(ticket, usage)
+
+
+def get_llm(model: Optional[str] = None, temperature: float = 0.0, provider: Optional[str] = None,
+            kind: str = "generation"):
+    """
+    The chat model for provider, model and temperature, wrapped in the shared
+    scheduler. kind ("generation" or "reflection") sets its priority.
+    """
+    if _llm_factory is not None:
+        raw = _llm_factory(model, temperature)
+    else:
+        raw = _client(provider or get_setting("NL2KQL_LLM_PROVIDER") or DEFAULT_PROVIDER, model, temperature)
+    return ScheduledLLM(raw, get_scheduler(), kind)
+
+
+class LazyLLM:
+    """
+    Node attribute that resolves get_llm(temperature=..., kind=...) on first
+    access, so building a graph imports no provider SDK and checks no
+    credentials. It can be assigned like a plain attribute.
+    """
+
+    def __init__(self, temperature: float = 0.0, kind: str = "generation"):
+        self.temperature = temperature
+        self.kind = kind
+
+    def __set_name__(self, owner, name: str) -> None:
+        self.attribute = f"_{name}"
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        model = instance.__dict__.get(self.attribute)
+        if model is None:
+            model = instance.__dict__[self.attribute] = get_llm(temperature=self.temperature, kind=self.kind)
+        return model
+
+    def __set__(self, instance, value) -> None:
+        instance.__dict__[self.attribute] = value
+
+
+def run_steps(steps: Generator[Any, Any, T], call: Callable[[Any], Any]) -> T:
+    """
+    Drives a node written as a generator: each request it yields goes to
+    call, and the result (or the exception call raised) is sent back until
+    the generator returns the node's update. A node's __call__ and acall then
+    share everything but the LLM call itself.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                response = call(request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
 
 
-@lru_cache(maxsize=3)
-def get_llm(model: str = "gemini-pro", temperature: float = 0.0):
-    """Singleton Gemini client; caching avoids multiple sockets."""
-    print(f"--- Initializing Gemini LLM (temperature={temperature}) ---")
-    return ChatGoogleGenerativeAI(model=model, temperature=temperature, google_api_key=GOOGLE_API_KEY)
+async def arun_steps(steps: Generator[Any, Any, T], call: Callable[[Any], Awaitable[Any]]) -> T:
+    """Async variant of run_steps; call returns an awaitable."""
+    try:
+        request = next(steps)
+        while True:
+            try:
+                response = await call(request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
@@ -0,0 +1,78 @@
+"""
+Prompt layout for provider-side prefix caching.
+
+Every LLM prompt is a static prefix (the instructions plus the pre-rendered
+schema blocks of a table set, in sorted order) followed by the chat history
+and a short per-request suffix. Requests on the same tables therefore share
+their leading tokens, which providers with prompt/context caching serve from
+cache. The prefix SystemMessage is built once per schema version and table
+set and memoized; the suffix is a plain str.format template, so nothing else
+is re-rendered per call.
+
+Cache hits are reported by the provider in usage_metadata
+(input_token_details.cache_read); LLMMetricsHandler turns them into the
+nl2kql_prompt_cache_total and cached-token metrics. FakeChatModel(prefix_cache=True)
+emulates such a provider offline.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Sequence
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from .instrumentation import METRICS
+from .schemas import get_registry
+
+PROMPT_PREFIXES = METRICS.counter(
+    "nl2kql_prompt_prefixes_total", "Prompt prefix lookups by prompt and result (memoized, rendered).", ["prompt", "result"]
+)
+
+
+class CachedPrompt:
+    """
+    A prompt split into a static, memoized prefix and a small dynamic suffix.
+
+    Attributes:
+        name (str): Label for metrics.
+        instructions (str): Static system text; used verbatim, never formatted.
+        suffix (str): str.format template for the closing HumanMessage.
+        schema_heading (str): Line placed before the schema blocks in the prefix.
+        max_prefixes (int): Rendered prefixes kept, least recently used dropped first.
+    """
+
+    def __init__(self, name: str, instructions: str, suffix: str, schema_heading: str = "Tables and their schemas:",
+                 max_prefixes: int = 256):
+        self.name = name
+        self.instructions = instructions.strip()
+        self.suffix = suffix.strip()
+        self.schema_heading = schema_heading
+        self.max_prefixes = max_prefixes
+        self._prefixes: "OrderedDict[tuple, SystemMessage]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefix(self, tables: Iterable[str]) -> SystemMessage:
+        """The system message for a table set; the same object for the same set, in any order."""
+        registry = get_registry()
+        table_set = tuple(sorted(set(tables)))
+        key = (registry.version, table_set)
+        with self._lock:
+            message = self._prefixes.get(key)
+            if message is not None:
+                self._prefixes.move_to_end(key)
+        if message is not None:
+            PROMPT_PREFIXES.inc(prompt=self.name, result="memoized")
+            return message
+        content = f"{self.instructions}\n\n{self.schema_heading}\n{registry.render_many(table_set)}"
+        message = SystemMessage(content=content)
+        with self._lock:
+            message = self._prefixes.setdefault(key, message)
+            while len(self._prefixes) > self.max_prefixes:
+                self._prefixes.popitem(last=False)
+        PROMPT_PREFIXES.inc(prompt=self.name, result="rendered")
+        return message
+
+    def format_messages(self, tables: Iterable[str], chat_history: Optional[Sequence[BaseMessage]] = None,
+                        **values) -> List[BaseMessage]:
+        """[prefix, *chat_history, suffix formatted with values]."""
+        return [self.prefix(tables), *(chat_history or ()), HumanMessage(content=self.suffix.format(**values))]
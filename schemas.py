@@ -1,4 +1,17 @@
-from typing import List, Tuple, Dict
+import csv
+import hashlib
+import json
+import logging
+import math
+import re
+import sys
+import threading
+from collections.abc import Mapping
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from .config import get_setting
+
+logger = logging.getLogger(__name__)
 
 # Define the schemas for the security log tables
 TABLE_SCHEMAS: Dict[str, List[Tuple[str, str]]] = {
@@ -46,17 +59,406 @@ TABLE_SCHEMAS: Dict[str, List[Tuple[str, str]]] = {
 
 ALL_TABLE_NAMES = list(TABLE_SCHEMAS.keys())
 
+# Words in a user query that point at a table regardless of any IoCs.
+TABLE_KEYWORDS: Dict[str, List[str]] = {
+    "PassiveDNS": ["dns", "domain", "domains", "resolve", "resolved", "resolution", "c2"],
+    "InboundBrowsing": ["inbound", "visitor", "visitors", "website", "web", "request", "requests"],
+    "ProcessEvents": ["process", "processes", "command", "commandline", "execution", "executed", "powershell", "malware", "hash"],
+    "Email": ["email", "emails", "mail", "phishing", "phish", "sender", "recipient", "attachment"],
+    "OutBoundBrowsing": ["outbound", "browsing", "browse", "visited", "url", "urls", "download", "downloaded"],
+    "FileCreationEvents": ["file", "files", "hash", "sha256", "filename", "dropped", "created", "malware"],
+    "Employees": ["employee", "employees", "user", "users", "staff", "role"],
+    "IAM": ["iam", "cloud", "resource", "permission", "permissions", "privilege", "role"],
+    "AuthenticationEvents": ["login", "logon", "logins", "authentication", "auth", "password", "brute", "credential", "credentials"],
+}
+
+# Reference tables: their rows describe entities (hosts, people, resolutions), not events.
+REFERENCE_TABLES = ("Employees", "PassiveDNS")
+
+
+
+# Terms too common to say anything about a table.
+_STOPWORDS = {
+    "a", "an", "and", "any", "all", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it",
+    "of", "on", "or", "show", "the", "to", "was", "were", "with", "find", "get", "list",
+}
+
+
+def _identifier_terms(name: str) -> List[str]:
+    """Splits snake_case / CamelCase identifiers into lowercase terms."""
+    spaced = re.sub(r"([a-z0-9])([A-Z])|([A-Z])([A-Z][a-z])", r"\1\3 \2\4", name)
+    terms = (_normalize_term(t) for t in re.split(r"[^A-Za-z0-9]+", spaced) if t and not t.isdigit())
+    return [t for t in terms if t not in _STOPWORDS]
+
+
+def _normalize_term(term: str) -> str:
+    term = term.lower()
+    # Cheap plural folding so "emails"/"email" and "processes"/"process" meet.
+    if len(term) > 4 and term.endswith("es") and term[-3] in "sx":
+        return term[:-2]
+    if len(term) > 3 and term.endswith("s") and not term.endswith(("ss", "us", "is")):
+        return term[:-1]
+    return term
+
+
+class TableSchema:
+    """One table: column names and types kept as parallel tuples of interned strings."""
+
+    __slots__ = ("name", "columns", "types", "keywords")
+
+    def __init__(self, name: str, columns: Sequence[str], types: Sequence[str], keywords: Sequence[str] = ()):
+        self.name = name
+        self.columns = tuple(sys.intern(c) for c in columns)
+        self.types = tuple(sys.intern(t) for t in types)
+        self.keywords = tuple(keywords)
+
+    def fields(self) -> List[Tuple[str, str]]:
+        return list(zip(self.columns, self.types))
+
+
+# Assumed for tables and columns a statistics file does not cover.
+DEFAULT_TABLE_ROWS = 10_000_000
+DEFAULT_RETENTION_DAYS = 30
+_TYPE_BYTES = {
+    "string": 32, "guid": 16, "dynamic": 64, "datetime": 8, "timespan": 8,
+    "int": 4, "long": 8, "real": 8, "double": 8, "decimal": 16, "bool": 1,
+}
+
+
+class TableStats:
+    """
+    Size statistics for one table, used by cost.py.
+
+    Attributes:
+        rows (int): Rows currently retained.
+        rows_per_day (float): Ingestion rate; a time filter scales scans by it.
+        avg_bytes (Dict[str, float]): Average stored bytes per value, by column.
+        cardinality (Dict[str, int]): Distinct values, by column.
+    """
+
+    __slots__ = ("rows", "rows_per_day", "avg_bytes", "cardinality")
+
+    def __init__(self, rows: int, rows_per_day: float, avg_bytes: Dict[str, float], cardinality: Dict[str, int]):
+        self.rows = rows
+        self.rows_per_day = rows_per_day
+        self.avg_bytes = avg_bytes
+        self.cardinality = cardinality
+
+    def distinct(self, column: str) -> int:
+        """Distinct values of a column; unknown columns are assumed to have sqrt(rows)."""
+        return max(1, self.cardinality.get(column) or int(math.sqrt(self.rows)))
+
+    def column_bytes(self, column: str) -> float:
+        return self.avg_bytes.get(column, _TYPE_BYTES["string"])
+
+
+# Which type a column listed twice keeps: the first of these it was given,
+# otherwise its first type.
+DUPLICATE_TYPE_PREFERENCE = ("string", "dynamic")
+
+
+def _type_rank(col_type: str) -> int:
+    return DUPLICATE_TYPE_PREFERENCE.index(col_type) if col_type in DUPLICATE_TYPE_PREFERENCE else len(DUPLICATE_TYPE_PREFERENCE)
+
+
+class SchemaRegistry(Mapping):
+    """
+    Catalog of table schemas.
+
+    Behaves as a read-only mapping of table name -> [(column, type), ...], so it
+    can be passed anywhere TABLE_SCHEMAS is accepted. When created from a file
+    the export is only read on first access. A column listed twice is kept
+    once, at its first position, with the type DUPLICATE_TYPE_PREFERENCE ranks
+    highest (string, so IoC and text operators keep working); every dropped
+    entry is logged and listed in duplicates as (table, column, dropped type).
+    Rendered schema blocks and the lexical table index are built once and
+    memoized.
+    """
+
+    def __init__(self, tables: Optional[Dict[str, Sequence[Tuple[str, str]]]] = None,
+                 keywords: Optional[Dict[str, Sequence[str]]] = None, path: Optional[str] = None,
+                 stats_path: Optional[str] = None):
+        self.path = path
+        self.stats_path = stats_path
+        self._raw_stats: Optional[Dict[str, dict]] = None
+        self._stats: Dict[str, TableStats] = {}
+        self._raw_tables = tables
+        self._raw_keywords = keywords or {}
+        self._tables: Optional[Dict[str, TableSchema]] = None
+        self._rendered: Dict[str, str] = {}
+        self._index: Optional[Dict[str, Dict[str, float]]] = None
+        self._idf: Dict[str, float] = {}
+        self._version: Optional[str] = None
+        self.duplicates: List[Tuple[str, str, str]] = []
+        self._lock = threading.RLock()
+
+    # -- loading ------------------------------------------------------------ #
+
+    @classmethod
+    def from_file(cls, path: str) -> "SchemaRegistry":
+        """Registry backed by a JSON or CSV schema export, loaded lazily."""
+        return cls(path=path)
+
+    def _ensure_loaded(self) -> Dict[str, TableSchema]:
+        if self._tables is None:
+            with self._lock:
+                if self._tables is None:
+                    if self.path:
+                        raw, keywords = _read_schema_file(self.path)
+                        keywords = {**keywords, **self._raw_keywords}
+                    else:
+                        raw, keywords = self._raw_tables or {}, self._raw_keywords
+                    self._tables = self._build(raw, keywords)
+        return self._tables
+
+    def _build(self, raw: Dict[str, Sequence[Tuple[str, str]]], keywords: Dict[str, Sequence[str]]) -> Dict[str, TableSchema]:
+        tables: Dict[str, TableSchema] = {}
+        for name, fields in raw.items():
+            columns: List[str] = []
+            types: List[str] = []
+            position: Dict[str, int] = {}
+            for column, col_type in fields:
+                col_type = col_type.lower()
+                i = position.get(column)
+                if i is None:
+                    position[column] = len(columns)
+                    columns.append(column)
+                    types.append(col_type)
+                    continue
+                if _type_rank(col_type) < _type_rank(types[i]):
+                    col_type, types[i] = types[i], col_type
+                self.duplicates.append((name, column, col_type))
+                if col_type == types[i]:
+                    logger.debug("Table %s lists column %s twice.", name, column)
+                else:
+                    logger.warning("Table %s lists column %s twice; keeping type %s, dropping %s.",
+                                   name, column, types[i], col_type)
+            tables[name] = TableSchema(name, columns, types, keywords.get(name, ()))
+        return tables
+
+    # -- Mapping interface -------------------------------------------------- #
+
+    def __getitem__(self, table: str) -> List[Tuple[str, str]]:
+        return self._ensure_loaded()[table].fields()
+
+    def __contains__(self, table: object) -> bool:
+        return table in self._ensure_loaded()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ensure_loaded())
+
+    def __len__(self) -> int:
+        return len(self._ensure_loaded())
+
+    def table(self, name: str) -> TableSchema:
+        return self._ensure_loaded()[name]
+
+    @property
+    def version(self) -> str:
+        """Changes whenever a table or column changes; used to invalidate cached KQL."""
+        if self._version is None:
+            digest = hashlib.sha1()
+            for name in sorted(self._ensure_loaded()):
+                table = self._tables[name]
+                digest.update(repr((name, table.columns, table.types)).encode())
+            self._version = digest.hexdigest()[:12]
+        return self._version
+
+    # -- statistics --------------------------------------------------------- #
+
+    def stats(self, table_name: str) -> TableStats:
+        """
+        Row count, ingestion rate and per-column size/cardinality of a table,
+        from stats_path when it covers the table, otherwise defaults derived
+        from the column types. Memoized.
+        """
+        stats = self._stats.get(table_name)
+        if stats is None:
+            with self._lock:
+                if self._raw_stats is None:
+                    self._raw_stats = _read_stats_file(self.stats_path) if self.stats_path else {}
+            raw = self._raw_stats.get(table_name, {})
+            columns = raw.get("columns", {})
+            rows = int(raw.get("rows", DEFAULT_TABLE_ROWS))
+            tables = self._ensure_loaded()
+            fields = tables[table_name].fields() if table_name in tables else []
+            avg_bytes = {column: _TYPE_BYTES.get(col_type, _TYPE_BYTES["string"]) for column, col_type in fields}
+            cardinality = {column: 2 for column, col_type in fields if col_type == "bool"}
+            cardinality.update({column: rows for column, col_type in fields if col_type == "datetime"})
+            for column, values in columns.items():
+                if "avg_bytes" in values:
+                    avg_bytes[column] = float(values["avg_bytes"])
+                if "cardinality" in values:
+                    cardinality[column] = int(values["cardinality"])
+            rows_per_day = float(raw.get("rows_per_day", rows / DEFAULT_RETENTION_DAYS))
+            stats = self._stats[table_name] = TableStats(rows, rows_per_day, avg_bytes, cardinality)
+        return stats
+
+    # -- rendering ---------------------------------------------------------- #
+
+    def render(self, table_name: str) -> str:
+        """The prompt block for one table, memoized."""
+        block = self._rendered.get(table_name)
+        if block is None:
+            tables = self._ensure_loaded()
+            if table_name in tables:
+                table = tables[table_name]
+                lines = [f"\nTable: {table_name}\nFields:\n"]
+                lines.extend(f"- {column} ({col_type})\n" for column, col_type in zip(table.columns, table.types))
+                block = "".join(lines)
+            else:
+                block = f"\nWarning: Schema for table '{table_name}' not found.\n"
+            self._rendered[table_name] = block
+        return block
+
+    def render_many(self, table_names: Iterable[str]) -> str:
+        return "".join(self.render(name) for name in table_names)
+
+    # -- lexical index ------------------------------------------------------ #
+
+    # Relative weight of a query term matching each part of a table's metadata.
+    NAME_WEIGHT = 3.0
+    KEYWORD_WEIGHT = 2.0
+    COLUMN_WEIGHT = 1.0
+
+    def _ensure_index(self) -> Dict[str, Dict[str, float]]:
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    index: Dict[str, Dict[str, float]] = {}
+
+                    def add(term: str, table: str, weight: float) -> None:
+                        postings = index.setdefault(term, {})
+                        postings[table] = max(postings.get(table, 0.0), weight)
+
+                    tables = self._ensure_loaded()
+                    for name, table in tables.items():
+                        for term in _identifier_terms(name):
+                            add(term, name, self.NAME_WEIGHT)
+                        for keyword in table.keywords:
+                            add(_normalize_term(keyword), name, self.KEYWORD_WEIGHT)
+                        for column in table.columns:
+                            for term in _identifier_terms(column):
+                                add(term, name, self.COLUMN_WEIGHT)
+                    n = max(len(tables), 1)
+                    self._idf = {term: math.log(1 + n / len(postings)) for term, postings in index.items()}
+                    self._index = index
+        return self._index
+
+    def score_tables(self, text: str) -> Dict[str, float]:
+        """Lexical relevance of every matching table to a free-text query."""
+        index = self._ensure_index()
+        scores: Dict[str, float] = {}
+        for term in {_normalize_term(t) for t in re.findall(r"[A-Za-z][A-Za-z0-9]*", text)}:
+            postings = index.get(term) if term not in _STOPWORDS else None
+            if not postings:
+                continue
+            idf = self._idf[term]
+            for table, weight in postings.items():
+                scores[table] = scores.get(table, 0.0) + weight * idf
+        return scores
+
+    def candidates(self, text: str, k: int = 10) -> List[str]:
+        """The top-k tables for a query, so prompts need not embed the whole catalog."""
+        scores = self.score_tables(text)
+        ranked = sorted(scores, key=lambda t: -scores[t])[:k]
+        if len(ranked) < k:
+            ranked.extend(t for t in self if t not in scores)
+        return ranked[:k]
+
+
+def _read_schema_file(path: str) -> Tuple[Dict[str, List[Tuple[str, str]]], Dict[str, List[str]]]:
+    """
+    Reads a schema export. Supported formats:
+    - CSV with table, column and type columns (Kusto-style TableName/ColumnName/ColumnType also accepted);
+    - JSON from `.show database schema as json`;
+    - JSON mapping of table -> [[column, type], ...] or {column: type};
+    - JSON list of {"name", "columns", "keywords"} objects.
+    """
+    tables: Dict[str, List[Tuple[str, str]]] = {}
+    keywords: Dict[str, List[str]] = {}
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                row = {k.strip().lower(): (v or "").strip() for k, v in row.items() if k}
+                table = row.get("table") or row.get("tablename")
+                column = row.get("column") or row.get("columnname")
+                col_type = row.get("type") or row.get("columntype") or "string"
+                if table and column:
+                    tables.setdefault(table, []).append((column, col_type))
+        return tables, keywords
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict) and "Databases" in data:
+        for database in data["Databases"].values():
+            for name, table in database.get("Tables", {}).items():
+                tables[name] = [
+                    (col["Name"], col.get("CslType") or col.get("Type", "string").split(".")[-1])
+                    for col in table.get("OrderedColumns", [])
+                ]
+    elif isinstance(data, dict):
+        for name, columns in data.items():
+            if isinstance(columns, dict):
+                tables[name] = list(columns.items())
+            else:
+                tables[name] = [tuple(col) for col in columns]
+    else:
+        for entry in data:
+            columns = entry.get("columns", [])
+            tables[entry["name"]] = [
+                (col["name"], col.get("type", "string")) if isinstance(col, dict) else tuple(col)
+                for col in columns
+            ]
+            if entry.get("keywords"):
+                keywords[entry["name"]] = list(entry["keywords"])
+    return tables, keywords
+
+
+def _read_stats_file(path: str) -> Dict[str, dict]:
+    """
+    Reads table statistics: JSON mapping table -> {"rows", "rows_per_day",
+    "columns": {column: {"cardinality", "avg_bytes"}}}, optionally under a
+    top-level "tables" key. Every field is optional.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("tables", data) if isinstance(data, dict) else {}
+
+
+_registry: Optional[SchemaRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> SchemaRegistry:
+    """
+    The process-wide schema registry. Loads NL2KQL_SCHEMA_PATH (JSON/CSV)
+    when set, otherwise the built-in TABLE_SCHEMAS, and table statistics
+    from NL2KQL_STATS_PATH (JSON) when set; both may also come from .env.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                path = get_setting("NL2KQL_SCHEMA_PATH")
+                stats_path = get_setting("NL2KQL_STATS_PATH")
+                if path:
+                    _registry = SchemaRegistry(keywords=TABLE_KEYWORDS, path=path, stats_path=stats_path)
+                else:
+                    _registry = SchemaRegistry(TABLE_SCHEMAS, keywords=TABLE_KEYWORDS, stats_path=stats_path)
+    return _registry
+
+
+def set_registry(registry: SchemaRegistry) -> None:
+    """Replaces the process-wide registry (e.g. with a workspace export)."""
+    global _registry
+    with _registry_lock:
+        _registry = registry
+
 
 def schema_as_string(table_names: List[str]) -> str:
     """
     Generates a string representation of the schema for given tables.
+    Table blocks are pre-rendered and memoized by the registry.
     """
-    schema_str = ""
-    for table_name in table_names:
-        if table_name in TABLE_SCHEMAS:
-            schema_str += f"\nTable: {table_name}\nFields:\n"
-            for field, f_type in TABLE_SCHEMAS[table_name]:
-                schema_str += f"- {field} ({f_type})\n"
-        else:
-            schema_str += f"\nWarning: Schema for table '{table_name}' not found.\n"
-    return schema_str
+    return get_registry().render_many(table_names)
@@ -0,0 +1,279 @@
+"""
+Long-running HTTP service around one warm, compiled graph.
+
+Identical hunts that arrive while one is already running share its result
+(single-flight), and at most max_workers pipelines run at once with at most
+max_queue more waiting; beyond that requests are rejected with 503.
+
+Usage:
+    python -m nl2kql_agent.service --port 8080 --workers 8 --max-queue 64 --cache
+    python -m nl2kql_agent.service --sample-data samples/   # dry-run queries on <Table>.csv files
+    NL2KQL_STATS_PATH=stats.json python -m nl2kql_agent.service --max-scan-gb 20   # reject expensive queries
+
+Endpoints:
+    POST /query    {"query": "..."} -> result fields, plus "coalesced"
+    GET  /healthz  liveness and queue depth
+    GET  /metrics  instrumentation.METRICS in Prometheus text format
+"""
+
+import argparse
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .cache import QueryCache
+from .cost import CostBudget, CostModel
+from .engine import DryRunPolicy, ExecutionEngine, SampleData
+from .graph import build_graph
+from .instrumentation import METRICS, configure_logging
+from .iocs import column_index
+from .kql_parser import parse_kql
+from .schemas import get_registry
+from .threat_intel_types import ThreatIntelState, initial_state
+
+logger = logging.getLogger(__name__)
+
+REQUESTS = METRICS.counter("nl2kql_service_requests_total", "Service requests by outcome.", ["outcome"])
+COALESCED = METRICS.counter("nl2kql_service_coalesced_total", "Requests answered by another request's pipeline run.")
+
+# State fields returned to clients; chat_history is internal.
+RESULT_FIELDS = (
+    "user_query", "enriched_query", "shortlisted_tables", "iocs", "kql_query", "optimizations",
+    "validation_status", "validation_error", "cost_estimate", "dry_run", "retries", "cache_hit",
+)
+
+
+class ServiceOverloaded(RuntimeError):
+    """The pipeline queue is full."""
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Runs fn once per key at a time; concurrent callers with the same key wait for that run."""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Returns (result, shared); shared is True when another caller's run produced it."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class QueryService:
+    """
+    Keeps one compiled graph warm and runs hunts on a bounded worker pool.
+
+    Attributes:
+        max_workers (int): Pipelines executing at once.
+        max_queue (int): Pipelines allowed to wait for a worker before new ones get ServiceOverloaded.
+        timeout (float): Seconds a request waits for its pipeline before giving up.
+    """
+
+    def __init__(self, app=None, cache: Optional[QueryCache] = None, max_workers: int = 8,
+                 max_queue: int = 64, timeout: Optional[float] = 120.0):
+        if max_workers < 1 or max_queue < 0:
+            raise ValueError("max_workers must be at least 1 and max_queue at least 0.")
+        self.app = app if app is not None else build_graph(cache=cache)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="nl2kql")
+        self._flight = SingleFlight()
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+    def warm_up(self) -> None:
+        """Builds the schema prompt blocks, table index and column index before the first request."""
+        registry = get_registry()
+        registry.render_many(registry)
+        registry.candidates("warm up", k=1)
+        column_index(registry)
+        parse_kql(f"{next(iter(registry))} | take 1")
+
+    @property
+    def pending(self) -> int:
+        """Pipelines running or waiting for a worker."""
+        return self._pending
+
+    @staticmethod
+    def flight_key(user_query: str) -> str:
+        # Whitespace only: IoC values can be case-sensitive.
+        return " ".join(user_query.split())
+
+    def _execute(self, user_query: str) -> ThreatIntelState:
+        with self._pending_lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise ServiceOverloaded(f"{self._pending} pipelines already running or queued.")
+            self._pending += 1
+        try:
+            future = self._pool.submit(self.app.invoke, initial_state(user_query))
+        except BaseException:
+            self._release()
+            raise
+        # The slot is held until the pipeline finishes, not until this request
+        # stops waiting, so timed-out pipelines still count against the limit.
+        future.add_done_callback(lambda _: self._release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()  # frees the slot at once if the pipeline never started
+            raise
+
+    def _release(self) -> None:
+        with self._pending_lock:
+            self._pending -= 1
+
+    def run(self, user_query: str) -> Tuple[ThreatIntelState, bool]:
+        """Returns (result, coalesced). Raises ServiceOverloaded or concurrent.futures.TimeoutError."""
+        result, shared = self._flight.do(self.flight_key(user_query), lambda: self._execute(user_query))
+        if shared:
+            COALESCED.inc()
+        return result, shared
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service: QueryService  # set on the subclass built by make_server
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def do_GET(self) -> None:
+        if self.path == "/healthz":
+            self._send_json(200, {"status": "ok", "pending": self.service.pending})
+        elif self.path == "/metrics":
+            self._send(200, METRICS.render_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}."})
+
+    def do_POST(self) -> None:
+        if self.path != "/query":
+            self._send_json(404, {"error": f"Unknown path {self.path}."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            user_query = json.loads(self.rfile.read(length) or b"{}").get("query", "")
+        except (ValueError, AttributeError):
+            REQUESTS.inc(outcome="bad_request")
+            self._send_json(400, {"error": 'Body must be a JSON object like {"query": "..."}.'})
+            return
+        if not isinstance(user_query, str) or not user_query.strip():
+            REQUESTS.inc(outcome="bad_request")
+            self._send_json(400, {"error": "Field 'query' must be a non-empty string."})
+            return
+
+        try:
+            result, coalesced = self.service.run(user_query)
+        except ServiceOverloaded as e:
+            REQUESTS.inc(outcome="rejected")
+            self._send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+            return
+        except FutureTimeoutError:
+            REQUESTS.inc(outcome="timeout")
+            self._send_json(504, {"error": f"Pipeline did not finish within {self.service.timeout}s."})
+            return
+        except Exception as e:
+            logger.exception("Pipeline failed for %r", user_query)
+            REQUESTS.inc(outcome="error")
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        REQUESTS.inc(outcome="ok")
+        payload = {field: result.get(field) for field in RESULT_FIELDS}
+        payload["user_query"] = user_query
+        payload["coalesced"] = coalesced
+        self._send_json(200, payload)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def make_server(service: QueryService, host: str = "127.0.0.1", port: int = 8080) -> ThreadingHTTPServer:
+    """An HTTP server bound to host:port that answers with service; call serve_forever() on it."""
+    handler = type("QueryServiceHandler", (_Handler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serve NL2KQL over HTTP with a warm graph.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=8, help="Pipelines executing at once.")
+    parser.add_argument("--max-queue", type=int, default=64, help="Pipelines waiting before requests get 503.")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--cache", action="store_true", help="Serve repeated query shapes from a QueryCache.")
+    parser.add_argument("--cache-path", help="SQLite file backing the cache (implies --cache).")
+    parser.add_argument("--sample-data", help="Directory of <Table>.csv/.parquet samples to dry-run queries on.")
+    parser.add_argument("--max-scan-gb", type=float,
+                        help="Reject queries estimated to scan more than this (table stats from NL2KQL_STATS_PATH).")
+    parser.add_argument("--json-logs", action="store_true")
+    args = parser.parse_args(argv)
+
+    configure_logging(json_format=args.json_logs)
+    cache = QueryCache(path=args.cache_path) if args.cache or args.cache_path else None
+    app = None
+    if args.sample_data or args.max_scan_gb:
+        policy = DryRunPolicy(ExecutionEngine(SampleData.from_directory(args.sample_data))) if args.sample_data else None
+        cost_model = CostModel(CostBudget(max_scan_bytes=args.max_scan_gb * 1e9)) if args.max_scan_gb else None
+        app = build_graph(cache=cache, dry_run=policy, cost_model=cost_model)
+    service = QueryService(app=app, cache=cache, max_workers=args.workers, max_queue=args.max_queue, timeout=args.timeout)
+    service.warm_up()
+    server = make_server(service, args.host, args.port)
+    logger.info("Serving on http://%s:%d", args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
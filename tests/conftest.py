@@ -0,0 +1,34 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_package() -> None:
+    # The repository root is the nl2kql_agent package itself, whatever the checkout is called.
+    if "nl2kql_agent" in sys.modules:
+        return
+    spec = importlib.util.spec_from_file_location(
+        "nl2kql_agent", os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT]
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["nl2kql_agent"] = module
+    spec.loader.exec_module(module)
+
+
+_import_package()
+
+from nl2kql_agent.fake_llm import FakeChatModel  # noqa: E402
+from nl2kql_agent.llm import set_llm_factory  # noqa: E402
+
+
+@pytest.fixture
+def fake_llm():
+    """Routes every LLM call of the graph to a FakeChatModel, which the test may reconfigure."""
+    model = FakeChatModel()
+    set_llm_factory(lambda name, temperature: model)
+    yield model
+    set_llm_factory(None)
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from nl2kql_agent.batch import run_batch
+from nl2kql_agent.checkpoint import SQLiteCheckpointer
+from nl2kql_agent.graph import build_graph
+
+HASH_QUERY = "Files with hash d41d8cd98f00b204e9800998ecf8427e"
+
+
+class _TrackingApp:
+    """Records how many ainvoke calls overlap."""
+
+    def __init__(self, delay=0.01, fail_on=()):
+        self.delay = delay
+        self.fail_on = set(fail_on)
+        self.running = 0
+        self.peak = 0
+
+    async def ainvoke(self, state, config=None):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+            if state["user_query"] in self.fail_on:
+                raise RuntimeError("boom")
+            return {"user_query": state["user_query"], "kql_query": "PassiveDNS | take 1"}
+        finally:
+            self.running -= 1
+
+
+async def _collect(*args, **kwargs):
+    return [item async for item in run_batch(*args, **kwargs)]
+
+
+def test_bounded_concurrency_and_every_result_reported():
+    app = _TrackingApp()
+    queries = [f"query {i}" for i in range(10)]
+    results = asyncio.run(_collect(queries, max_concurrency=3, app=app))
+    assert app.peak == 3
+    assert sorted(item.index for item in results) == list(range(10))
+    assert all(item.user_query == queries[item.index] and item.error is None for item in results)
+
+
+def test_failures_and_timeouts_are_reported_not_raised():
+    app = _TrackingApp(delay=0.05, fail_on={"bad"})
+    results = {item.user_query: item for item in asyncio.run(_collect(["bad", "good"], app=app))}
+    assert results["bad"].result is None and results["bad"].error == "RuntimeError: boom"
+    assert results["good"].result is not None
+    slow = asyncio.run(_collect(["slow"], app=_TrackingApp(delay=1.0), timeout=0.05))
+    assert slow[0].error == "Timed out after 0.05s"
+
+
+def test_rejects_zero_concurrency():
+    with pytest.raises(ValueError):
+        asyncio.run(_collect(["q"], max_concurrency=0, app=_TrackingApp()))
+
+
+def test_rerun_resumes_interrupted_hunts_from_checkpoints(fake_llm):
+    app = build_graph(checkpointer=SQLiteCheckpointer())
+    fake_llm.latency = 5.0  # the generator call outlives the timeout
+    first = asyncio.run(_collect([HASH_QUERY], app=app, batch_id="b", timeout=0.5))
+    assert first[0].error is not None
+    config = {"configurable": {"thread_id": "b:0"}}
+    assert app.get_state(config).next == ("kql_generator",)
+
+    fake_llm.latency = 0.0
+    second = asyncio.run(_collect([HASH_QUERY], app=app, batch_id="b"))
+    result = second[0].result
+    assert result["validation_status"] == "valid"
+    # The enricher ran once, in the first batch.
+    assert sum(m.content.startswith("Enriched query") for m in result["chat_history"]) == 1
+
+    fake_llm.latency = 5.0  # a finished hunt is read back without calling the model
+    third = asyncio.run(_collect([HASH_QUERY], app=app, batch_id="b", timeout=0.5))
+    assert third[0].result["kql_query"] == result["kql_query"]
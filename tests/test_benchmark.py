@@ -0,0 +1,31 @@
+import asyncio
+
+from nl2kql_agent.benchmark import DEFAULT_CORPUS, _run_query, run_benchmark
+from nl2kql_agent.fake_llm import FakeChatModel
+from nl2kql_agent.graph import build_graph
+from nl2kql_agent.instrumentation import RETRIES
+from nl2kql_agent.llm import set_llm_factory
+
+
+def test_retries_counted_for_queries_fixed_by_reflection():
+    model = FakeChatModel(invalid_rate=0.5, seed=1)
+    set_llm_factory(lambda name, temperature: model)
+    try:
+        app = build_graph()
+        before = RETRIES.value()
+        runs = [asyncio.run(_run_query(app, query, None)) for query in DEFAULT_CORPUS]
+    finally:
+        set_llm_factory(None)
+    # The validator resets retries once a query validates; the stream still saw each reflection.
+    assert any(run.status == "valid" and run.retries > 0 for run in runs)
+    assert sum(run.retries for run in runs) == RETRIES.value() - before
+
+
+def test_report_totals_retries():
+    report = run_benchmark(DEFAULT_CORPUS[:6], concurrency_levels=(1, 3),
+                           model=FakeChatModel(invalid_rate=0.9, seed=1))
+    assert [level["concurrency"] for level in report["levels"]] == [1, 3]
+    for level in report["levels"]:
+        assert level["queries"] == 6
+        assert level["retries"]["total"] > 0
+        assert level["retries"]["max"] <= 2
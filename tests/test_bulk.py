@@ -0,0 +1,49 @@
+import pytest
+
+from nl2kql_agent.bulk import BulkHunter, IndicatorSet
+from nl2kql_agent.kql_parser import validate_kql
+
+
+def _ips(n):
+    return [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(n)]
+
+
+@pytest.fixture
+def template():
+    hunter = BulkHunter(use_llm=False)
+    return hunter.fallback_template("ipv4", "AuthenticationEvents", hunter.targets("ipv4")["AuthenticationEvents"])
+
+
+@pytest.mark.parametrize("max_query_chars, max_values", [(60000, 10000), (2000, 10000), (60000, 7), (500, 3)])
+def test_chunks_stay_within_limits(template, max_query_chars, max_values):
+    hunter = BulkHunter(max_query_chars=max_query_chars, max_values=max_values, use_llm=False)
+    values = _ips(1000)
+    chunks = hunter.chunks(template, values)
+    assert [value for chunk in chunks for value in chunk] == values
+    for chunk in chunks:
+        assert 0 < len(chunk) <= max_values
+        assert len(hunter.render(template, chunk)) <= max_query_chars
+    # As few chunks as the limits allow: no two neighbours would have fit together.
+    for a, b in zip(chunks, chunks[1:]):
+        assert len(a) + len(b) > max_values or len(hunter.render(template, a + b)) > max_query_chars
+
+
+def test_chunks_rejects_a_value_that_cannot_fit(template):
+    hunter = BulkHunter(max_query_chars=len(BulkHunter.render(template, [])) + 10, use_llm=False)
+    assert hunter.chunks(template, ["1.2.3.4"]) == [["1.2.3.4"]]
+    with pytest.raises(ValueError):
+        hunter.chunks(template, ["203.113.200.100"])
+
+
+def test_queries_cover_every_indicator_and_validate():
+    indicators = IndicatorSet([("ipv4", ip) for ip in _ips(250)] + [("domain", "evil.example.com")])
+    hunter = BulkHunter(max_values=100, use_llm=False)
+    queries = hunter.queries(indicators)
+    ipv4 = [q for q in queries if q.ioc_type == "ipv4"]
+    assert {q.table for q in ipv4} == set(hunter.targets("ipv4"))
+    for table in {q.table for q in ipv4}:
+        parts = [q for q in ipv4 if q.table == table]
+        assert sum(q.indicators for q in parts) == 250
+        assert [(q.chunk, q.total) for q in parts] == [(i, len(parts)) for i in range(1, len(parts) + 1)]
+    for query in queries:
+        assert validate_kql(query.kql_query)["is_valid"], query.kql_query
@@ -0,0 +1,54 @@
+from nl2kql_agent.cache import QueryCache
+from nl2kql_agent.checkpoint import SQLiteCheckpointer, thread_config
+from nl2kql_agent.graph import build_graph
+from nl2kql_agent.threat_intel_types import follow_up_state, initial_state
+
+
+def test_same_shape_query_is_served_from_cache(fake_llm):
+    app = build_graph(cache=QueryCache())
+    first = app.invoke(initial_state("Find activity for IP 203.0.113.7"))
+    second = app.invoke(initial_state("Find activity for IP 198.51.100.9"))
+    assert not first.get("cache_hit")
+    assert second["cache_hit"]
+    assert "198.51.100.9" in second["kql_query"] and "203.0.113.7" not in second["kql_query"]
+
+
+def test_follow_up_turn_does_not_leak_into_other_sessions(fake_llm):
+    cache = QueryCache()
+    app = build_graph(cache=cache, checkpointer=SQLiteCheckpointer())
+    app.invoke(initial_state("Find activity for IP 203.0.113.7"), thread_config("a"))
+    app.invoke(follow_up_state("Only show failed logins"), thread_config("a"))
+    other = build_graph(cache=cache).invoke(initial_state("Only show failed logins"))
+    assert not other.get("cache_hit")
+    assert "203.0.113.7" not in other["kql_query"]
+
+
+def test_follow_up_state_and_thread_config_bypass_the_cache(fake_llm):
+    cache = QueryCache()
+    app = build_graph(cache=cache)
+    query = "Find activity for IP 203.0.113.7"
+    app.invoke(initial_state(query), {"configurable": {"thread_id": "t"}})
+    assert cache.get(query) is None
+    app.invoke(initial_state(query))
+    assert cache.get(query) is not None
+    result = app.invoke({**follow_up_state(query),
+                         "enriched_query": "", "shortlisted_tables": ["InboundBrowsing"]})
+    assert not result.get("cache_hit")
+
+
+def test_plain_dict_input_uses_the_cache(fake_llm):
+    # The input shape documented in the README, without initial_state().
+    app = build_graph(cache=QueryCache())
+    first = app.invoke({"user_query": "Find activity for IP 203.0.113.7", "chat_history": [], "retries": 0})
+    second = app.invoke({"user_query": "Find activity for IP 198.51.100.9", "chat_history": [], "retries": 0})
+    assert first["cache_hit"] is False
+    assert second["cache_hit"] is True
+
+
+def test_state_carrying_an_earlier_enrichment_bypasses_the_cache(fake_llm):
+    cache = QueryCache()
+    app = build_graph(cache=cache)
+    app.invoke(initial_state("Only show failed logins"))
+    result = app.invoke({"user_query": "Only show failed logins", "enriched_query": "Activity for 203.0.113.7",
+                         "shortlisted_tables": ["AuthenticationEvents"], "retries": 0})
+    assert not result.get("cache_hit")
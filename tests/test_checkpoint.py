@@ -0,0 +1,86 @@
+import sqlite3
+import zlib
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from nl2kql_agent import checkpoint
+from nl2kql_agent.checkpoint import CompactSerializer, SQLiteCheckpointer, thread_config
+from nl2kql_agent.graph import build_graph
+from nl2kql_agent.threat_intel_types import follow_up_state, initial_state
+
+HASH_QUERY = "Files with hash d41d8cd98f00b204e9800998ecf8427e"
+LARGE = {"chat_history": [HumanMessage(content="word " * 200, id="1"), AIMessage(content="KQL", id="2")],
+         "retries": 2, "shortlisted_tables": ["FileCreationEvents"]}
+
+
+def test_messages_are_stored_compactly_and_read_back():
+    serde = CompactSerializer(compress_min_bytes=10_000)
+    type_, data = serde.dumps_typed(LARGE)
+    assert type_ == "cmsgpack"
+    assert b"additional_kwargs" not in data
+    assert serde.loads_typed((type_, data)) == LARGE
+    tool_call = AIMessage(content="", tool_calls=[{"name": "f", "args": {}, "id": "t"}])
+    assert serde.loads_typed(serde.dumps_typed(tool_call)).tool_calls == tool_call.tool_calls
+
+
+def test_large_values_use_zlib_without_zstandard(monkeypatch):
+    monkeypatch.setattr(checkpoint, "zstandard", None)
+    serde = CompactSerializer(compress_min_bytes=64)
+    type_, data = serde.dumps_typed(LARGE)
+    assert type_ == "cmsgpack+zlib" and len(data) < len(CompactSerializer(10_000).dumps_typed(LARGE)[1])
+    assert serde.loads_typed((type_, data)) == LARGE
+    with pytest.raises(ImportError):
+        serde.loads_typed(("cmsgpack+zstd", data))
+
+
+def test_large_values_use_zstandard():
+    pytest.importorskip("zstandard")
+    serde = CompactSerializer(compress_min_bytes=64)
+    type_, data = serde.dumps_typed(LARGE)
+    assert type_ == "cmsgpack+zstd"
+    assert serde.loads_typed((type_, data)) == LARGE
+    # zlib checkpoints written without zstandard are still readable.
+    assert serde.loads_typed(("cmsgpack+zlib", zlib.compress(serde.dumps_typed([1])[1]))) == [1]
+
+
+def test_state_survives_reopening_the_file(fake_llm, tmp_path):
+    path = str(tmp_path / "hunts.db")
+    config = thread_config("analyst")
+    result = build_graph(checkpointer=SQLiteCheckpointer(path)).invoke(initial_state(HASH_QUERY), config)
+    state = build_graph(checkpointer=SQLiteCheckpointer(path)).get_state(config)
+    assert state.next == ()
+    assert state.values["kql_query"] == result["kql_query"]
+    assert [m.content for m in state.values["chat_history"]] == [m.content for m in result["chat_history"]]
+
+
+def test_interrupted_hunt_resumes_after_the_last_node(fake_llm):
+    app = build_graph(checkpointer=SQLiteCheckpointer())
+    config = thread_config("t")
+    for update in app.stream(initial_state(HASH_QUERY), config, stream_mode="updates"):
+        assert "enricher" in update
+        break  # the process dies after the enricher
+    assert app.get_state(config).next == ("kql_generator",)
+    result = app.invoke(None, config)
+    assert result["validation_status"] == "valid"
+    assert sum(m.content.startswith("Enriched query") for m in result["chat_history"]) == 1
+
+
+def test_old_checkpoints_are_pruned(fake_llm, tmp_path):
+    path = str(tmp_path / "hunts.db")
+    saver = SQLiteCheckpointer(path, max_checkpoints=3)
+    app = build_graph(checkpointer=saver)
+    config = thread_config("t")
+    app.invoke(initial_state(HASH_QUERY), config)
+    for turn in range(3):
+        app.invoke(follow_up_state(f"Only on host ws-{turn}"), config)
+    with sqlite3.connect(path) as db:
+        kept = db.execute("SELECT COUNT(*) FROM checkpoints WHERE thread_id = 't'").fetchone()[0]
+    # Pruning runs in batches of max_checkpoints // 2.
+    assert kept <= 3 + 1
+    # The newest state is complete after pruning.
+    assert app.get_state(config).values["validation_status"] in ("valid", "failed")
+    assert saver.stats()["checkpoints"] > kept
+
+    saver.delete_thread("t")
+    assert saver.get_tuple(config) is None
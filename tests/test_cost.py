@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from nl2kql_agent.cost import CostBudget, CostModel
+from nl2kql_agent.fake_llm import FakeChatModel
+from nl2kql_agent.llm import set_llm_factory
+from nl2kql_agent.schemas import TABLE_SCHEMAS, SchemaRegistry
+from nl2kql_agent.tools.validator import QueryValidator
+
+STATS = {
+    "ProcessEvents": {"rows": 100_000_000, "rows_per_day": 1_000_000,
+                      "columns": {"hostname": {"cardinality": 1_000}, "process_name": {"cardinality": 500}}},
+    "FileCreationEvents": {"rows": 50_000_000, "rows_per_day": 500_000,
+                           "columns": {"hostname": {"cardinality": 1_000}}},
+}
+
+
+@pytest.fixture
+def registry(tmp_path):
+    path = tmp_path / "stats.json"
+    path.write_text(json.dumps({"tables": STATS}))
+    return SchemaRegistry(TABLE_SCHEMAS, stats_path=str(path))
+
+
+def test_time_window_scales_the_scan(registry):
+    model = CostModel(registry=registry)
+    unbounded = model.estimate("ProcessEvents | take 10")
+    bounded = model.estimate("ProcessEvents | where timestamp_1 > ago(1d) | take 10")
+    assert unbounded.rows_scanned == 100_000_000 and bounded.rows_scanned == 1_000_000
+    assert bounded.scan_bytes == pytest.approx(unbounded.scan_bytes / 100)
+    assert bounded.rows == 10 and "last 1d" in bounded.notes[0]
+
+
+def test_index_filters_and_projection_shrink_the_scan(registry):
+    model = CostModel(registry=registry)
+    everything = model.estimate("ProcessEvents | where timestamp_1 > ago(1d)")
+    narrow = model.estimate('ProcessEvents | where timestamp_1 > ago(1d) | where process_name == "x" | project hostname')
+    assert narrow.scan_bytes < everything.scan_bytes / 10
+    assert narrow.rows == pytest.approx(1_000_000 / 500)
+
+
+def test_join_rows_follow_key_cardinality(registry):
+    estimate = CostModel(registry=registry).estimate(
+        "ProcessEvents | where timestamp_1 > ago(1d) | join kind=inner "
+        "(FileCreationEvents | where timestamp_1 > ago(1d)) on hostname")
+    assert estimate.max_join_rows == pytest.approx(1_000_000 * 500_000 / 1_000)
+    assert estimate.tables == ["ProcessEvents", "FileCreationEvents"]
+
+
+def test_union_legs_are_scanned_with_the_filters_after_the_union(registry):
+    estimate = CostModel(registry=registry).estimate(
+        "union ProcessEvents, FileCreationEvents | where timestamp_1 > ago(1d)")
+    assert estimate.rows_scanned == 1_500_000
+
+
+def test_check_reports_what_is_over_budget(registry):
+    model = CostModel(CostBudget(max_scan_bytes=1e9, max_join_rows=1e6), registry=registry)
+    assert model.check("ProcessEvents | where timestamp_1 > ago(1h) | count")[1] is None
+    _, problem = model.check("ProcessEvents | join kind=inner (FileCreationEvents) on hostname")
+    assert "scans ~" in problem and "a join produces ~" in problem and "ago(1d)" in problem
+
+
+def test_validator_sends_expensive_queries_to_reflection_then_rejects_them(registry):
+    fixed = "ProcessEvents | where timestamp_1 > ago(1h) | take 10"
+    set_llm_factory(lambda name, temperature: FakeChatModel(responder=lambda messages, rng: fixed))
+    try:
+        validator = QueryValidator(cost_model=CostModel(CostBudget(max_scan_bytes=1e9), registry=registry))
+        state = {"user_query": "q", "kql_query": "ProcessEvents", "shortlisted_tables": ["ProcessEvents"],
+                 "validation_status": "pending", "retries": 0, "chat_history": []}
+        update = validator(state)
+        assert update["validation_status"] == "retrying" and update["kql_query"] == fixed
+        assert "too expensive" in update["validation_error"]
+
+        update = validator({**state, "retries": QueryValidator.MAX_RETRIES})
+        assert update["validation_status"] == "failed" and update["cost_estimate"]["scan_bytes"] > 1e9
+
+        update = validator({**state, "kql_query": fixed})
+        assert update["validation_status"] == "valid"
+    finally:
+        set_llm_factory(None)
@@ -0,0 +1,99 @@
+import pytest
+
+from nl2kql_agent.engine import DryRunPolicy, ExecutionEngine, SampleData, SampleTable, UnsupportedQuery
+
+LOGINS = [
+    {"user": "alice", "src_ip": "10.0.0.1", "result": "Failed", "bytes": 10, "ts": "2024-05-31T10:00:00"},
+    {"user": "bob", "src_ip": "10.0.0.2", "result": "Success", "bytes": 30, "ts": "2024-05-20T10:00:00"},
+    {"user": "alice", "src_ip": "10.0.0.1", "result": "Failed", "bytes": 20, "ts": "2024-05-31T11:00:00"},
+    {"user": "carol", "src_ip": "10.0.0.3", "result": "Failed", "bytes": None, "ts": "2024-06-01T00:00:00"},
+]
+HOSTS = [
+    {"src_ip": "10.0.0.1", "hostname": "ws-1"},
+    {"src_ip": "10.0.0.2", "hostname": "ws-2"},
+    {"src_ip": "10.0.0.9", "hostname": "ws-9"},
+]
+LOGIN_SCHEMA = [("user", "string"), ("src_ip", "string"), ("result", "string"), ("bytes", "long"), ("ts", "datetime")]
+HOST_SCHEMA = [("src_ip", "string"), ("hostname", "string")]
+
+
+@pytest.fixture
+def engine():
+    return ExecutionEngine(SampleData({
+        "Logins": SampleTable.from_records("Logins", LOGINS, LOGIN_SCHEMA),
+        "Hosts": SampleTable.from_records("Hosts", HOSTS, HOST_SCHEMA),
+    }))
+
+
+def _column(frame, name):
+    return frame.columns[name].tolist()
+
+
+def test_where_project_and_count(engine):
+    frame = engine.execute('Logins | where result == "Failed" and src_ip in ("10.0.0.1") | project user, bytes')
+    assert list(frame.columns) == ["user", "bytes"]
+    assert _column(frame, "bytes") == [10.0, 20.0]
+    assert _column(engine.execute('Logins | where user has "ali" or user =~ "BOB" | count'), "Count") == [1.0]
+
+
+def test_ago_is_anchored_at_the_newest_sample(engine):
+    assert engine.execute("Logins | where ts > ago(1d)").rows == 3
+
+
+def test_summarize_by_key(engine):
+    frame = engine.execute("Logins | summarize n = count(), total = sum(bytes), users = dcount(user) by result")
+    by_result = dict(zip(_column(frame, "result"), zip(_column(frame, "n"), _column(frame, "total"))))
+    assert by_result == {"Failed": (3.0, 30.0), "Success": (1.0, 30.0)}
+    assert sorted(_column(frame, "users")) == [1.0, 2.0]
+
+
+@pytest.mark.parametrize("kind, rows", [("inner", 3), ("leftouter", 4), ("leftanti", 1), ("leftsemi", 3)])
+def test_join_kinds(engine, kind, rows):
+    frame = engine.execute(f"Logins | join kind={kind} (Hosts) on src_ip")
+    assert frame.rows == rows
+    if kind in ("inner", "leftouter"):
+        assert "src_ip1" in frame.columns and "hostname" in frame.columns
+
+
+def test_sort_and_top_follow_the_direction(engine):
+    assert _column(engine.execute("Logins | top 2 by bytes desc"), "bytes") == [30.0, 20.0]
+    assert _column(engine.execute("Logins | top 2 by bytes asc"), "bytes")[1] == 10.0
+    # Nulls go last when descending (the default) and first when ascending.
+    assert _column(engine.execute("Logins | sort by bytes"), "user")[-1] == "carol"
+    assert _column(engine.execute("Logins | sort by bytes asc"), "user")[0] == "carol"
+    assert _column(engine.execute("Logins | sort by bytes asc nulls last"), "bytes")[:3] == [10.0, 20.0, 30.0]
+    # Later keys break ties of earlier ones.
+    frame = engine.execute("Logins | sort by user asc, ts desc | project user, bytes")
+    assert _column(frame, "user") == ["alice", "alice", "bob", "carol"]
+    assert _column(frame, "bytes")[:2] == [20.0, 10.0]
+
+
+def test_union_and_unsupported_operators(engine):
+    assert engine.execute("union Logins, Hosts").rows == 7
+    with pytest.raises(UnsupportedQuery):
+        engine.execute("Logins | evaluate bag_unpack(x)")
+
+
+def test_dry_run_reports_scan_and_errors(engine):
+    result = engine.dry_run('Logins | where user == "alice"')
+    assert (result.rows, result.rows_scanned, result.tables, result.error) == (2, 4, ["Logins"], None)
+    assert result.bytes_scanned > 0
+    assert engine.dry_run("Nope | take 1").error is not None
+
+
+def test_policy_verdicts(engine):
+    policy = DryRunPolicy(engine, min_rows=1, max_rows=3)
+    assert policy.check("Logins | take 2")[1] is None
+    result, problem = policy.check('Logins | where user == "dave"')
+    assert result.rows == 0 and problem.startswith("Dry run on sample data returned 0 rows")
+    result, problem = policy.check("Logins")
+    assert result.rows == 4 and "above the limit of 3" in problem
+    # Queries the engine cannot run are not sent back.
+    assert policy.check("Logins | evaluate bag_unpack(x)")[1] is None
+
+
+def test_hunt_iocs_are_exempt_from_the_empty_check(engine):
+    policy = DryRunPolicy(engine)
+    query = 'Logins | where src_ip == "203.0.113.7"'
+    assert policy.check(query, iocs=["203.0.113.7"])[1] is None
+    assert policy.check(query, iocs=["198.51.100.1"])[1] is not None
@@ -0,0 +1,57 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages.utils import count_tokens_approximately
+
+from nl2kql_agent.graph import build_graph
+from nl2kql_agent.history import MAX_STORED_MESSAGES, HistoryPolicy, add_history, condense
+from nl2kql_agent.threat_intel_types import initial_state
+
+
+def _messages(n, words=20):
+    return [HumanMessage(content=f"message {i} " + "word " * words) for i in range(n)]
+
+
+def test_add_history_appends_and_caps():
+    old = _messages(MAX_STORED_MESSAGES - 1)
+    merged = add_history(old, [AIMessage(content="new 1"), AIMessage(content="new 2")])
+    assert len(merged) == MAX_STORED_MESSAGES
+    assert merged[-1].content == "new 2"
+    assert merged[0].content.startswith("message 1 ")
+    assert add_history(None, []) == []
+
+
+def test_window_respects_the_token_budget():
+    messages = _messages(30)
+    window = HistoryPolicy(max_tokens=200, summarize=False).select(messages)
+    assert window == messages[-len(window):]
+    assert 0 < len(window) < 30
+    assert count_tokens_approximately(window) <= 200
+
+
+def test_newest_message_is_kept_even_over_budget():
+    huge = HumanMessage(content="word " * 2000)
+    assert HistoryPolicy(max_tokens=10, summarize=False).select([huge]) == [huge]
+
+
+def test_summary_of_dropped_messages_is_bounded():
+    messages = _messages(40)
+    selected = HistoryPolicy(max_tokens=200, summary_max_tokens=50).select(messages)
+    summary, window = selected[0], selected[1:]
+    assert isinstance(summary, SystemMessage)
+    assert summary.content.startswith(f"Summary of {40 - len(window)} earlier message(s)")
+    assert count_tokens_approximately([summary]) <= 50
+    # The oldest lines go first.
+    assert f"message {39 - len(window)} " in summary.content and "message 0 " not in summary.content
+
+
+def test_custom_summarizer_and_condense():
+    policy = HistoryPolicy(max_tokens=50, summarizer=lambda dropped: f"{len(dropped)} dropped")
+    assert policy.select(_messages(10))[0].content.endswith("dropped")
+    assert condense([AIMessage(content="first\nsecond"), AIMessage(content="")]) == "- first"
+
+
+def test_nodes_add_only_their_own_messages(fake_llm):
+    result = build_graph().invoke(initial_state("Files with hash d41d8cd98f00b204e9800998ecf8427e"))
+    contents = [m.content.split(":", 1)[0] for m in result["chat_history"]]
+    assert contents[:2] == ["Enriched query", "Generated KQL"]
+    assert contents[-1] == "KQL Validated"
+    assert len(contents) == len(set(m.id for m in result["chat_history"]))
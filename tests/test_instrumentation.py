@@ -0,0 +1,118 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, LLMResult
+
+from nl2kql_agent.graph import build_graph
+from nl2kql_agent.instrumentation import (
+    LLM_ERRORS,
+    LLM_TOKENS,
+    METRICS,
+    NODE_ERRORS,
+    NODE_SECONDS,
+    PROMPT_CACHE,
+    RETRIES,
+    VALIDATIONS,
+    InstrumentedNode,
+    LLMMetricsHandler,
+    MetricsRegistry,
+)
+from nl2kql_agent.threat_intel_types import initial_state
+
+
+class _Node:
+    def __init__(self, update=None, error=None):
+        self.update = update
+        self.error = error
+
+    def __call__(self, state):
+        if self.error is not None:
+            raise self.error
+        return self.update
+
+    async def acall(self, state):
+        return self(state)
+
+
+def test_counter_and_histogram_render_in_the_prometheus_format():
+    registry = MetricsRegistry()
+    counter = registry.counter("hunts_total", "Hunts.", ["status"])
+    counter.inc(status="valid")
+    counter.inc(2, status='say "hi"\n')
+    histogram = registry.histogram("wait_seconds", "Wait.", buckets=(0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(3)
+
+    assert registry.render_prometheus().splitlines() == [
+        "# HELP hunts_total Hunts.",
+        "# TYPE hunts_total counter",
+        'hunts_total{status="say \\"hi\\"\\n"} 2',
+        'hunts_total{status="valid"} 1',
+        "# HELP wait_seconds Wait.",
+        "# TYPE wait_seconds histogram",
+        'wait_seconds_bucket{le="0.1"} 1',
+        'wait_seconds_bucket{le="1"} 2',
+        'wait_seconds_bucket{le="+Inf"} 3',
+        "wait_seconds_sum 3.55",
+        "wait_seconds_count 3",
+    ]
+    assert histogram.summary() == {"count": 3, "sum": 3.55, "mean": pytest.approx(3.55 / 3)}
+
+
+def test_metrics_check_their_labels_and_registration():
+    registry = MetricsRegistry()
+    counter = registry.counter("c_total", "C.", ["node"])
+    assert registry.counter("c_total", "C.", ["node"]) is counter
+    with pytest.raises(ValueError):
+        registry.histogram("c_total", "C.", ["node"])
+    with pytest.raises(ValueError):
+        counter.inc(kind="x")
+    with pytest.raises(ValueError):
+        counter.inc(-1, node="x")
+    counter.inc(node="x")
+    registry.reset()
+    assert counter.value(node="x") == 0
+
+
+def test_instrumented_node_counts_retries_validations_and_errors():
+    before = (RETRIES.value(), VALIDATIONS.value(status="retrying"), VALIDATIONS.value(status="valid"))
+    InstrumentedNode("v", _Node({"validation_status": "retrying"}))({})
+    asyncio.run(InstrumentedNode("v", _Node({"validation_status": "valid"})).acall({}))
+    InstrumentedNode("v", _Node({"validation_status": "pending"}))({})
+    assert (RETRIES.value(), VALIDATIONS.value(status="retrying"), VALIDATIONS.value(status="valid")) == (
+        before[0] + 1, before[1] + 1, before[2] + 1)
+
+    errors, runs = NODE_ERRORS.value(node="broken"), NODE_SECONDS.summary(node="broken")["count"]
+    with pytest.raises(RuntimeError):
+        InstrumentedNode("broken", _Node(error=RuntimeError("boom")))({})
+    assert NODE_ERRORS.value(node="broken") == errors + 1
+    assert NODE_SECONDS.summary(node="broken")["count"] == runs + 1
+
+
+def test_llm_handler_counts_tokens_cache_hits_and_errors():
+    handler = LLMMetricsHandler("probe")
+    message = AIMessage(content="x", usage_metadata={
+        "input_tokens": 120, "output_tokens": 7, "total_tokens": 127, "input_token_details": {"cache_read": 100}})
+    run_id = uuid4()
+    handler.on_chat_model_start({}, [], run_id=run_id)
+    handler.on_llm_end(LLMResult(generations=[[ChatGeneration(message=message)]]), run_id=run_id)
+    assert LLM_TOKENS.value(node="probe", kind="prompt") == 120
+    assert LLM_TOKENS.value(node="probe", kind="completion") == 7
+    assert LLM_TOKENS.value(node="probe", kind="cached") == 100
+    assert PROMPT_CACHE.value(node="probe", result="hit") == 1
+
+    handler.on_llm_error(RuntimeError("boom"), run_id=uuid4())
+    assert LLM_ERRORS.value(node="probe") == 1
+
+
+def test_graph_run_is_exported(fake_llm):
+    result = build_graph().invoke(initial_state("Files with hash d41d8cd98f00b204e9800998ecf8427e"))
+    assert result["validation_status"] == "valid"
+    text = METRICS.render_prometheus()
+    for node in ("enricher", "kql_generator", "kql_validator"):
+        assert f'nl2kql_node_duration_seconds_count{{node="{node}"}}' in text
+    assert 'nl2kql_llm_tokens_total{node="kql_generator",kind="prompt"}' in text
+    assert 'nl2kql_validations_total{status="valid"}' in text
@@ -0,0 +1,68 @@
+import pytest
+
+from nl2kql_agent.iocs import enrich, extract_iocs, rank_tables
+from nl2kql_agent.tools.enricher import UserQueryEnricher
+from nl2kql_agent.threat_intel_types import initial_state
+
+
+def test_extracts_each_ioc_type_once():
+    text = ("Visit http://evil.com/x.exe from 10.0.0.1 and mail bob@evil.org; dropped payload.exe, "
+            "md5 d41d8cd98f00b204e9800998ecf8427e, v6 2001:db8::1, not an IP 999.1.1.1")
+    assert [(ioc.type, ioc.value) for ioc in extract_iocs(text)] == [
+        ("url", "http://evil.com/x.exe"),
+        ("ipv4", "10.0.0.1"),
+        ("email", "bob@evil.org"),
+        ("md5", "d41d8cd98f00b204e9800998ecf8427e"),
+        ("ipv6", "2001:db8::1"),
+    ]
+
+
+@pytest.mark.parametrize("text, ioc_type", [
+    ("a" * 64, "sha256"), ("b" * 40, "sha1"), ("c" * 32, "md5"), ("login.evil-site.co.uk", "domain"),
+])
+def test_hash_and_domain_types(text, ioc_type):
+    assert [ioc.type for ioc in extract_iocs(f"look for {text} please")] == [ioc_type]
+
+
+def test_ip_hunt_ranks_event_tables_before_reference_tables():
+    ranked = [table for table, _ in rank_tables("Find activity for IP 203.0.113.7",
+                                                 extract_iocs("203.0.113.7"))]
+    assert set(ranked[:3]) == {"InboundBrowsing", "OutBoundBrowsing", "AuthenticationEvents"}
+    assert ranked.index("AuthenticationEvents") < ranked.index("Employees")
+    assert ranked.index("IAM") < ranked.index("PassiveDNS")
+
+
+def test_split_tie_lowers_confidence():
+    result = enrich("Find activity for IP 203.0.113.7")
+    assert "AuthenticationEvents" in result.shortlisted_tables
+    assert result.confidence < UserQueryEnricher.MIN_CONFIDENCE
+
+
+def test_clear_ioc_match_is_confident():
+    result = enrich("Files with hash d41d8cd98f00b204e9800998ecf8427e")
+    assert result.shortlisted_tables[:2] == ["FileCreationEvents", "ProcessEvents"]
+    assert result.confidence == 1.0
+    assert "FileCreationEvents.sha256" in result.enriched_query
+
+
+@pytest.mark.parametrize("text, confident", [
+    ("Show failed logins", True),
+    ("processes with powershell", True),
+    ("what did the user do", False),
+    ("show hostname activity", False),
+])
+def test_keyword_only_confidence(text, confident):
+    assert (enrich(text).confidence >= UserQueryEnricher.MIN_CONFIDENCE) is confident
+
+
+def test_nothing_matched():
+    result = enrich("nothing here")
+    assert result.confidence == 0.0 and len(result.shortlisted_tables) == 4
+
+
+def test_enricher_asks_the_llm_only_on_low_confidence(fake_llm):
+    enricher = UserQueryEnricher()
+    confident = enricher(initial_state("Files with hash d41d8cd98f00b204e9800998ecf8427e"))
+    assert confident["enriched_query"].startswith("Files with hash")
+    weak = enricher(initial_state("what did the user do"))
+    assert weak["enriched_query"].startswith("Hunt for activity matching:")
@@ -0,0 +1,72 @@
+import pytest
+
+from nl2kql_agent.kql_parser import KQLSyntaxError, parse_kql, validate_kql
+
+
+@pytest.mark.parametrize("query, tables", [
+    ('InboundBrowsing | where src_ip == "1.2.3.4" | project timestamp_1, url', ["InboundBrowsing"]),
+    ('let ips = dynamic(["1.1.1.1"]);\nunion InboundBrowsing, OutBoundBrowsing\n| where src_ip in (ips) '
+     'and timestamp_1 > ago(7d)\n| summarize Count = count(), dcount(url) by src_ip, bin(timestamp_1, 1h)\n'
+     '| where Count > 5 and dcount_url > 1 | sort by Count desc', ["InboundBrowsing", "OutBoundBrowsing"]),
+    ('ProcessEvents | join kind=inner (FileCreationEvents | where filename endswith ".exe" '
+     '| project hostname, sha256) on hostname | project process_name, sha256, hostname',
+     ["ProcessEvents", "FileCreationEvents"]),
+    ('ProcessEvents | join kind=inner (FileCreationEvents) on $left.process_hash == $right.sha256 '
+     '| project process_name, path', ["ProcessEvents", "FileCreationEvents"]),
+    ('Email | where sender =~ "attacker@evil.com" or reply_to has "evil.com" | project-away accepted_1 '
+     '| extend d = tostring(split(sender, "@")[1]) | summarize count() by d', ["Email"]),
+    ('Email | where event_time_1 between (datetime(2024-01-01) .. now()) | top 10 by event_time_1 desc', ["Email"]),
+    ('IAM | where Source_IP startswith "10." | project-rename ip = Source_IP | project ip, UserName', ["IAM"]),
+    ('AuthenticationEvents | where result == "Failed" | count', ["AuthenticationEvents"]),
+    ("Employees | where ['name'] == 'x' | distinct hostname", ["Employees"]),
+])
+def test_accepts_valid_queries(query, tables):
+    result = validate_kql(query)
+    assert result["is_valid"], result["error"]
+    assert result["tables"] == tables
+    assert (result["line"], result["column"]) == (0, 0)
+
+
+@pytest.mark.parametrize("query, kind, line, column, message", [
+    ('InboundBrowsing\n| where src == "1.2.3.4"', "Semantic", 2, 9, "Did you mean 'src_ip'?"),
+    ('InboundBrowsing\n| where src_ip == "x"\n| summarize by', "Syntax", 3, 15, "Expected an expression"),
+    ("Foo | take 10", "Semantic", 1, 1, "Table 'Foo' does not exist."),
+    ('InboundBrowsing where src_ip == "x"', "Syntax", 1, 17, "expected '|' before the next operator"),
+    ('InboundBrowsing | where url contains "x" |', "Syntax", 1, 43, "Expected an operator after '|'"),
+    ('InboundBrowsing | where (url contains "x"', "Syntax", 1, 42, "Expected ')'"),
+    ("InboundBrowsing | join kind=sideways (PassiveDNS) on ip", "Syntax", 1, 29, "Unknown join kind 'sideways'."),
+    ("AuthenticationEvents | count | project foo", "Semantic", 1, 40, "Available columns: Count."),
+    ('InboundBrowsing | where url == "abc', "Syntax", 1, 32, "Unterminated string literal."),
+])
+def test_rejects_invalid_queries_with_location(query, kind, line, column, message):
+    result = validate_kql(query)
+    assert not result["is_valid"]
+    assert (result["line"], result["column"]) == (line, column)
+    assert result["error"].startswith(f"{kind} error at line {line}, column {column}:")
+    assert message in result["error"]
+
+
+def test_error_excerpt_points_at_the_offending_text():
+    query = 'InboundBrowsing\n| where src == "1.2.3.4"'
+    excerpt = validate_kql(query)["error"].splitlines()[1:]
+    assert excerpt[0].strip() == '| where src == "1.2.3.4"'
+    assert excerpt[1].index("^") - excerpt[0].index("|") == 8
+
+
+def test_rejects_queries_outside_the_shortlist():
+    result = validate_kql("PassiveDNS | take 1", ["Email"])
+    assert not result["is_valid"]
+    assert "does not reference any of the shortlisted tables (Email)" in result["error"]
+
+
+def test_parse_kql_raises_with_location():
+    with pytest.raises(KQLSyntaxError) as info:
+        parse_kql("InboundBrowsing |\n| take 1")
+    assert (info.value.line, info.value.column) == (2, 1)
+
+
+def test_sort_keeps_direction_and_null_placement():
+    top = parse_kql("Email | top 5 by sender asc, event_time_1 nulls first").body.operators[0]
+    assert (top.descending, top.nulls_first) == ([False, True], [True, True])
+    sort = parse_kql("Email | sort by sender desc nulls last").body.operators[0]
+    assert sort.count is None and (sort.descending, sort.nulls_first) == ([True], [False])
@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from nl2kql_agent import llm, tools
+from nl2kql_agent.fake_llm import FakeChatModel
+
+
+class _TemperatureModel(FakeChatModel):
+    temperature: float = 0.0
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loads the checkout as nl2kql_agent in a fresh interpreter, like conftest.py does.
+PROBE = """
+import importlib.util, json, os, sys
+spec = importlib.util.spec_from_file_location("nl2kql_agent", os.path.join(ROOT, "__init__.py"),
+                                              submodule_search_locations=[ROOT])
+package = importlib.util.module_from_spec(spec)
+sys.modules["nl2kql_agent"] = package
+spec.loader.exec_module(package)
+HEAVY = ("langgraph", "langchain_core", "langchain_google_genai", "dotenv", "nl2kql_agent.graph")
+loaded = {"import": [m for m in HEAVY if m in sys.modules]}
+package.build_graph()
+loaded["build_graph"] = [m for m in HEAVY if m in sys.modules]
+print(json.dumps(loaded))
+"""
+
+
+def test_importing_the_package_loads_nothing_heavy():
+    env = {k: v for k, v in os.environ.items() if k != "GOOGLE_API_KEY"}
+    out = subprocess.run([sys.executable, "-c", f"ROOT = {ROOT!r}\n" + PROBE], env=env, cwd=ROOT,
+                         capture_output=True, text=True, check=True).stdout
+    loaded = json.loads(out.splitlines()[-1])
+    assert loaded["import"] == []
+    # Building the graph needs LangGraph, but neither a provider SDK nor an API key.
+    assert "langgraph" in loaded["build_graph"]
+    assert "langchain_google_genai" not in loaded["build_graph"]
+
+
+def test_tools_resolve_their_nodes_on_access():
+    assert tools.NL2KQLGenerator.__module__ == "nl2kql_agent.tools.kql_generator"
+    assert set(tools.__all__) <= set(dir(tools))
+    with pytest.raises(AttributeError):
+        tools.Missing
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    built = []
+
+    def factory(model, temperature):
+        built.append((model, temperature))
+        return _TemperatureModel(temperature=temperature)
+    monkeypatch.setitem(llm._providers, "probe", (factory, "probe-1"))
+    monkeypatch.setenv("NL2KQL_LLM_PROVIDER", "probe")
+    llm._base_client.cache_clear()
+    llm._client.cache_clear()
+    yield built
+    llm._base_client.cache_clear()
+    llm._client.cache_clear()
+
+
+def test_provider_is_chosen_by_setting_and_built_once(provider):
+    class Node:
+        model = llm.LazyLLM(temperature=0.7)
+
+    node = Node()
+    assert provider == []  # nothing is built until the first access
+    assert node.model is node.model
+    llm.get_llm(temperature=0.3)
+    # One client per model; temperatures are copies of it.
+    assert provider == [("probe-1", 0.0)]
+    assert node.model.model.temperature == 0.7
+    assert llm.get_llm(temperature=0.7).model is node.model.model
+
+
+def test_unknown_provider_is_reported(monkeypatch):
+    monkeypatch.setenv("NL2KQL_LLM_PROVIDER", "nope")
+    with pytest.raises(ValueError, match="Unknown LLM provider 'nope'"):
+        llm.get_llm()
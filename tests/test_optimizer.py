@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+from nl2kql_agent.engine import ExecutionEngine, SampleData
+from nl2kql_agent.kql_parser import validate_kql
+from nl2kql_agent.tools.optimizer import KQLOptimizer
+
+
+@pytest.fixture(scope="module")
+def data():
+    return SampleData.synthetic(rows=500, seed=3)
+
+
+@pytest.fixture(scope="module")
+def engine(data):
+    return ExecutionEngine(data)
+
+
+def _rows(frame):
+    columns = sorted(frame.columns)
+    return sorted(tuple(str(frame.columns[c][i]) for c in columns) for i in range(frame.rows)), columns
+
+
+def _value(data, table, column, rank=0):
+    values, counts = np.unique(data[table].columns[column], return_counts=True)
+    return str(values[counts.argsort()[::-1][rank]])
+
+
+def _optimize_and_compare(engine, query, expected_note):
+    # No default time window: it changes the result on purpose.
+    optimized, notes = KQLOptimizer(time_window=None).optimize(query)
+    assert any(expected_note in note for note in notes), notes
+    assert optimized != query
+    assert validate_kql(optimized)["is_valid"], validate_kql(optimized)["error"]
+    before, after = engine.execute(query), engine.execute(optimized)
+    assert before.rows > 0
+    assert _rows(after) == _rows(before)
+    return optimized
+
+
+def test_or_chain_becomes_in(data, engine):
+    a, b = _value(data, "AuthenticationEvents", "src_ip"), _value(data, "AuthenticationEvents", "src_ip", 1)
+    query = f'AuthenticationEvents | where src_ip == "{a}" or src_ip == "{b}" or result == "result_3"'
+    optimized = _optimize_and_compare(engine, query, "-> 'src_ip in (...)'")
+    assert f'src_ip in ("{a}", "{b}")' in optimized
+
+
+def test_contains_becomes_has_for_a_hash(data, engine):
+    digest = _value(data, "ProcessEvents", "process_hash")
+    optimized = _optimize_and_compare(engine, f'ProcessEvents | where process_hash contains "{digest}"', "-> 'has'")
+    assert f'process_hash has "{digest}"' in optimized
+
+
+@pytest.mark.parametrize("query", [
+    'InboundBrowsing | where src_ip contains "10.0.0.1"',
+    'InboundBrowsing | where url contains "alpha1.com"',
+    'ProcessEvents | where process_hash !contains "d41d8cd98f00b204e9800998ecf8427e"',
+])
+def test_contains_kept_when_has_would_match_differently(query):
+    optimized, notes = KQLOptimizer(time_window=None).optimize(query)
+    assert optimized == query and notes == []
+
+
+def test_filter_moves_in_front_of_inner_join(data, engine):
+    name = _value(data, "ProcessEvents", "process_name")
+    query = (f'ProcessEvents | join kind=inner (FileCreationEvents) on hostname '
+             f'| where process_name == "{name}" and filename != "x"')
+    optimized = _optimize_and_compare(engine, query, "in front of the inner join")
+    assert optimized.index(f'process_name == "{name}"') < optimized.index("join")
+
+
+@pytest.mark.parametrize("join", ["join", "join kind=innerunique"])
+def test_filter_stays_after_innerunique_join(join):
+    query = f'ProcessEvents | {join} (FileCreationEvents) on hostname | where process_name == "cmd.exe"'
+    optimized, notes = KQLOptimizer(time_window=None).optimize(query)
+    assert optimized == query and notes == []
+
+
+def test_filter_moves_into_union_legs(data, engine):
+    ip = _value(data, "InboundBrowsing", "src_ip")
+    query = f'union InboundBrowsing, OutBoundBrowsing | where src_ip == "{ip}" | project src_ip, url'
+    optimized = _optimize_and_compare(engine, query, "into every input of the union")
+    assert optimized.startswith(f'union (InboundBrowsing | where src_ip == "{ip}")')
+
+
+def test_project_added_before_join(data, engine):
+    query = ('ProcessEvents | join kind=inner (FileCreationEvents | project hostname, filename) on hostname '
+             '| project hostname, process_name, filename')
+    optimized = _optimize_and_compare(engine, query, "before the join")
+    assert optimized.index("| project") < optimized.index("join")
+
+
+def test_time_window_added_to_event_tables_only():
+    optimizer = KQLOptimizer()
+    optimized, notes = optimizer.optimize('AuthenticationEvents | where result == "Failed"')
+    assert "where timestamp_1 > ago(7d)" in optimized and len(notes) == 1
+    assert optimizer.optimize("PassiveDNS | take 5") == ("PassiveDNS | take 5", [])
+
+
+def test_time_window_added_to_each_union_input():
+    optimized, notes = KQLOptimizer().optimize('union InboundBrowsing, OutBoundBrowsing | where src_ip == "x"')
+    assert optimized == ('union (InboundBrowsing | where timestamp_1 > ago(7d) | where src_ip == "x"), '
+                         '(OutBoundBrowsing | where timestamp_1 > ago(7d) | where src_ip == "x")')
+    assert sum("input of the union: it had no time bound" in note for note in notes) == 2
+    assert validate_kql(optimized)["is_valid"], validate_kql(optimized)["error"]
+
+
+def test_union_time_window_skips_reference_tables_and_timed_queries():
+    optimizer = KQLOptimizer()
+    optimized, notes = optimizer.optimize("union InboundBrowsing, PassiveDNS | take 5")
+    assert optimized == "union (InboundBrowsing | where timestamp_1 > ago(7d)), PassiveDNS\n| take 5"
+    assert len(notes) == 1
+    optimized, _ = optimizer.optimize("union InboundBrowsing, OutBoundBrowsing | where timestamp_1 > ago(1d)")
+    assert "ago(7d)" not in optimized
@@ -0,0 +1,52 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from nl2kql_agent import schemas
+from nl2kql_agent.prompts import PROMPT_PREFIXES, CachedPrompt
+from nl2kql_agent.schemas import TABLE_SCHEMAS, SchemaRegistry
+
+
+def _prompt(name="test", **kwargs):
+    return CachedPrompt(name, "  Answer in KQL.  ", suffix="\nRequest: {query}\n", **kwargs)
+
+
+def test_prefix_is_memoized_for_any_table_order(monkeypatch):
+    monkeypatch.setattr(schemas, "_registry", SchemaRegistry(TABLE_SCHEMAS))
+    prompt = _prompt("test_memoized")
+    first = prompt.prefix(["PassiveDNS", "Email"])
+    assert prompt.prefix(("Email", "PassiveDNS", "Email")) is first
+    assert PROMPT_PREFIXES.value(prompt="test_memoized", result="rendered") == 1
+    assert PROMPT_PREFIXES.value(prompt="test_memoized", result="memoized") == 1
+    assert first.content.startswith("Answer in KQL.\n\nTables and their schemas:\n")
+    assert first.content.index("Email") < first.content.index("PassiveDNS")
+
+
+def test_schema_change_renders_a_new_prefix(monkeypatch):
+    monkeypatch.setattr(schemas, "_registry", SchemaRegistry(TABLE_SCHEMAS))
+    prompt = _prompt()
+    before = prompt.prefix(["PassiveDNS"])
+    monkeypatch.setattr(schemas, "_registry", SchemaRegistry({**TABLE_SCHEMAS, "PassiveDNS": [("ip", "string")]}))
+    after = prompt.prefix(["PassiveDNS"])
+    assert after is not before
+    assert "- domain (string)" in before.content and "- domain (string)" not in after.content
+
+
+def test_least_recently_used_prefix_is_dropped(monkeypatch):
+    monkeypatch.setattr(schemas, "_registry", SchemaRegistry(TABLE_SCHEMAS))
+    prompt = _prompt(max_prefixes=2)
+    dns, email = prompt.prefix(["PassiveDNS"]), prompt.prefix(["Email"])
+    assert prompt.prefix(["PassiveDNS"]) is dns
+    prompt.prefix(["ProcessEvents"])
+    assert len(prompt._prefixes) == 2
+    assert prompt.prefix(["PassiveDNS"]) is dns
+    assert prompt.prefix(["Email"]) is not email
+
+
+def test_format_messages_puts_history_between_prefix_and_suffix(monkeypatch):
+    monkeypatch.setattr(schemas, "_registry", SchemaRegistry(TABLE_SCHEMAS))
+    prompt = _prompt()
+    history = [HumanMessage(content="earlier"), AIMessage(content="Generated KQL: Email | take 1")]
+    messages = prompt.format_messages(["Email"], history, query="phishing {links}")
+    assert messages[0] is prompt.prefix(["Email"]) and isinstance(messages[0], SystemMessage)
+    assert messages[1:3] == history
+    assert isinstance(messages[3], HumanMessage) and messages[3].content == "Request: phishing {links}"
+    assert len(prompt.format_messages(["Email"], query="x")) == 2
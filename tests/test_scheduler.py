@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+from nl2kql_agent.fake_llm import FakeChatModel, FakeLLMError, FakeRateLimitError
+from nl2kql_agent.llm import LLMScheduler, ScheduledLLM, TokenBucket, is_rate_limit, is_retryable, priority_class
+
+PROMPT = [HumanMessage(content="Files with hash d41d8cd98f00b204e9800998ecf8427e")]
+
+
+def test_token_bucket_refills_and_can_be_corrected():
+    bucket = TokenBucket(60, capacity=10)  # one per second
+    start = bucket.updated
+    bucket.take(10, now=start)
+    assert bucket.wait_time(2, now=start) == pytest.approx(2.0)
+    assert bucket.wait_time(2, now=start + 1) == pytest.approx(1.0)
+    # More than the capacity waits for a full bucket, not forever.
+    assert bucket.wait_time(50, now=start + 1) == pytest.approx(9.0)
+    bucket.adjust(-100)
+    assert bucket.level == 10
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_errors_are_classified_by_status_or_name():
+    assert is_rate_limit(FakeRateLimitError("429")) and is_retryable(FakeRateLimitError("429"))
+    assert not is_retryable(FakeLLMError("boom"))
+    ResourceExhausted = type("ResourceExhausted", (Exception,), {})
+    assert is_rate_limit(ResourceExhausted())
+    error = RuntimeError("bad gateway")
+    error.status_code = 502
+    assert is_retryable(error) and not is_rate_limit(error)
+
+
+def test_waiting_calls_are_admitted_by_priority():
+    scheduler = LLMScheduler(requests_per_minute=600)  # ten per second
+    scheduler._request_bucket.level = 0
+    order = []
+
+    def call(name, cls, kind):
+        with priority_class(cls):
+            scheduler.acquire(scheduler.ticket(kind, PROMPT))
+        order.append(name)
+
+    threads = [
+        threading.Thread(target=call, args=("batch", "batch", "generation")),
+        threading.Thread(target=call, args=("reflection", "interactive", "reflection")),
+        threading.Thread(target=call, args=("generation", "interactive", "generation")),
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert order == ["generation", "reflection", "batch"]
+    assert scheduler.stats["calls"] == 3
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_rate_limited_calls_are_retried(use_async):
+    scheduler = LLMScheduler(base_delay=0.01, seed=0)
+    # With seed 1 the first call draws 0.13 (throttled) and the second 0.85.
+    llm = ScheduledLLM(FakeChatModel(throttle_rate=0.5, seed=1), scheduler)
+    response = asyncio.run(llm.ainvoke(PROMPT)) if use_async else llm.invoke(PROMPT)
+    assert response.content
+    assert scheduler.stats["retries"] == scheduler.stats["rate_limited"] == 1
+
+
+def test_backoff_honours_retry_after_and_gives_up():
+    scheduler = LLMScheduler(max_retries=2, max_delay=5.0, seed=0)
+    assert scheduler.backoff(FakeRateLimitError("429", retry_after=60), attempt=0) == 5.0
+    assert scheduler._paused_until > time.monotonic()
+    assert 0 <= scheduler.backoff(FakeRateLimitError("429"), attempt=1) <= 1.0
+    assert scheduler.backoff(FakeRateLimitError("429"), attempt=2) is None
+    assert scheduler.backoff(FakeLLMError("boom"), attempt=0) is None
+    with pytest.raises(FakeLLMError):
+        ScheduledLLM(FakeChatModel(error_rate=1.0), LLMScheduler()).invoke(PROMPT)
+
+
+def _drain(llm, use_async):
+    async def collect():
+        return [chunk async for chunk in llm.astream(PROMPT)]
+    return asyncio.run(collect()) if use_async else list(llm.stream(PROMPT))
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_streamed_calls_settle_their_token_charge(use_async):
+    scheduler = LLMScheduler(tokens_per_minute=6000, expected_output_tokens=1000)
+    chunks = _drain(ScheduledLLM(FakeChatModel(), scheduler), use_async)
+    usage = chunks[-1].usage_metadata
+    charged = scheduler._token_bucket.capacity - scheduler._token_bucket.level
+    # Charged what was used, not the up-front estimate of 1000 output tokens.
+    assert charged == pytest.approx(usage["input_tokens"] + usage["output_tokens"], abs=5)
@@ -0,0 +1,70 @@
+import json
+import threading
+
+from nl2kql_agent import schemas
+from nl2kql_agent.iocs import column_index
+from nl2kql_agent.schemas import TABLE_KEYWORDS, TABLE_SCHEMAS, SchemaRegistry
+
+
+def test_duplicate_columns_keep_the_string_type():
+    registry = SchemaRegistry(TABLE_SCHEMAS, keywords=TABLE_KEYWORDS)
+    fields = registry["Email"]
+    assert [column for column, _ in fields].count("link") == 1
+    assert ("link", "string") in fields
+    assert ("Email", "link", "guid") in registry.duplicates
+    assert ("Email", "link") in column_index(registry)["url"]
+
+
+def test_duplicates_keep_their_first_position():
+    registry = SchemaRegistry({"T": [("a", "guid"), ("b", "int"), ("a", "string"), ("b", "long")]})
+    assert registry["T"] == [("a", "string"), ("b", "int")]
+    assert registry.duplicates == [("T", "a", "guid"), ("T", "b", "long")]
+
+
+def test_loads_a_schema_file_lazily(tmp_path):
+    path = tmp_path / "schema.json"
+    path.write_text(json.dumps([{"name": "Proxy", "columns": [["client_ip", "string"], ["ts", "datetime"]],
+                                 "keywords": ["proxy"]}]))
+    registry = SchemaRegistry.from_file(str(path))
+    path.write_text(json.dumps([{"name": "Proxy", "columns": [["client_ip", "string"]]}]))
+    # Nothing is read until the first access.
+    assert list(registry) == ["Proxy"]
+    assert registry["Proxy"] == [("client_ip", "string")]
+
+
+def test_render_is_memoized_and_version_tracks_changes():
+    registry = SchemaRegistry(TABLE_SCHEMAS)
+    block = registry.render("PassiveDNS")
+    assert block is registry.render("PassiveDNS")
+    assert "- ip (string)" in block and "- domain (string)" in block
+    assert "not found" in registry.render("Nope")
+    changed = SchemaRegistry({**TABLE_SCHEMAS, "PassiveDNS": [("ip", "string")]})
+    assert registry.version == SchemaRegistry(TABLE_SCHEMAS).version != changed.version
+
+
+def test_candidates_rank_by_lexical_relevance_and_fill_up_to_k():
+    registry = SchemaRegistry(TABLE_SCHEMAS, keywords=TABLE_KEYWORDS)
+    assert registry.candidates("phishing emails with attachments", k=3)[0] == "Email"
+    assert registry.candidates("powershell command lines", k=2)[0] == "ProcessEvents"
+    assert len(registry.candidates("zzz", k=5)) == 5
+    assert registry.candidates("failed logins", k=1) == ["AuthenticationEvents"]
+
+
+def test_get_registry_builds_one_registry_for_concurrent_callers(monkeypatch):
+    monkeypatch.setattr(schemas, "_registry", None)
+    seen = []
+    threads = [threading.Thread(target=lambda: seen.append(schemas.get_registry())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(registry) for registry in seen}) == 1
+
+
+def test_get_registry_reads_paths_from_settings(monkeypatch, tmp_path):
+    path = tmp_path / "schema.json"
+    path.write_text(json.dumps({"Proxy": [["client_ip", "string"]]}))
+    monkeypatch.setattr(schemas, "_registry", None)
+    monkeypatch.setattr(schemas, "get_setting", lambda name, default=None: {
+        "NL2KQL_SCHEMA_PATH": str(path)}.get(name, default))
+    assert list(schemas.get_registry()) == ["Proxy"]
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from nl2kql_agent.service import QueryService, ServiceOverloaded, SingleFlight, make_server
+
+
+class _GatedApp:
+    """Pipeline stand-in that blocks until the test opens the gate."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.started = threading.Semaphore(0)
+        self.calls = 0
+
+    def invoke(self, state):
+        self.calls += 1
+        self.started.release()
+        self.gate.wait(5)
+        return {"user_query": state["user_query"], "kql_query": "PassiveDNS | take 1", "validation_status": "valid",
+                "chat_history": []}
+
+
+def _wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_single_flight_runs_once_per_key():
+    flight, gate, calls = SingleFlight(), threading.Event(), []
+
+    def fn():
+        calls.append(1)
+        gate.wait(5)
+        return "result"
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(flight.do, "k", fn) for _ in range(4)]
+        _wait_until(lambda: calls)
+        time.sleep(0.1)  # let the other callers join the flight
+        gate.set()
+        outcomes = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in outcomes) == [False, True, True, True]
+    assert {result for result, _ in outcomes} == {"result"}
+    # The key is free again once the run is over.
+    assert flight.do("k", lambda: "again") == ("again", False)
+
+
+def test_single_flight_shares_the_error():
+    flight = SingleFlight()
+    with pytest.raises(KeyError):
+        flight.do("k", lambda: {}["missing"])
+    assert flight.do("k", lambda: 1) == (1, False)
+
+
+def test_identical_queries_are_coalesced():
+    app = _GatedApp()
+    service = QueryService(app=app, max_workers=2, max_queue=0)
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(service.run, "hunt  for x")
+        app.started.acquire(timeout=2)
+        second = pool.submit(service.run, "hunt for x")
+        time.sleep(0.1)
+        app.gate.set()
+        assert sorted([first.result()[1], second.result()[1]]) == [False, True]
+    assert app.calls == 1
+    service.close()
+
+
+def test_full_queue_is_rejected_and_slots_are_released():
+    app = _GatedApp()
+    service = QueryService(app=app, max_workers=1, max_queue=1)
+    with ThreadPoolExecutor(2) as pool:
+        running = [pool.submit(service.run, f"hunt {i}") for i in range(2)]
+        _wait_until(lambda: service.pending == 2)
+        with pytest.raises(ServiceOverloaded):
+            service.run("hunt 3")
+        app.gate.set()
+        assert all(future.result()[0]["validation_status"] == "valid" for future in running)
+    _wait_until(lambda: service.pending == 0)
+    service.close()
+
+
+def test_timed_out_pipeline_keeps_its_slot_until_it_finishes():
+    app = _GatedApp()
+    service = QueryService(app=app, max_workers=1, max_queue=0, timeout=0.05)
+    with pytest.raises(FutureTimeoutError):
+        service.run("slow")
+    assert service.pending == 1
+    with pytest.raises(ServiceOverloaded):
+        service.run("next")
+    app.gate.set()
+    _wait_until(lambda: service.pending == 0)
+    assert service.run("next")[0]["user_query"] == "next"
+    service.close()
+
+
+@pytest.fixture
+def server():
+    app = _GatedApp()
+    service = QueryService(app=app, max_workers=1, max_queue=0)
+    httpd = make_server(service, port=0)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield app, service, f"http://127.0.0.1:{httpd.server_address[1]}"
+    app.gate.set()
+    httpd.shutdown()
+    httpd.server_close()
+    service.close()
+
+
+def _post(url, body):
+    request = urllib.request.Request(url + "/query", data=json.dumps(body).encode(), method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, dict(response.headers), json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), json.loads(e.read())
+
+
+def test_http_answers_rejects_with_503_and_exports_metrics(server):
+    app, service, url = server
+    with ThreadPoolExecutor(1) as pool:
+        busy = pool.submit(_post, url, {"query": "first"})
+        app.started.acquire(timeout=2)
+        status, headers, payload = _post(url, {"query": "second"})
+        assert status == 503 and headers["Retry-After"] == "1"
+        app.gate.set()
+        status, _, payload = busy.result()
+    assert status == 200
+    assert payload["kql_query"] == "PassiveDNS | take 1" and payload["coalesced"] is False
+    assert "chat_history" not in payload
+
+    assert _post(url, {"query": "  "})[0] == 400
+    _wait_until(lambda: service.pending == 0)
+    with urllib.request.urlopen(url + "/healthz", timeout=5) as response:
+        assert json.loads(response.read()) == {"status": "ok", "pending": 0}
+    with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+        text = response.read().decode()
+    assert 'nl2kql_service_requests_total{outcome="rejected"}' in text
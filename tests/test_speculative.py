@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from nl2kql_agent.fake_llm import FakeChatModel
+from nl2kql_agent.llm import set_llm_factory
+from nl2kql_agent.tools.kql_generator import NL2KQLGenerator
+
+STATE = {"enriched_query": "Failed logins from 10.0.0.5", "shortlisted_tables": ["AuthenticationEvents"]}
+VALID = 'AuthenticationEvents | where src_ip == "10.0.0.5"'
+
+
+def _invalid(i):
+    return f'AuthenticationEvents | where source_{i} == "10.0.0.5"'
+
+
+@pytest.fixture
+def candidates():
+    """Installs one FakeChatModel per candidate temperature: {temperature: (latency, answer)}."""
+    prompts = {}
+
+    def install(plan):
+        def factory(name, temperature):
+            latency, answer = plan[temperature]
+
+            def responder(messages, rng):
+                prompts[temperature] = messages
+                if isinstance(answer, Exception):
+                    raise answer
+                return answer
+            return FakeChatModel(latency=latency, responder=responder)
+        set_llm_factory(factory)
+        return prompts
+
+    yield install
+    set_llm_factory(None)
+
+
+def _run(generator, use_async):
+    return asyncio.run(generator.acall(STATE)) if use_async else generator(STATE)
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_first_valid_candidate_wins(candidates, use_async):
+    prompts = candidates({0.2: (0.0, _invalid(0)), 0.6: (0.05, VALID), 0.9: (2.0, VALID)})
+    update = _run(NL2KQLGenerator(candidates=3), use_async)
+    assert update["kql_query"] == VALID and update["validation_status"] == "pending"
+    # Each candidate after the first gets its own prompt hint.
+    assert prompts[0.6][-1].content == NL2KQLGenerator.CANDIDATE_HINTS[1]
+    assert prompts[0.2][-1].content != NL2KQLGenerator.CANDIDATE_HINTS[1]
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_without_a_valid_candidate_the_lowest_index_goes_to_the_validator(candidates, use_async):
+    candidates({0.2: (0.1, _invalid(0)), 0.6: (0.05, _invalid(1)), 0.9: (0.0, _invalid(2))})
+    update = _run(NL2KQLGenerator(candidates=3), use_async)
+    assert update["kql_query"] == _invalid(0) and update["validation_status"] == "pending"
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_failed_candidates_are_skipped_until_all_fail(candidates, use_async):
+    candidates({0.2: (0.0, RuntimeError("boom")), 0.6: (0.02, _invalid(1))})
+    assert _run(NL2KQLGenerator(candidates=2), use_async)["kql_query"] == _invalid(1)
+
+    candidates({0.2: (0.0, RuntimeError("boom")), 0.6: (0.0, RuntimeError("boom"))})
+    update = _run(NL2KQLGenerator(candidates=2), use_async)
+    assert update["validation_status"] == "failed" and update["validation_error"] == "boom"
+
+
+def test_rejects_zero_candidates():
+    with pytest.raises(ValueError):
+        NL2KQLGenerator(candidates=0)
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from nl2kql_agent.kql_parser import IncrementalValidator
+from nl2kql_agent.tools.kql_generator import NL2KQLGenerator
+
+STATE = {"enriched_query": "Failed logins from 10.0.0.5", "shortlisted_tables": ["AuthenticationEvents"]}
+INVALID = 'AuthenticationEvents | where source == "10.0.0.5" | where result == "Failed" | project timestamp_1, username'
+VALID = 'AuthenticationEvents | where src_ip == "10.0.0.5" | where result == "Failed" | project timestamp_1, username'
+
+
+def _generator(text):
+    tokens = []
+    generator = NL2KQLGenerator(stream=True, on_token=tokens.append)
+    # GenericFakeChatModel streams its message word by word.
+    generator.llm = GenericFakeChatModel(messages=iter([AIMessage(content=text)]))
+    return generator, tokens
+
+
+def test_incremental_validator_aborts_at_the_first_bad_prefix():
+    validator = IncrementalValidator()
+    assert validator.feed("AuthenticationEvents ") is None
+    assert validator.feed('| where source == "x" ') is None  # the stage is not finished yet
+    failure = validator.feed("| take 1")
+    assert failure is not None and "Column 'source' does not exist" in failure["error"]
+    assert validator.feed(" more") is failure
+
+
+def test_unknown_table_aborts_after_the_first_word():
+    assert IncrementalValidator().feed("Nope | take 1") is not None
+    # A prefix that does not parse yet is not an error.
+    assert IncrementalValidator().feed("AuthenticationEvents | where (") is None
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_stream_is_cancelled_on_an_invalid_prefix(use_async):
+    generator, tokens = _generator(INVALID)
+    update = asyncio.run(generator.acall(STATE)) if use_async else generator(STATE)
+    assert update["validation_status"] == "aborted"
+    assert "Column 'source' does not exist" in update["validation_error"]
+    assert "project" not in "".join(tokens)  # nothing after the failing stage was consumed
+    assert update["kql_query"] == "".join(tokens).strip()
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_valid_stream_is_returned_whole(use_async):
+    generator, tokens = _generator(VALID)
+    update = asyncio.run(generator.acall(STATE)) if use_async else generator(STATE)
+    assert update["validation_status"] == "pending"
+    assert update["kql_query"] == VALID == "".join(tokens)
@@ -1,6 +1,8 @@
-from typing import TypedDict, List, Any
+from typing import Annotated, TypedDict, List, Dict, Any
 from langchain_core.messages import BaseMessage
 
+from .history import add_history
+
 class ThreatIntelState(TypedDict, total=False):
     """
     Represents the state of our threat intelligence system.
@@ -9,17 +11,67 @@ class ThreatIntelState(TypedDict, total=False):
         user_query (str): The original natural language query from the user.
         enriched_query (str): The enriched query with identified IoCs.
         shortlisted_tables (List[str]): Names of tables selected by the enricher.
+        iocs (List[Dict[str, str]]): IoCs found in the user query, as {"type", "value"} dicts.
         kql_query (str): The generated KQL query.
-        validation_status (str): Status of KQL validation (e.g., "valid", "invalid", "retrying").
+        optimizations (List[str]): Rewrites the optimizer applied to kql_query, one reason each.
+        validation_status (str): Status of KQL validation (e.g., "valid", "invalid", "retrying", "aborted").
         validation_error (str): Error message if KQL validation fails.
+        cost_estimate (Dict[str, Any]): Estimated scan bytes, rows and largest join of kql_query,
+            when the validator has a CostModel.
+        dry_run (Dict[str, Any]): Rows, scanned rows/bytes and timing of kql_query on sample data,
+            when the validator has a DryRunPolicy.
         retries (int): Number of times a query has been retried after validation failure.
         chat_history (List[BaseMessage]): History of messages for conversational context.
+            Nodes return only the messages they add; the add_history reducer appends them and
+            caps the stored list.
+        cache_hit (bool): True when the result was served from the NL->KQL cache.
+        follow_up (bool): True for a further turn of a session (see follow_up_state); such
+            turns depend on the previous turn and never use the NL->KQL cache.
     """
     user_query: str
     enriched_query: str
     shortlisted_tables: List[str]
+    iocs: List[Dict[str, str]]
     kql_query: str
+    optimizations: List[str]
     validation_status: str
     validation_error: str
+    cost_estimate: Dict[str, Any]
+    dry_run: Dict[str, Any]
     retries: int
-    chat_history: List[BaseMessage]
+    chat_history: Annotated[List[BaseMessage], add_history]
+    cache_hit: bool
+    follow_up: bool
+
+
+def initial_state(user_query: str) -> ThreatIntelState:
+    """Returns a fresh state for a new hunt."""
+    return {
+        "user_query": user_query,
+        "enriched_query": "",
+        "shortlisted_tables": [],
+        "kql_query": "",
+        "optimizations": [],
+        "validation_status": "",
+        "validation_error": "",
+        "retries": 0,
+        "chat_history": [],
+        "follow_up": False,
+    }
+
+
+def follow_up_state(user_query: str) -> ThreatIntelState:
+    """
+    Input for a further turn on a checkpointed thread: resets the per-turn
+    fields but keeps enriched_query, shortlisted_tables, iocs and chat_history,
+    so the enricher can reuse them.
+    """
+    return {
+        "user_query": user_query,
+        "kql_query": "",
+        "optimizations": [],
+        "validation_status": "",
+        "validation_error": "",
+        "retries": 0,
+        "follow_up": True,
+    }
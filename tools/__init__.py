@@ -1,10 +1,29 @@
 """
 Tools package for the NL2KQL Agent.
-Contains the three main LangGraph nodes: enricher, kql_generator, and validator.
+Contains the LangGraph nodes: enricher, kql_generator, kql_optimizer, and validator.
+Each node module is imported on first access.
 """
 
-from .enricher import UserQueryEnricher
-from .kql_generator import NL2KQLGenerator
-from .validator import QueryValidator
+import importlib
 
-__all__ = ["UserQueryEnricher", "NL2KQLGenerator", "QueryValidator"]
+_LAZY_ATTRIBUTES = {
+    "UserQueryEnricher": ".enricher",
+    "NL2KQLGenerator": ".kql_generator",
+    "QueryValidator": ".validator",
+    "KQLOptimizer": ".optimizer",
+}
+
+__all__ = ["UserQueryEnricher", "NL2KQLGenerator", "QueryValidator", "KQLOptimizer"]
+
+
+def __getattr__(name: str):
+    module = _LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
@@ -1,43 +1,126 @@
 
 import json
-import random
-from typing import List
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+import logging
+from typing import Any, Generator, List, Optional
+from langchain_core.messages import AIMessage
 
-from ..llm import get_llm
-from ..schemas import schema_as_string, ALL_TABLE_NAMES
+from ..history import DEFAULT_HISTORY_POLICY, HistoryPolicy
+from ..iocs import Enrichment, enrich, extract_iocs
+from ..llm import LazyLLM, arun_steps, run_steps
+from ..prompts import CachedPrompt
+from ..schemas import get_registry
 from ..threat_intel_types import ThreatIntelState
 
+logger = logging.getLogger(__name__)
+
 
 class UserQueryEnricher:
     """Enriches a user query and picks four tables."""
 
-    PROMPT = ChatPromptTemplate.from_messages([
-        ("system", """
+    # Rule-based results at or above this confidence skip the LLM entirely.
+    MIN_CONFIDENCE = 0.5
+    NUM_TABLES = 4
+    # Only this many lexically ranked candidate tables are embedded in the LLM prompt.
+    LLM_CANDIDATE_TABLES = 12
+    # Separates a session's first request from the follow-ups appended to its enriched query.
+    FOLLOW_UP_MARKER = "\nFollow-up request: "
+
+    llm = LazyLLM(temperature=0.0)
+
+    PROMPT = CachedPrompt("enricher", """
 You are an expert threat intelligence analyst. Your task is to enrich a natural language user query into a precise threat hunting request.
 Identify potential Indicators of Compromise (IoCs) like IP addresses, domains, hashes, or email addresses from the user query.
-Based on the identified IoCs and the nature of the request, shortlist exactly 4 relevant security log tables from the following available tables.
+Based on the identified IoCs and the nature of the request, shortlist exactly 4 relevant security log tables from the available tables listed below.
 For each shortlisted table, explain why it's relevant.
 
-Available Security Log Tables and their schemas:
-{table_schemas}
-
 Your output MUST be a JSON object with two keys:
 1. "enriched_query": A detailed threat hunting request based on the user's query, specifying the IoCs and the type of activity to look for.
 2. "shortlisted_tables": A JSON array of the 4 selected table names.
 
 Example Input: "Find activities related to malicious IP address 192.168.1.1"
 Example Output:
-{{
+{
     "enriched_query": "Identify network connections and associated processes linked to the malicious IP address 192.168.1.1.",
     "shortlisted_tables": ["InboundBrowsing", "OutBoundBrowsing", "ProcessEvents", "AuthenticationEvents"]
-}}
-        """),
-        MessagesPlaceholder(variable_name="chat_history")
-    ])
+}
+        """, suffix="{user_query}", schema_heading="Available Security Log Tables and their schemas:")
+
+    def __init__(self, history_policy: HistoryPolicy = DEFAULT_HISTORY_POLICY):
+        self.history_policy = history_policy
+
+    def _llm_messages(self, user_query: str, chat_history: List) -> List:
+        candidates = get_registry().candidates(user_query, k=self.LLM_CANDIDATE_TABLES)
+        return self.PROMPT.format_messages(candidates, self.history_policy.select(chat_history), user_query=user_query)
+
+    def _parse_llm_enrichment(self, llm_response, fallback: Enrichment) -> Enrichment:
+        content = llm_response.content if isinstance(llm_response.content, str) else "".join(
+            part for part in llm_response.content if isinstance(part, str)
+        )
+        content = content.strip()
+        if content.startswith("```"):
+            content = content.strip("`").split("\n", 1)[-1]
+        parsed = json.loads(content[content.find("{"):content.rfind("}") + 1])
+        registry = get_registry()
+        tables = [t for t in parsed.get("shortlisted_tables", []) if t in registry]
+        if not tables:
+            raise ValueError("LLM did not shortlist any known table.")
+        return Enrichment(
+            enriched_query=parsed.get("enriched_query") or fallback.enriched_query,
+            shortlisted_tables=tables[:self.NUM_TABLES],
+            iocs=fallback.iocs,
+            confidence=1.0,
+        )
+
+    def _apply(self, result: Enrichment, source: str) -> ThreatIntelState:
+        logger.info("Enriched Query (%s, confidence=%.1f): %s", source, result.confidence, result.enriched_query)
+        logger.info("Shortlisted Tables: %s", result.shortlisted_tables)
+
+        return {
+            "enriched_query": result.enriched_query,
+            "shortlisted_tables": result.shortlisted_tables,
+            "iocs": [{"type": ioc.type, "value": ioc.value} for ioc in result.iocs],
+            "chat_history": [AIMessage(
+                content=f"Enriched query: {result.enriched_query}\nShortlisted tables: {', '.join(result.shortlisted_tables)}"
+            )],
+        }
+
+    def _follow_up(self, state: ThreatIntelState) -> Optional[ThreatIntelState]:
+        """
+        On a later turn of a checkpointed session (see follow_up_state), keeps
+        the previous turn's tables and IoCs when the new request names no IoCs
+        of its own, and appends the request to the enriched query.
+        """
+        previous = state.get("enriched_query", "")
+        tables = state.get("shortlisted_tables", [])
+        user_query = state.get("user_query", "")
+        if not previous or not tables or extract_iocs(user_query):
+            return None
+        first_request = previous.split(self.FOLLOW_UP_MARKER, 1)[0]
+        result = Enrichment(f"{first_request}{self.FOLLOW_UP_MARKER}{user_query.strip()}", list(tables), [], 1.0)
+        update = self._apply(result, "previous turn")
+        update["iocs"] = list(state.get("iocs", []))
+        return update
+
+    def _steps(self, state: ThreatIntelState) -> Generator[List, Any, ThreatIntelState]:
+        """Yields the LLM request, if the rules are not confident enough, and returns the update."""
+        logger.info("[Query Enricher]")
+        follow_up = self._follow_up(state)
+        if follow_up is not None:
+            return follow_up
+        user_query = state.get("user_query", "")
+        result = enrich(user_query, k=self.NUM_TABLES)
+        if result.confidence >= self.MIN_CONFIDENCE:
+            return self._apply(result, "rules")
+        try:
+            llm_response = yield self._llm_messages(user_query, state.get("chat_history", []))
+            return self._apply(self._parse_llm_enrichment(llm_response, result), "llm")
+        except Exception as e:
+            logger.warning("LLM enrichment failed, using rule-based result: %s", e)
+            return self._apply(result, "rules")
 
     def __call__(self, state: ThreatIntelState) -> ThreatIntelState:
-        # Real implementation (if not already present, add logic here)
-        # This is a placeholder; actual enrichment logic should be implemented.
-        return state
+        return run_steps(self._steps(state), self.llm.invoke)
+
+    async def acall(self, state: ThreatIntelState) -> ThreatIntelState:
+        """Async variant of __call__; awaits the LLM instead of blocking on it."""
+        return await arun_steps(self._steps(state), self.llm.ainvoke)
@@ -1,81 +1,248 @@
+import asyncio
+import logging
+from concurrent.futures import as_completed
+from typing import Callable, Generator, List, Optional, Tuple
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 
-## 8. nl2kql_agent/tools/kql_generator.py
-from typing import List
-from langchain_core.messages import AIMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-
-from ..llm import get_llm
-from ..schemas import schema_as_string
+from ..history import DEFAULT_HISTORY_POLICY, HistoryPolicy
+from ..kql_parser import IncrementalValidator, validate_kql
+from ..llm import LazyLLM, arun_steps, get_llm, run_steps
+from ..prompts import CachedPrompt
 from ..threat_intel_types import ThreatIntelState
 
+logger = logging.getLogger(__name__)
 
 
 class NL2KQLGenerator:
     """Generates KQL queries from enriched natural language queries."""
-    # Removed duplicate __call__ method to resolve method name conflict.
 
-    PROMPT = ChatPromptTemplate.from_messages([
-        ("system", """
+    PROMPT = CachedPrompt("kql_generator", """
 You are an expert in Kusto Query Language (KQL) and a security analyst.
-Your task is to generate a semantically correct KQL query based on the provided enriched threat hunting request and the schemas of the shortlisted tables.
+Your task is to generate a semantically correct KQL query based on the enriched threat hunting request at the end of the conversation and the schemas of the shortlisted tables below.
 Focus on extracting the relevant information from the tables using appropriate KQL operators (e.g., `where`, `contains`, `has`, `startswith`, `endswith`, `project`, `join`).
 Ensure the query uses the exact table and field names as provided in the schema.
 If multiple tables are shortlisted, consider if a `union` or `join` operation is appropriate, or if separate queries are needed. For simplicity, prioritize single table queries first, then consider `union` if the request clearly spans multiple tables for the same type of data.
-
-Shortlisted Tables and their Schemas:
-{shortlisted_table_schemas}
-
+Your output MUST be ONLY the KQL query string, without any additional text, explanations, or markdown formatting (e.g., no ```kql).
+        """, suffix="""
 Enriched Threat Hunting Request:
 {enriched_query}
+        """, schema_heading="Shortlisted Tables and their Schemas:")
 
-Your output MUST be ONLY the KQL query string, without any additional text, explanations, or markdown formatting (e.g., no ```kql).
-        """),
-        MessagesPlaceholder(variable_name="chat_history")
-    ])
+    # Speculative mode: candidate i uses the i-th temperature and hint (cycling).
+    CANDIDATE_TEMPERATURES = (0.2, 0.6, 0.9, 1.0)
+    CANDIDATE_HINTS = (
+        "",
+        "Use only table and column names that appear verbatim in the schemas above.",
+        "Prefer the simplest single-table query that answers the request.",
+        "Check every table and column name against the schemas before answering.",
+    )
 
-    def __init__(self):
-        self.llm = get_llm(temperature=0.2)
+    llm = LazyLLM(temperature=CANDIDATE_TEMPERATURES[0])
 
-    def __call__(self, state: ThreatIntelState) -> ThreatIntelState:
-        print("\n[KQL Generator]")
+    def __init__(self, history_policy: HistoryPolicy = DEFAULT_HISTORY_POLICY, stream: bool = False,
+                 on_token: Optional[Callable[[str], None]] = None, candidates: int = 1):
+        """
+        With stream=True the response is consumed token by token: each chunk is
+        passed to on_token (if given) and to an IncrementalValidator, and
+        generation is cancelled as soon as the prefix references an unknown
+        table or column. Streamed tokens also reach LangGraph's
+        stream_mode="messages" through the usual callbacks.
+
+        With candidates > 1 that many queries are requested concurrently, with
+        varied temperatures and prompt hints, and the first one to pass local
+        validation is returned; the others are cancelled. If none is valid,
+        the first candidate goes to the validator for reflection as usual.
+        This mode takes precedence over stream.
+        """
+        if candidates < 1:
+            raise ValueError("candidates must be at least 1.")
+        self.history_policy = history_policy
+        self.stream = stream
+        self.on_token = on_token
+        self.candidates = candidates
+        self._candidate_llms: Optional[List] = None
+
+    def _messages(self, state: ThreatIntelState) -> List:
         # Use .get() for all optional keys to avoid KeyError
         enriched_query = state.get("enriched_query", "")
         shortlisted_tables = state.get("shortlisted_tables", [])
-        chat_history = state.get("chat_history", [])
+        chat_history = self.history_policy.select(state.get("chat_history", []))
+
+        return self.PROMPT.format_messages(shortlisted_tables, chat_history, enriched_query=enriched_query)
+
+    def _on_response(self, llm_response) -> ThreatIntelState:
+        kql_query = ""
+        if isinstance(llm_response.content, str):
+            kql_query = llm_response.content.strip()
+        else:
+            logger.warning("LLM response content for KQL generation is not a string, received type: %s", type(llm_response.content))
+            if isinstance(llm_response.content, list):
+                kql_query = "".join([part for part in llm_response.content if isinstance(part, str)]).strip()
+            if not kql_query:
+                raise ValueError("LLM response content is not a parsable string for KQL.")
+
+        logger.info("Generated KQL Query: %s", kql_query)
+
+        return {
+            "kql_query": kql_query,
+            "validation_status": "pending",
+            "chat_history": [AIMessage(content=f"Generated KQL: {kql_query}")],
+        }
+
+    def _on_error(self, e: Exception) -> ThreatIntelState:
+        logger.error("An unexpected error occurred during KQL generation: %s", e)
+        return {
+            "kql_query": f"Error generating KQL: {e}",
+            "validation_status": "failed",
+            "validation_error": str(e),
+            "chat_history": [AIMessage(content=f"Error generating KQL: {e}")],
+        }
+
+    def _on_abort(self, partial_kql: str, validation_result: dict) -> ThreatIntelState:
+        # validation_status "aborted" sends the validator straight to reflection.
+        logger.info("KQL generation aborted early: %s", validation_result["error"])
+        return {
+            "kql_query": partial_kql.strip(),
+            "validation_status": "aborted",
+            "validation_error": validation_result["error"],
+            "chat_history": [AIMessage(content=f"Aborted KQL: {partial_kql.strip()} (Error: {validation_result['error']})")],
+        }
+
+    def _on_chunk(self, chunk, validator: IncrementalValidator) -> Optional[dict]:
+        content = chunk.content
+        text = content if isinstance(content, str) else "".join(part for part in content if isinstance(part, str))
+        if not text:
+            return None
+        if self.on_token is not None:
+            self.on_token(text)
+        return validator.feed(text)
+
+    def _generate_streaming(self, msg: List) -> ThreatIntelState:
+        validator = IncrementalValidator()
+        full = None
+        stream = self.llm.stream(msg)
+        try:
+            for chunk in stream:
+                full = chunk if full is None else full + chunk
+                failure = self._on_chunk(chunk, validator)
+                if failure is not None:
+                    return self._on_abort(validator.text, failure)
+        finally:
+            stream.close()
+        if full is None:
+            raise ValueError("LLM returned an empty stream for KQL generation.")
+        return self._on_response(full)
+
+    async def _agenerate_streaming(self, msg: List) -> ThreatIntelState:
+        validator = IncrementalValidator()
+        full = None
+        stream = self.llm.astream(msg)
+        try:
+            async for chunk in stream:
+                full = chunk if full is None else full + chunk
+                failure = self._on_chunk(chunk, validator)
+                if failure is not None:
+                    return self._on_abort(validator.text, failure)
+        finally:
+            await stream.aclose()
+        if full is None:
+            raise ValueError("LLM returned an empty stream for KQL generation.")
+        return self._on_response(full)
+
+    def _candidate_requests(self, msg: List) -> List[Tuple[object, List]]:
+        if self._candidate_llms is None:
+            self._candidate_llms = [self.llm] + [
+                get_llm(temperature=self.CANDIDATE_TEMPERATURES[i % len(self.CANDIDATE_TEMPERATURES)])
+                for i in range(1, self.candidates)
+            ]
+        requests = []
+        for i, llm in enumerate(self._candidate_llms):
+            hint = self.CANDIDATE_HINTS[i % len(self.CANDIDATE_HINTS)]
+            requests.append((llm, msg + [HumanMessage(content=hint)] if hint else msg))
+        return requests
+
+    def _accept(self, index: int, llm_response, shortlisted_tables: List[str], outcome: dict) -> Optional[ThreatIntelState]:
+        """Returns the update for a locally valid candidate; remembers the lowest-index invalid one."""
+        update = self._on_response(llm_response)
+        if validate_kql(update["kql_query"], shortlisted_tables)["is_valid"]:
+            logger.info("Candidate %d of %d passed local validation.", index + 1, self.candidates)
+            return update
+        if outcome.get("fallback") is None or index < outcome["fallback"][0]:
+            outcome["fallback"] = (index, update)
+        return None
+
+    def _no_valid_candidate(self, outcome: dict) -> ThreatIntelState:
+        if outcome.get("fallback") is None:
+            raise outcome["error"]
+        index, update = outcome["fallback"]
+        logger.info("None of the %d candidates is valid; sending candidate %d to the validator.", self.candidates, index + 1)
+        return update
+
+    def _generate_speculative(self, msg: List, shortlisted_tables: List[str]) -> ThreatIntelState:
+        outcome: dict = {}
+        pool = ContextThreadPoolExecutor(max_workers=self.candidates)
+        try:
+            futures = {pool.submit(llm.invoke, m): i for i, (llm, m) in enumerate(self._candidate_requests(msg))}
+            for future in as_completed(futures):
+                try:
+                    update = self._accept(futures[future], future.result(), shortlisted_tables, outcome)
+                except Exception as e:
+                    outcome.setdefault("error", e)
+                    continue
+                if update is not None:
+                    return update
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        return self._no_valid_candidate(outcome)
 
-        shortlisted_schemas_str = schema_as_string(shortlisted_tables)
+    async def _agenerate_speculative(self, msg: List, shortlisted_tables: List[str]) -> ThreatIntelState:
+        outcome: dict = {}
 
+        async def request(index: int, llm, messages: List):
+            return index, await llm.ainvoke(messages)
+
+        tasks = [asyncio.ensure_future(request(i, llm, m)) for i, (llm, m) in enumerate(self._candidate_requests(msg))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    index, llm_response = await next_done
+                    update = self._accept(index, llm_response, shortlisted_tables, outcome)
+                except Exception as e:
+                    outcome.setdefault("error", e)
+                    continue
+                if update is not None:
+                    return update
+        finally:
+            for task in tasks:
+                task.cancel()
+        return self._no_valid_candidate(outcome)
+
+    def _generate(self, msg: List, state: ThreatIntelState) -> ThreatIntelState:
+        if self.candidates > 1:
+            return self._generate_speculative(msg, state.get("shortlisted_tables", []))
+        if self.stream:
+            return self._generate_streaming(msg)
+        return self._on_response(self.llm.invoke(msg))
+
+    async def _agenerate(self, msg: List, state: ThreatIntelState) -> ThreatIntelState:
+        if self.candidates > 1:
+            return await self._agenerate_speculative(msg, state.get("shortlisted_tables", []))
+        if self.stream:
+            return await self._agenerate_streaming(msg)
+        return self._on_response(await self.llm.ainvoke(msg))
+
+    def _steps(self, state: ThreatIntelState) -> Generator[List, ThreatIntelState, ThreatIntelState]:
+        """Yields the prompt; the caller generates from it (in the configured mode) and sends back the update."""
+        logger.info("[KQL Generator]")
         try:
-            msg = self.PROMPT.format_messages(
-                shortlisted_table_schemas=shortlisted_schemas_str,
-                enriched_query=enriched_query,
-                chat_history=chat_history
-            )
-            llm_response = self.llm.invoke(msg)
-            kql_query = ""
-            if isinstance(llm_response.content, str):
-                kql_query = llm_response.content.strip()
-            else:
-                print(f"Warning: LLM response content for KQL generation is not a string, received type: {type(llm_response.content)}")
-                if isinstance(llm_response.content, list):
-                    kql_query = "".join([part for part in llm_response.content if isinstance(part, str)]).strip()
-                if not kql_query:
-                    raise ValueError("LLM response content is not a parsable string for KQL.")
-
-            print(f"Generated KQL Query: {kql_query}")
-
-            state["kql_query"] = kql_query
-            state["validation_status"] = "pending"
-            if "chat_history" not in state or state["chat_history"] is None:
-                state["chat_history"] = []
-            state["chat_history"].append(AIMessage(content=f"Generated KQL: {kql_query}"))
-            return state
+            return (yield self._messages(state))
         except Exception as e:
-            print(f"An unexpected error occurred during KQL generation: {e}")
-            state["kql_query"] = f"Error generating KQL: {e}"
-            state["validation_status"] = "failed"
-            state["validation_error"] = str(e)
-            if "chat_history" not in state or state["chat_history"] is None:
-                state["chat_history"] = []
-            state["chat_history"].append(AIMessage(content=f"Error generating KQL: {e}"))
-            return state
+            return self._on_error(e)
+
+    def __call__(self, state: ThreatIntelState) -> ThreatIntelState:
+        return run_steps(self._steps(state), lambda msg: self._generate(msg, state))
+
+    async def acall(self, state: ThreatIntelState) -> ThreatIntelState:
+        """Async variant of __call__; awaits the LLM instead of blocking on it."""
+        return await arun_steps(self._steps(state), lambda msg: self._agenerate(msg, state))
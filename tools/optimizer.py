@@ -0,0 +1,632 @@
+"""
+Rule-based KQL optimizer that runs between generation and validation.
+
+Generated queries tend to scan more than they need to: `contains` where `has`
+could use the term index, filters after a join instead of before it, every
+column carried through a join, and no time bound at all. KQLOptimizer parses
+the query and applies rewrites that keep its meaning:
+
+- `col == "a" or col == "b"` chains become `col in ("a", "b")`.
+- `contains` becomes `has` when the literal is one complete IoC that is also
+  a single term (a hash), so both operators match the same values.
+- Conjuncts of a `where` after a join (or union) that only read left-side
+  columns move in front of it, so fewer rows are shuffled.
+- A `project` of the columns the rest of the pipeline reads is added before
+  the first join or union, when the pipeline narrows its output later.
+- Event tables without any filter on their datetime column get a default
+  window on it, e.g. `where timestamp_1 > ago(7d)`. In `union A, B | ...`
+  over bare tables each event-table input gets its own window. Parenthesized
+  inputs are pipelines of their own and are bounded as such; bare inputs of
+  a `| union` operator, or of a union that also has parenthesized inputs,
+  are left alone.
+
+Only queries that already validate are touched, untouched stages keep their
+original text, and a rewrite that would make the query invalid is dropped.
+Each rewrite is logged with its reason and listed in state["optimizations"].
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+from ..iocs import IOC_LABELS, extract_iocs
+from ..kql_parser import (
+    Binary, Call, Count, Distinct, Expr, Extend, Index, Join, KQLError, KQLRenderError, ListExpr,
+    Literal, Member, Name, Operator, Pipeline, Project, ProjectRename, Sort, Star, SubQuery,
+    Summarize, TableSource, Take, Token, UnionOperator, UnionSource, Unary, Where, parse_kql,
+    render_expr, render_name, tokenize, validate_kql,
+)
+from ..schemas import REFERENCE_TABLES, get_registry
+from ..threat_intel_types import ThreatIntelState
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIME_WINDOW = "7d"
+
+# Preferred event-time columns, before any other datetime column.
+DATETIME_COLUMNS = ("timestamp_1", "event_time_1", "timestamp")
+
+# Reference tables: their rows are not events, so a time window would drop them.
+UNTIMED_TABLES = REFERENCE_TABLES
+
+# Negated forms are left alone: where `has` and `contains` disagree, `!has`
+# keeps rows that `!contains` drops.
+_HAS_FOR_CONTAINS = {"contains": "has", "contains_cs": "has_cs"}
+
+# Join kinds whose output keeps each left row's columns as they are, so a
+# filter on left columns gives the same rows before or after the join.
+# Not innerunique (the default kind): it dedups the left side by key first,
+# so filtering before it can keep a different row per key.
+_PUSHDOWN_JOIN_KINDS = {"inner", "leftouter", "leftsemi", "leftanti", "leftantisemi"}
+
+_TIME_WINDOW_REASON = ("it had no time bound, and filtering on the datetime column first lets the cluster "
+                       "skip older extents")
+
+# Operators after which only the columns they name survive.
+_NARROWING = (Project, Summarize, Count)
+
+
+class _Skip(Exception):
+    """A rewrite does not apply to this part of the query."""
+
+
+@dataclass
+class _Stage:
+    """One `| operator` of a pipeline being rewritten, with the text it will be rendered as."""
+    op: Operator
+    text: str
+
+
+def _conjuncts(expr: Expr, op: str = "and") -> List[Expr]:
+    if isinstance(expr, Binary) and expr.op == op:
+        return _conjuncts(expr.left, op) + _conjuncts(expr.right, op)
+    return [expr]
+
+
+def _chain(exprs: Sequence[Expr], op: str = "and") -> Expr:
+    result = exprs[0]
+    for expr in exprs[1:]:
+        result = Binary(expr.token, op, result, expr)
+    return result
+
+
+def _references(expr: Expr, scalars: Set[str]) -> Set[str]:
+    """Column names an expression reads; raises _Skip when that cannot be known."""
+    if isinstance(expr, Name):
+        return set() if expr.name in scalars else {expr.name}
+    if isinstance(expr, (Star, SubQuery)):
+        raise _Skip()
+    if isinstance(expr, Literal):
+        return set()
+    if isinstance(expr, Call):
+        return set().union(*(_references(arg, scalars) for arg in expr.args))
+    if isinstance(expr, Binary):
+        return _references(expr.left, scalars) | _references(expr.right, scalars)
+    if isinstance(expr, Unary):
+        return _references(expr.operand, scalars)
+    if isinstance(expr, Member):
+        return _references(expr.obj, scalars)
+    if isinstance(expr, Index):
+        return _references(expr.obj, scalars) | _references(expr.index, scalars)
+    if isinstance(expr, ListExpr):
+        return set().union(*(_references(item, scalars) for item in expr.items))
+    raise _Skip()
+
+
+def _operator_references(op: Operator, scalars: Set[str]) -> Set[str]:
+    """Columns an operator reads from its input; raises _Skip for operators that are not understood."""
+    if isinstance(op, Where):
+        return _references(op.predicate, scalars)
+    if isinstance(op, (Project, Extend)):
+        return set().union(*(_references(item.expr, scalars) for item in op.items))
+    if isinstance(op, Summarize):
+        return set().union(*(_references(item.expr, scalars) for item in op.aggregates + op.by))
+    if isinstance(op, Sort):
+        return set().union(*(_references(key, scalars) for key in op.by))
+    if isinstance(op, Take):
+        return _references(op.count, scalars)
+    if isinstance(op, Distinct) and op.columns:
+        return set().union(*(_references(column, scalars) for column in op.columns))
+    if isinstance(op, ProjectRename):
+        return {old.name for _, old in op.items}
+    if isinstance(op, Join):
+        return {key.left.name for key in op.on}
+    if isinstance(op, (Count, UnionOperator)):
+        return set()
+    raise _Skip()
+
+
+class KQLOptimizer:
+    """
+    Rewrites a locally valid KQL query into a cheaper equivalent.
+
+    Attributes:
+        time_window (Optional[str]): KQL timespan used for the default time window; None disables it.
+        untimed_tables (Set[str]): Tables that never get a default time window.
+    """
+
+    def __init__(self, time_window: Optional[str] = DEFAULT_TIME_WINDOW,
+                 untimed_tables: Sequence[str] = UNTIMED_TABLES,
+                 schemas: Optional[Mapping[str, Sequence[Tuple[str, str]]]] = None):
+        if time_window is not None:
+            tokens = tokenize(time_window)
+            if len(tokens) != 2 or tokens[0].kind != "TIMESPAN":
+                raise ValueError(f"time_window must be a KQL timespan such as '7d', got {time_window!r}.")
+        self.time_window = time_window
+        self.untimed_tables = set(untimed_tables)
+        self._schemas = schemas
+
+    @property
+    def schemas(self) -> Mapping[str, Sequence[Tuple[str, str]]]:
+        return get_registry() if self._schemas is None else self._schemas
+
+    # -- entry points ------------------------------------------------------- #
+
+    def optimize(self, kql_query: str) -> Tuple[str, List[str]]:
+        """
+        Returns the rewritten query and one reason per rewrite. Queries that
+        do not validate, and rewrites that would stop them validating, are
+        returned unchanged.
+        """
+        query = kql_query.strip()
+        if not validate_kql(query, schemas=self.schemas)["is_valid"]:
+            return kql_query, []
+        rewrite = _Rewrite(self, query)
+        try:
+            optimized, reasons = rewrite.run()
+        except (KQLError, KQLRenderError) as e:
+            logger.warning("KQL optimizer skipped the query: %s", e)
+            return kql_query, []
+        if not reasons:
+            return kql_query, []
+        check = validate_kql(optimized, schemas=self.schemas)
+        if not check["is_valid"]:
+            logger.warning("KQL optimizer output failed validation, keeping the original: %s", check["error"])
+            return kql_query, []
+        return optimized, reasons
+
+    def __call__(self, state: ThreatIntelState) -> ThreatIntelState:
+        logger.info("[KQL Optimizer]")
+        if state.get("validation_status") == "aborted":
+            return {"optimizations": []}
+        kql_query, reasons = self.optimize(state.get("kql_query", ""))
+        for reason in reasons:
+            logger.info("KQL rewrite: %s", reason)
+        if not reasons:
+            return {"optimizations": []}
+        logger.info("Optimized KQL Query: %s", kql_query)
+        return {"kql_query": kql_query, "optimizations": reasons}
+
+    async def acall(self, state: ThreatIntelState) -> ThreatIntelState:
+        """Async variant of __call__; the rewrites are CPU-only and fast, so it runs inline."""
+        return self(state)
+
+    # -- schema helpers ----------------------------------------------------- #
+
+    def table_columns(self, table: str) -> Optional[List[str]]:
+        if "*" in table or table not in self.schemas:
+            return None
+        return list(dict.fromkeys(column for column, _ in self.schemas[table]))
+
+    def datetime_columns(self, table: str) -> List[str]:
+        columns = list(dict.fromkeys(column for column, col_type in self.schemas[table] if col_type == "datetime"))
+        return sorted(columns, key=lambda c: DATETIME_COLUMNS.index(c) if c in DATETIME_COLUMNS else len(DATETIME_COLUMNS))
+
+
+class _Rewrite:
+    """Rewrites one query. Pipelines are re-rendered only when a rule changed them."""
+
+    def __init__(self, optimizer: KQLOptimizer, query: str):
+        self.optimizer = optimizer
+        self.query = query
+        self.ast = parse_kql(query)
+        self.tokens = tokenize(query)
+        self.index = {tok.pos: i for i, tok in enumerate(self.tokens)}
+        self.tabular_lets = {let.name for let in self.ast.lets if isinstance(let.value, Pipeline)}
+        self.scalars = {let.name for let in self.ast.lets if not isinstance(let.value, Pipeline)}
+        self.reasons: List[str] = []
+
+    def run(self) -> Tuple[str, List[str]]:
+        edits = []
+        for pipeline in self.ast.pipelines():
+            mark = len(self.reasons)
+            try:
+                start, end = self.span(pipeline)
+                text = self.pipeline(pipeline, nested=False)
+            except _Skip:
+                del self.reasons[mark:]
+                continue
+            if text is not None:
+                edits.append((start, end, text))
+        query = self.query
+        for start, end, text in sorted(edits, reverse=True):
+            query = query[:start] + text + query[end:]
+        return query, self.reasons
+
+    def note(self, reason: str) -> None:
+        self.reasons.append(reason)
+
+    # -- text layout -------------------------------------------------------- #
+
+    def parenthesized(self, pipeline: Pipeline) -> bool:
+        i = self.index[pipeline.source.token.pos]
+        return i > 0 and self.tokens[i - 1].kind == "OP" and self.tokens[i - 1].value == "("
+
+    def layout(self, pipeline: Pipeline) -> Tuple[int, List[int], int]:
+        """(source start, position of each top-level pipe, end) of a pipeline's text."""
+        i = self.index[pipeline.source.token.pos]
+        start, pipes, depth = self.tokens[i].pos, [], 0
+        while self.tokens[i].kind != "EOF":
+            tok = self.tokens[i]
+            if tok.kind == "OP":
+                if tok.value in "([{":
+                    depth += 1
+                elif tok.value in ")]}":
+                    if depth == 0:
+                        break
+                    depth -= 1
+                elif depth == 0 and tok.value == ";":
+                    break
+                elif depth == 0 and tok.value == "|":
+                    pipes.append(tok.pos)
+            i += 1
+        if len(pipes) != len(pipeline.operators):
+            raise _Skip()
+        return start, pipes, self.tokens[i].pos
+
+    def span(self, pipeline: Pipeline) -> Tuple[int, int]:
+        start, _, end = self.layout(pipeline)
+        return start, start + len(self.query[start:end].rstrip())
+
+    def segment(self, start: int, end: int, nested: Sequence[Pipeline]) -> str:
+        """Query text between start and end with nested pipelines rewritten."""
+        edits = []
+        for pipeline in nested:
+            mark = len(self.reasons)
+            try:
+                text = self.pipeline(pipeline, nested=True)
+                if text is not None:
+                    edits.append((*self.nested_span(pipeline), text))
+            except _Skip:
+                del self.reasons[mark:]
+        text = self.query[start:end].rstrip()
+        for edit_start, edit_end, replacement in sorted(edits, reverse=True):
+            text = text[:edit_start - start] + replacement + text[edit_end - start:]
+        return text
+
+    def nested_span(self, pipeline: Pipeline) -> Tuple[int, int]:
+        if self.parenthesized(pipeline):
+            return self.span(pipeline)
+        source = pipeline.source
+        if pipeline.operators or not isinstance(source, TableSource) or source.token.quoted:
+            raise _Skip()
+        return source.token.pos, source.token.pos + len(source.name)
+
+    # -- pipelines ---------------------------------------------------------- #
+
+    def pipeline(self, pipeline: Pipeline, nested: bool) -> Optional[str]:
+        """The rewritten text of a pipeline, or None when no rule changed it."""
+        if nested and not self.parenthesized(pipeline):
+            self.nested_span(pipeline)  # raises _Skip for anything but a bare table name
+            start, pipes, end = pipeline.source.token.pos, [], pipeline.source.token.pos + len(pipeline.source.name)
+        else:
+            start, pipes, end = self.layout(pipeline)
+        bounds = pipes + [end]
+        source = pipeline.source
+        # Bare union legs are left to push_into_union; bare join sides may become `(T | ...)`.
+        source_nested = [leg for leg in source.legs if self.parenthesized(leg)] if isinstance(source, UnionSource) else []
+        source_text = self.segment(start, bounds[0], source_nested)
+        stages = []
+        for op, op_end in zip(pipeline.operators, bounds[1:]):
+            if isinstance(op, Join):
+                nested_pipelines = [op.right]
+            elif isinstance(op, UnionOperator):
+                nested_pipelines = [leg for leg in op.legs if self.parenthesized(leg)]
+            else:
+                nested_pipelines = []
+            stages.append(_Stage(op, self.segment(op.token.pos, op_end, nested_pipelines)))
+        original = [source_text] + [stage.text for stage in stages]
+
+        for stage in stages:
+            if isinstance(stage.op, Where):
+                self.rewrite_predicate(stage)
+        windows = self.union_time_windows(source, stages)
+        source_text = self.push_down(source, source_text, stages, windows)
+        self.add_time_window(source, stages)
+        self.add_early_project(source, stages)
+
+        rendered = [source_text] + [stage.text for stage in stages]
+        if rendered == original:
+            return None
+        if not nested:
+            return "\n| ".join(rendered)
+        text = " | ".join(rendered)
+        return text if self.parenthesized(pipeline) else f"({text})"
+
+    def where(self, token: Token, predicates: Sequence[Expr]) -> _Stage:
+        predicate = _chain(list(predicates))
+        return _Stage(Where(token, predicate), f"where {render_expr(predicate, self.query)}")
+
+    # -- rules -------------------------------------------------------------- #
+
+    def rewrite_predicate(self, stage: _Stage) -> None:
+        mark = len(self.reasons)
+        predicate = self.contains_to_has(self.in_lists(stage.op.predicate))
+        if len(self.reasons) == mark:
+            return
+        try:
+            stage.text = f"{stage.op.name} {render_expr(predicate, self.query)}"
+        except KQLRenderError:
+            del self.reasons[mark:]
+            return
+        stage.op = Where(stage.op.token, predicate)
+
+    def in_lists(self, expr: Expr) -> Expr:
+        """Turns `c == x or c == y` into `c in (x, y)` (and `=~` into `in~`)."""
+        if not isinstance(expr, Binary):
+            return expr
+        if expr.op == "and":
+            return Binary(expr.token, "and", self.in_lists(expr.left), self.in_lists(expr.right))
+        if expr.op != "or":
+            return expr
+        disjuncts = [self.in_lists(d) for d in _conjuncts(expr, "or")]
+        groups: Dict[Tuple[str, str], List[Binary]] = {}
+        for d in disjuncts:
+            if isinstance(d, Binary) and d.op in ("==", "=~") and isinstance(d.left, Name) and isinstance(d.right, Literal):
+                groups.setdefault((d.left.name, d.op), []).append(d)
+        merged: List[Expr] = []
+        done: Set[Tuple[str, str]] = set()
+        for d in disjuncts:
+            key = (d.left.name, d.op) if isinstance(d, Binary) and isinstance(d.left, Name) else None
+            group = groups.get(key) if key is not None else None
+            if group is None or len(group) < 2 or d not in group:
+                merged.append(d)
+                continue
+            if key in done:
+                continue
+            done.add(key)
+            column, op = key
+            in_op = "in" if op == "==" else "in~"
+            values = ListExpr(group[0].token, [g.right for g in group])
+            merged.append(Binary(group[0].token, in_op, group[0].left, values))
+            self.note(f"{len(group)} '{column} {op}' comparisons joined by 'or' -> '{column} {in_op} (...)': "
+                      "one set lookup instead of a chain of predicates")
+        return _chain(merged, "or")
+
+    def contains_to_has(self, expr: Expr) -> Expr:
+        """`c contains "<IoC>"` -> `c has "<IoC>"` when the literal is exactly one indicator and one term."""
+        if not isinstance(expr, Binary):
+            return expr
+        if expr.op in ("and", "or"):
+            return Binary(expr.token, expr.op, self.contains_to_has(expr.left), self.contains_to_has(expr.right))
+        if expr.op not in _HAS_FOR_CONTAINS or not isinstance(expr.right, Literal) or expr.right.kind != "string":
+            return expr
+        value = expr.right.value
+        found = extract_iocs(value)
+        # `has` matches whole terms (runs of letters and digits), so only a
+        # literal that is one term is matched the same way; IPs, domains and
+        # URLs span several terms and `has` would miss e.g. "10.0.0.1" in "110.0.0.1".
+        if (len(found) != 1 or (found[0].start, found[0].end) != (0, len(value))
+                or not (value.isascii() and value.isalnum())):
+            return expr
+        new_op = _HAS_FOR_CONTAINS[expr.op]
+        column = render_expr(expr.left, self.query)
+        self.note(f"'{column} {expr.op} \"{value}\"' -> '{new_op}': the literal is a complete "
+                  f"{IOC_LABELS[found[0].type]} and a single term, so a whole-term match is meant and can use the term index")
+        return Binary(expr.token, new_op, expr.left, expr.right)
+
+    def columns(self, source, ops: Sequence[Operator]) -> Optional[List[str]]:
+        """Output columns of source followed by ops, or None when they are not known exactly."""
+        if not isinstance(source, TableSource) or source.name in self.tabular_lets:
+            return None
+        columns = self.optimizer.table_columns(source.name)
+        if columns is None:
+            return None
+        for op in ops:
+            if isinstance(op, (Where, Sort, Take)):
+                continue
+            if not isinstance(op, (Project, Extend)):
+                return None
+            names = []
+            for item in op.items:
+                name = item.alias or (item.expr.name if isinstance(item.expr, Name) else None)
+                if name is None or "," in name:
+                    return None
+                names.append(name)
+            columns = names if isinstance(op, Project) else columns + [n for n in names if n not in columns]
+        return columns
+
+    def leg_columns(self, leg: Pipeline) -> Optional[List[str]]:
+        return self.columns(leg.source, leg.operators)
+
+    def push_down(self, source, source_text: str, stages: List[_Stage],
+                  windows: Optional[List[List[str]]] = None) -> str:
+        """
+        Moves left-only conjuncts of a `where` in front of the join or union
+        before it. windows are per-leg filters for a union source (see
+        union_time_windows), rendered together with anything pushed into it.
+        """
+        if isinstance(source, UnionSource) and source.token.value == "union":
+            pushed = None
+            if stages and isinstance(stages[0].op, Where):
+                pushed = self.push_into_union(source, source.legs, stages[0], filters=windows)
+            if pushed is not None:
+                source_text, _, kept = pushed
+                self.replace_where(stages, 0, kept)
+            elif windows is not None:
+                source_text = self.union_text(source, source.legs, windows)
+        i = 0
+        while i < len(stages) - 1:
+            op, after = stages[i].op, stages[i + 1].op
+            if not isinstance(after, Where):
+                i += 1
+                continue
+            left = self.columns(source, [s.op for s in stages[:i]])
+            if isinstance(op, Join) and op.kind in _PUSHDOWN_JOIN_KINDS:
+                movable, kept = self.split(after.predicate, left)
+                if movable and self.renders(kept):
+                    self.replace_where(stages, i + 1, kept)
+                    stages.insert(i, self.where(after.token, movable))
+                    self.note(f"moved '{stages[i].text}' in front of the {op.kind} join: it only reads "
+                              "left-side columns, so fewer rows are shuffled into the join")
+                    i += 1
+            elif isinstance(op, UnionOperator):
+                pushed = self.push_into_union(op, op.legs, stages[i + 1], left)
+                if pushed is not None:
+                    union_text, movable, kept = pushed
+                    self.replace_where(stages, i + 1, kept)
+                    stages[i] = _Stage(op, union_text)
+                    stages.insert(i, self.where(after.token, movable))
+                    i += 1
+            i += 1
+        return source_text
+
+    def renders(self, exprs: Sequence[Expr]) -> bool:
+        try:
+            for expr in exprs:
+                render_expr(expr, self.query)
+        except KQLRenderError:
+            return False
+        return True
+
+    def split(self, predicate: Expr, available: Optional[List[str]]) -> Tuple[List[Expr], List[Expr]]:
+        """Conjuncts that only read the available columns, and the rest."""
+        movable, kept = [], []
+        for conjunct in _conjuncts(predicate):
+            try:
+                refs = _references(conjunct, self.scalars)
+            except _Skip:
+                refs = None
+            if available is not None and refs and refs <= set(available):
+                movable.append(conjunct)
+            else:
+                kept.append(conjunct)
+        return movable, kept
+
+    def replace_where(self, stages: List[_Stage], i: int, kept: List[Expr]) -> None:
+        if kept:
+            stages[i] = self.where(stages[i].op.token, kept)
+        else:
+            del stages[i]
+
+    def push_into_union(self, union, legs: List[Pipeline], stage: _Stage,
+                        prefix_columns: Optional[List[str]] = None,
+                        filters: Optional[List[List[str]]] = None) -> Optional[Tuple[str, List[Expr], List[Expr]]]:
+        """
+        Copies the conjuncts of the `where` stage that every union input can
+        evaluate into each bare-table leg, after the leg's own filters if any.
+        Returns the rewritten union text, the pushed conjuncts and the ones
+        that stay behind, or None.
+        """
+        if union.with_source or any(
+            leg.operators or not isinstance(leg.source, TableSource) or self.parenthesized(leg) for leg in legs
+        ):
+            return None
+        inputs = [self.leg_columns(leg) for leg in legs]
+        if isinstance(union, UnionOperator):
+            inputs.append(prefix_columns)
+        if any(columns is None for columns in inputs):
+            return None
+        available = sorted(set.intersection(*(set(columns) for columns in inputs)))
+        movable, kept = self.split(stage.op.predicate, available)
+        if not movable or not self.renders(kept):
+            return None
+        pushed = render_expr(_chain(movable), self.query)
+        self.note(f"pushed 'where {pushed}' into every input of the union: each input is filtered "
+                  "before its rows are concatenated")
+        leg_filters = [(filters[i] if filters else []) + [pushed] for i in range(len(legs))]
+        return self.union_text(union, legs, leg_filters), movable, kept
+
+    def union_text(self, union, legs: List[Pipeline], filters: Sequence[Sequence[str]]) -> str:
+        """A union over bare-table legs, each followed by its `where` filters."""
+        head = self.query[union.token.pos:legs[0].source.token.pos]
+        rendered = []
+        for leg, predicates in zip(legs, filters):
+            name = render_name(leg.source.name)
+            rendered.append(f"({name} | {' | '.join(f'where {p}' for p in predicates)})" if predicates else name)
+        return head + ", ".join(rendered)
+
+    def time_window_column(self, source, stages: List[_Stage]) -> Optional[str]:
+        """The datetime column to bound an event table by, or None when it is untimed or already filtered on time."""
+        if (not isinstance(source, TableSource) or source.name in self.tabular_lets
+                or source.name in self.optimizer.untimed_tables or self.optimizer.table_columns(source.name) is None):
+            return None
+        datetime_columns = self.optimizer.datetime_columns(source.name)
+        if not datetime_columns:
+            return None
+        time_columns = set(datetime_columns) | set(DATETIME_COLUMNS)
+        for stage in stages:
+            if not isinstance(stage.op, Where):
+                continue
+            try:
+                refs = _references(stage.op.predicate, self.scalars)
+            except _Skip:
+                return None
+            if refs & time_columns:
+                return None
+        return datetime_columns[0]
+
+    def add_time_window(self, source, stages: List[_Stage]) -> None:
+        """Bounds an event table by its datetime column unless the query already filters on time."""
+        window = self.optimizer.time_window
+        column = None if window is None else self.time_window_column(source, stages)
+        if column is None:
+            return
+        tok = source.token
+        predicate = Binary(tok, ">", Name(tok, column), Call(tok, "ago", [Literal(tok, window, "timespan")]))
+        stages.insert(0, _Stage(Where(tok, predicate), f"where {render_name(column)} > ago({window})"))
+        self.note(f"added 'where {column} > ago({window})' to {source.name}: {_TIME_WINDOW_REASON}")
+
+    def union_time_windows(self, source, stages: List[_Stage]) -> Optional[List[List[str]]]:
+        """
+        The default time window of each input of `union A, B, ...`, as per-leg
+        filters, or None when no input gets one. Only unions of bare tables
+        are handled; each input is bounded by its own datetime column.
+        """
+        window = self.optimizer.time_window
+        if (window is None or not isinstance(source, UnionSource) or source.token.value != "union" or any(
+            leg.operators or not isinstance(leg.source, TableSource) or self.parenthesized(leg) for leg in source.legs
+        )):
+            return None
+        windows = []
+        for leg in source.legs:
+            column = self.time_window_column(leg.source, stages)
+            windows.append([f"{render_name(column)} > ago({window})"] if column else [])
+            if column:
+                self.note(f"added 'where {column} > ago({window})' to the {leg.source.name} input of the union: "
+                          f"{_TIME_WINDOW_REASON}")
+        return windows if any(windows) else None
+
+    def add_early_project(self, source, stages: List[_Stage]) -> None:
+        """Projects only the columns the rest of the pipeline reads before its first join or union."""
+        first = next((i for i, s in enumerate(stages) if isinstance(s.op, (Join, UnionOperator))), None)
+        if first is None:
+            return
+        columns = self.columns(source, [s.op for s in stages[:first]])
+        if columns is None:
+            return
+        needed: Set[str] = set()
+        try:
+            for stage in stages[first:]:
+                op = stage.op
+                needed |= _operator_references(op, self.scalars)
+                if isinstance(op, Join):
+                    # Keep columns the right side also has, so its columns keep their `1` suffixes.
+                    right = self.columns(op.right.source, op.right.operators)
+                    if right is None:
+                        return
+                    needed |= set(right)
+                if isinstance(op, _NARROWING) or (isinstance(op, Distinct) and op.columns):
+                    break
+            else:
+                return
+        except _Skip:
+            return
+        kept = [c for c in columns if c in needed]
+        if not kept or len(kept) == len(columns):
+            return
+        names = ", ".join(render_name(c) for c in kept)
+        tok = stages[first].op.token
+        stages.insert(first, _Stage(Project(tok, []), f"project {names}"))
+        self.note(f"added 'project {names}' before the {stages[first + 1].op.name}: only "
+                  f"{len(kept)} of {len(columns)} columns are read after it")
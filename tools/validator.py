@@ -1,150 +1,195 @@
-import random
-from typing import List
+import logging
+from typing import Any, Generator, List, Optional, Tuple
 from langchain_core.messages import AIMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
-from ..llm import get_llm
-from ..schemas import schema_as_string
+from ..cost import CostModel
+from ..engine import DryRunPolicy
+from ..history import DEFAULT_HISTORY_POLICY, HistoryPolicy
+from ..kql_parser import validate_kql
+from ..llm import LazyLLM, arun_steps, run_steps
+from ..prompts import CachedPrompt
 from ..threat_intel_types import ThreatIntelState
 
+logger = logging.getLogger(__name__)
+
+# Per-query details from the optional checks, copied into every state update.
+_RESULT_EXTRAS = ("cost_estimate", "dry_run")
 
 
 class QueryValidator:
     """Validates KQL syntax and semantics, with reflection for fixing."""
-    # Removed duplicate __call__ method to resolve method override conflict.
 
     MAX_RETRIES = 2
 
-    REFLECTION_PROMPT = ChatPromptTemplate.from_messages([
-        ("system", """
+    llm = LazyLLM(temperature=0.5, kind="reflection")
+
+    REFLECTION_PROMPT = CachedPrompt("kql_validator", """
 You are an expert KQL query debugger. A KQL query has failed validation.
-Your task is to analyze the provided KQL query, the validation error, and the relevant table schemas.
+Your task is to analyze the KQL query and the validation error given at the end of the conversation, using the relevant table schemas below.
+The validation error gives the line and column of the offending token; fix that location first.
 Based on this information, propose a corrected KQL query.
 Ensure the corrected query adheres to KQL syntax and uses correct table and field names from the schema.
 Your output MUST be ONLY the corrected KQL query string, without any additional text, explanations, or markdown formatting (e.g., no ```kql).
-
+        """, suffix="""
 Original KQL Query:
 {original_kql_query}
 
 Validation Error:
 {validation_error}
 
-Shortlisted Tables and their Schemas (for context):
-{shortlisted_table_schemas}
-
 Enriched Threat Hunting Request (for original intent):
 {enriched_query}
-        """),
-        MessagesPlaceholder(variable_name="chat_history")
-    ])
+        """, schema_heading="Shortlisted Tables and their Schemas (for context):")
 
-    def __init__(self):
-        self.llm = get_llm(temperature=0.5)
+    def __init__(self, history_policy: HistoryPolicy = DEFAULT_HISTORY_POLICY, dry_run: Optional[DryRunPolicy] = None,
+                 cost_model: Optional[CostModel] = None):
+        self.history_policy = history_policy
+        self.dry_run = dry_run
+        self.cost_model = cost_model
 
-    def _simulate_kql_validation(self, kql_query: str, shortlisted_tables: List[str]) -> dict:
+    def _validate_kql(self, kql_query: str, shortlisted_tables: List[str]) -> dict:
         """
-        Simulates KQL syntax and semantic validation.
-        In a real system, this would call a KQLAnalyzer REST API.
+        Validates KQL syntax and semantics locally against the schema registry.
+        Errors carry the line/column of the offending token so the reflection
+        prompt can point the model at the exact fix.
         """
-        print(f"\n[Simulating KQL Validation for: {kql_query}]")
-        
-        # Simulate common errors for demonstration
-        if "invalid_field" in kql_query:
-            return {"is_valid": False, "error": "Semantic error: 'invalid_field' is not a recognized column."}
-        if "missing_pipe" in kql_query:
-            return {"is_valid": False, "error": "Syntax error: Missing pipe operator '|' before 'where'."}
-        if "non_existent_table" in kql_query:
-             return {"is_valid": False, "error": "Semantic error: Table 'non_existent_table' does not exist."}
-        
-        # Check if the query actually references any of the shortlisted tables
-        references_shortlisted_table = False
-        for table in shortlisted_tables:
-            if table in kql_query:
-                references_shortlisted_table = True
-                break
-        
-        if not references_shortlisted_table:
-            return {"is_valid": False, "error": "Semantic error: Query does not reference any of the shortlisted tables."}
-
-        # Simulate random success/failure for general queries
-        if random.random() < 0.8:  # 80% chance of success
-            return {"is_valid": True, "error": None}
-        else:
-            return {"is_valid": False, "error": "Generic KQL syntax or semantic error (simulated)."}
+        logger.info("[Validating KQL: %s]", kql_query)
+        return validate_kql(kql_query, shortlisted_tables)
 
-    def __call__(self, state: ThreatIntelState) -> ThreatIntelState:
-        print("\n[Query Validator]")
-        
+    def _check(self, state: ThreatIntelState) -> Tuple[Optional[ThreatIntelState], dict]:
+        """
+        Runs local validation. Returns the final state update when no
+        reflection is needed (valid, or out of retries), otherwise None and
+        the failure.
+        """
         kql_query = state.get("kql_query", "")
         shortlisted_tables = state.get("shortlisted_tables", [])
-        enriched_query = state.get("enriched_query", "")
         retries = state.get("retries", 0)
-        chat_history = state.get("chat_history", [])
 
-        validation_result = self._simulate_kql_validation(kql_query, shortlisted_tables)
+        if state.get("validation_status") == "aborted":
+            # The streaming generator already found the error in a prefix.
+            validation_result = {"is_valid": False, "error": state.get("validation_error", "")}
+        else:
+            validation_result = self._validate_kql(kql_query, shortlisted_tables)
+
+        if validation_result["is_valid"] and self.cost_model is not None:
+            validation_result = self._cost_check(kql_query)
+        if validation_result["is_valid"] and self.dry_run is not None:
+            validation_result = {**validation_result, **self._dry_run(kql_query, state, retries)}
 
         if validation_result["is_valid"]:
-            print("KQL Query Validated Successfully.")
-            state["validation_status"] = "valid"
-            state["validation_error"] = ""
-            state["retries"] = 0
-            if "chat_history" not in state or state["chat_history"] is None:
-                state["chat_history"] = []
-            state["chat_history"].append(AIMessage(content=f"KQL Validated: {kql_query}"))
-            return state
+            logger.info("KQL Query Validated Successfully.")
+            update = {
+                "validation_status": "valid",
+                "validation_error": "",
+                "retries": 0,
+                "chat_history": [AIMessage(content=f"KQL Validated: {kql_query}")],
+                **self._extras(validation_result),
+            }
+            return update, validation_result
+
+        logger.info("KQL Query Validation Failed: %s", validation_result["error"])
+        if retries >= self.MAX_RETRIES:
+            logger.warning("Max retries reached (%d). Query remains invalid.", self.MAX_RETRIES)
+            return {
+                "validation_status": "failed",
+                "validation_error": validation_result["error"],
+                "chat_history": [AIMessage(content=f"KQL Validation Failed after retries: {kql_query} (Error: {validation_result['error']})")],
+                **self._extras(validation_result),
+            }, validation_result
+
+        logger.info("Attempting to fix query (Retry %d/%d)...", retries + 1, self.MAX_RETRIES)
+        return None, validation_result
+
+    def _cost_check(self, kql_query: str) -> dict:
+        """
+        Estimates the cost of a locally valid query. Over-budget queries go to
+        reflection, and are rejected once retries run out.
+        """
+        try:
+            estimate, problem = self.cost_model.check(kql_query)
+        except Exception as e:
+            logger.warning("Could not estimate query cost, skipping the budget check: %s", e)
+            return {"is_valid": True, "error": None}
+        logger.info("Estimated cost: %.0f bytes scanned, largest join %.0f rows.", estimate.scan_bytes,
+                    estimate.max_join_rows)
+        return {"is_valid": problem is None, "error": problem, "cost_estimate": estimate.as_dict()}
+
+    @staticmethod
+    def _extras(validation_result: dict) -> dict:
+        return {key: validation_result[key] for key in _RESULT_EXTRAS if key in validation_result}
+
+    def _dry_run(self, kql_query: str, state: ThreatIntelState, retries: int) -> dict:
+        """
+        Executes a locally valid query on the sample data. Empty or exploding
+        results go to reflection while retries are left; after that the query
+        is accepted as it stands.
+        """
+        iocs = [ioc["value"] for ioc in state.get("iocs", [])]
+        result, problem = self.dry_run.check(kql_query, iocs)
+        logger.info("Dry run: %d rows from %d scanned rows in %.1f ms.", result.rows, result.rows_scanned,
+                    result.seconds * 1000)
+        if problem is None:
+            return {"is_valid": True, "error": None, "dry_run": result.as_dict()}
+        if retries >= self.MAX_RETRIES:
+            logger.warning("Dry run still flags the query after %d retries: %s", retries, problem)
+            return {"is_valid": True, "error": None, "dry_run": result.as_dict()}
+        return {"is_valid": False, "error": problem, "dry_run": result.as_dict()}
+
+    def _reflection_messages(self, state: ThreatIntelState, validation_result: dict) -> List:
+        return self.REFLECTION_PROMPT.format_messages(
+            state.get("shortlisted_tables", []),
+            self.history_policy.select(state.get("chat_history", [])),
+            original_kql_query=state.get("kql_query", ""),
+            validation_error=validation_result["error"],
+            enriched_query=state.get("enriched_query", ""),
+        )
+
+    def _on_fix(self, state: ThreatIntelState, validation_result: dict, llm_response) -> ThreatIntelState:
+        fixed_kql_query = ""
+        if isinstance(llm_response.content, str):
+            fixed_kql_query = llm_response.content.strip()
         else:
-            print(f"KQL Query Validation Failed: {validation_result['error']}")
-            if retries < self.MAX_RETRIES:
-                print(f"Attempting to fix query (Retry {retries + 1}/{self.MAX_RETRIES})...")
-                
-                shortlisted_schemas_str = schema_as_string(shortlisted_tables)
-                
-                try:
-                    msg = self.REFLECTION_PROMPT.format_messages(
-                        original_kql_query=kql_query,
-                        validation_error=validation_result["error"],
-                        shortlisted_table_schemas=shortlisted_schemas_str,
-                        enriched_query=enriched_query,
-                        chat_history=chat_history
-                    )
-                    
-                    llm_response = self.llm.invoke(msg)
-                    
-                    fixed_kql_query = ""
-                    if isinstance(llm_response.content, str):
-                        fixed_kql_query = llm_response.content.strip()
-                    else:
-                        print(f"Warning: LLM response content for KQL fix is not a string, received type: {type(llm_response.content)}")
-                        if isinstance(llm_response.content, list):
-                            fixed_kql_query = "".join([part for part in llm_response.content if isinstance(part, str)]).strip()
-                        if not fixed_kql_query:
-                            raise ValueError("LLM response content is not a parsable string for KQL fix.")
-
-                    print(f"Proposed Fixed KQL Query: {fixed_kql_query}")
-
-                    state["kql_query"] = fixed_kql_query
-                    state["validation_status"] = "retrying"
-                    state["validation_error"] = validation_result["error"]
-                    state["retries"] = retries + 1
-                    chat_history = state.get("chat_history", [])
-                    chat_history.append(AIMessage(content=f"KQL Fix Attempted: {fixed_kql_query} (Error: {validation_result['error']})"))
-                    state["chat_history"] = chat_history
-                    
-                    return state
-                    
-                except Exception as e:
-                    print(f"An unexpected error occurred during KQL fixing: {e}")
-                    state["validation_status"] = "failed"
-                    state["validation_error"] = f"Error during KQL fix attempt: {e}"
-                    if "chat_history" not in state or state["chat_history"] is None:
-                        state["chat_history"] = []
-                    state["chat_history"].append(AIMessage(content=f"Error during KQL fix attempt: {e}"))
-                    return state
-            else:
-                print(f"Max retries reached ({self.MAX_RETRIES}). Query remains invalid.")
-                state["validation_status"] = "failed"
-                state["validation_error"] = validation_result["error"]
-                if "chat_history" not in state or state["chat_history"] is None:
-                    state["chat_history"] = []
-                state["chat_history"].append(AIMessage(content=f"KQL Validation Failed after retries: {kql_query} (Error: {validation_result['error']})"))
-                return state
+            logger.warning("LLM response content for KQL fix is not a string, received type: %s", type(llm_response.content))
+            if isinstance(llm_response.content, list):
+                fixed_kql_query = "".join([part for part in llm_response.content if isinstance(part, str)]).strip()
+            if not fixed_kql_query:
+                raise ValueError("LLM response content is not a parsable string for KQL fix.")
+
+        logger.info("Proposed Fixed KQL Query: %s", fixed_kql_query)
+
+        return {
+            "kql_query": fixed_kql_query,
+            "validation_status": "retrying",
+            "validation_error": validation_result["error"],
+            "retries": state.get("retries", 0) + 1,
+            "chat_history": [AIMessage(content=f"KQL Fix Attempted: {fixed_kql_query} (Error: {validation_result['error']})")],
+            **self._extras(validation_result),
+        }
+
+    def _on_fix_error(self, e: Exception) -> ThreatIntelState:
+        logger.error("An unexpected error occurred during KQL fixing: %s", e)
+        return {
+            "validation_status": "failed",
+            "validation_error": f"Error during KQL fix attempt: {e}",
+            "chat_history": [AIMessage(content=f"Error during KQL fix attempt: {e}")],
+        }
+
+    def _steps(self, state: ThreatIntelState) -> Generator[List, Any, ThreatIntelState]:
+        """Yields the reflection request, if the query needs fixing, and returns the update."""
+        logger.info("[Query Validator]")
+        done, validation_result = self._check(state)
+        if done is not None:
+            return done
+        try:
+            llm_response = yield self._reflection_messages(state, validation_result)
+            return self._on_fix(state, validation_result, llm_response)
+        except Exception as e:
+            return self._on_fix_error(e)
+
+    def __call__(self, state: ThreatIntelState) -> ThreatIntelState:
+        return run_steps(self._steps(state), self.llm.invoke)
+
+    async def acall(self, state: ThreatIntelState) -> ThreatIntelState:
+        """Async variant of __call__; awaits the reflection LLM call instead of blocking on it."""
+        return await arun_steps(self._steps(state), self.llm.ainvoke)